@@ -0,0 +1,13 @@
+from tqdm import tqdm
+
+from src.modules.datasets.feverous.database.element_store import build_element_store
+
+
+document_path = "datas/feverous/feverous_wikiv1.db"
+# Same as document_path to add the `elements` table to the Feverous DB itself
+output_path = "datas/feverous/feverous_elements.db"
+
+
+if __name__ == '__main__':
+    with tqdm(desc="Exploding pages", unit="doc") as pbar:
+        build_element_store(document_path, output_path, progress=pbar.update)
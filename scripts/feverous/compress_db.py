@@ -0,0 +1,18 @@
+import json
+
+from tqdm import tqdm
+
+from src.modules.datasets.feverous.database.compression import compress_db
+
+
+document_path = "datas/feverous/feverous_wikiv1.db"
+output_path = "datas/feverous/feverous_wikiv1.zstd.db"
+level = 9
+# 0 disables dictionary training
+dict_size = 112 * 1024
+
+
+if __name__ == '__main__':
+    with tqdm(desc="Compressing pages", unit="doc") as pbar:
+        report = compress_db(document_path, output_path, level, dict_size, progress=pbar.update)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,24 @@
+from tqdm import tqdm
+
+from src.modules.datasets.feverous.database.subset import collect_page_ids, extract_subset
+from src.modules.datasets.feverous.utils.annotation_processor import AnnotationProcessor
+from src.modules.retrievers.graph_check import load_retriever
+
+
+dataset_path = "datas/feverous/feverous_dev_challenges.jsonl"
+document_path = "datas/feverous/feverous_wikiv1.db"
+output_path = "datas/feverous/feverous_dev_subset.db"
+# Also keep the pages retrieved for every claim, None to only keep evidence and context pages
+persist_path = None
+similarity_top_k = 10
+
+
+if __name__ == '__main__':
+    retriever = None
+    if persist_path:
+        retriever = load_retriever(persist_path, document_path, similarity_top_k)
+
+    with tqdm(desc="Collecting pages", unit="claim") as pbar:
+        page_ids = collect_page_ids(AnnotationProcessor(dataset_path), retriever, progress=pbar.update)
+    num_pages = extract_subset(document_path, output_path, page_ids)
+    print(f"Wrote {num_pages} of {len(page_ids)} pages to {output_path}")
@@ -0,0 +1,54 @@
+import argparse
+import json
+import time
+
+from src.modules.retrievers.evaluation import load_claims, benchmark_retriever, get_rss_mb
+from src.modules.retrievers.graph_check import build_retriever, load_retriever
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark a retriever against Feverous gold evidence.")
+    parser.add_argument("--annotations", default="datas/feverous/feverous_dev_challenges.jsonl")
+    parser.add_argument("--document-path", default="datas/feverous/feverous_wikiv1.db")
+    parser.add_argument("--persist-path", default=None,
+                        help="Persisted index (BM25 dir, TF-IDF .npz or FTS .db). "
+                             "Without it a llama-index BM25Retriever is built from --document-path.")
+    parser.add_argument("--text-store-path", default=None,
+                        help="Page texts written by scripts/graph_check/build_text_store.py, "
+                             "used instead of parsing pages when building from --document-path.")
+    parser.add_argument("--ks", type=int, nargs="+", default=[1, 5, 10])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1])
+    parser.add_argument("--limit", type=int, default=None, help="Only use the first N annotations.")
+    parser.add_argument("--ids-only", action="store_true", help="Skip rendering retrieved texts when possible.")
+    parser.add_argument("--output", default=None, help="Also write the results as JSON.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    claims = load_claims(args.annotations, args.limit)
+
+    rss_before, _ = get_rss_mb()
+    start = time.perf_counter()
+    if args.persist_path:
+        retriever = load_retriever(args.persist_path, args.document_path, max(args.ks))
+    else:
+        retriever = build_retriever(args.document_path, max(args.ks), args.text_store_path)
+    load_time = time.perf_counter() - start
+    rss_after, _ = get_rss_mb()
+
+    results = benchmark_retriever(retriever, claims, args.ks, args.batch_sizes, args.workers, args.ids_only)
+    results = {"load_s": load_time, "index_rss_mb": rss_after - rss_before, **results}
+
+    for key, value in results.items():
+        if key != "sweeps":
+            print(f"{key:>20}: {value}")
+    print(f"{'batch_size':>10} {'workers':>8} {'queries/s':>10} {'p50 ms':>8} {'p95 ms':>8}")
+    for sweep in results["sweeps"]:
+        print(f"{sweep['batch_size']:>10} {sweep['workers']:>8} {sweep['queries_per_s']:>10.1f} "
+              f"{sweep['p50_latency_ms']:>8.2f} {sweep['p95_latency_ms']:>8.2f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
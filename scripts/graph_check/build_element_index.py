@@ -0,0 +1,18 @@
+from tqdm import tqdm
+
+from src.modules.retrievers.elements import build_element_index
+
+
+document_path = "datas/feverous/feverous_wikiv1.db"
+persist_path = "output/graph_check/elements"
+workers = 4
+num_shards = 64
+# Written by build_text_store.py with elements, None to parse every page
+text_store_path = None
+
+
+if __name__ == '__main__':
+    with tqdm(total=num_shards, desc="Indexing shards") as pbar:
+        build_element_index(
+            persist_path, document_path, text_store_path, workers, num_shards, progress=lambda _: pbar.update()
+        )
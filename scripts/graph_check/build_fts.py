@@ -0,0 +1,20 @@
+from tqdm import tqdm
+
+from src.modules.retrievers.fts import build_fts
+
+
+document_path = "datas/feverous/feverous_wikiv1.db"
+output_path = "output/graph_check/feverous_wikiv1_fts.db"
+with_elements = True
+# Written by build_text_store.py (with elements if with_elements), None to parse every page
+text_store_path = None
+# Cap on the characters of every table in page texts, must match the text store when one is used
+max_table_chars = None
+# Level the retriever opens the DB at, "element" requires with_elements
+level = "page"
+
+
+if __name__ == '__main__':
+    with tqdm(desc="Indexing documents", unit="doc") as pbar:
+        build_fts(document_path, output_path, elements=with_elements, progress=pbar.update,
+                  text_store_path=text_store_path, max_table_chars=max_table_chars, level=level)
@@ -1,39 +1,21 @@
-import multiprocessing as mp
 from tqdm import tqdm
-from llama_index.core import Document
-from llama_index.core.indices import SummaryIndex
-from llama_index.retrievers.bm25 import BM25Retriever
 
-from src.modules.datasets.feverous.database.feverous_db import FeverousDB
-from src.modules.datasets.feverous.utils.wiki_page import WikiPage
+from src.modules.retrievers.bm25 import build_sharded_index
 
 
 document_path = "datas/feverous/feverous_wikiv1.db"
 persist_path = "output/graph_check"
 workers = 4
-
-db = FeverousDB(document_path)
-doc_ids = db.get_doc_ids()
-
-
-def task(doc_id):
-    page_json = db.get_doc_json(doc_id)
-    wiki_page = WikiPage(doc_id, page_json)
-    document = Document(text=str(wiki_page))
-    return document
+num_shards = 64
+# Written by build_text_store.py, None to parse every page
+text_store_path = None
+# Cap on the characters of every table, must match the text store when one is used
+max_table_chars = None
 
 
 if __name__ == '__main__':
-    with mp.Pool(processes=workers) as pool:
-        documents = list(
-            tqdm(
-                pool.imap_unordered(task, doc_ids, chunksize=100),
-                total=len(doc_ids),
-                desc="Indexing documents"
-            )
+    with tqdm(total=num_shards, desc="Indexing shards") as pbar:
+        build_sharded_index(
+            persist_path, document_path, workers, num_shards, progress=lambda _: pbar.update(),
+            text_store_path=text_store_path, max_table_chars=max_table_chars
         )
-
-    index = SummaryIndex(nodes=documents)
-    retriever = BM25Retriever.from_defaults(index, similarity_top_k=10)
-
-    retriever.persist(persist_path)
\ No newline at end of file
@@ -0,0 +1,12 @@
+from tqdm import tqdm
+
+from src.modules.retrievers.links import build_link_graph
+
+
+document_path = "datas/feverous/feverous_wikiv1.db"
+output_path = "output/graph_check/links.npz"
+
+
+if __name__ == '__main__':
+    with tqdm(desc="Extracting links", unit="doc") as pbar:
+        build_link_graph(document_path, output_path, progress=pbar.update)
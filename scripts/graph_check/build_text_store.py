@@ -0,0 +1,20 @@
+from tqdm import tqdm
+
+from src.modules.retrievers.text_store import build_text_store
+
+
+document_path = "datas/feverous/feverous_wikiv1.db"
+# Rebuilding over an existing store only parses the pages that changed
+output_path = "output/graph_check/feverous_wikiv1_texts.db"
+with_elements = True
+workers = 4
+# Cap on the characters of every table in page texts, None to keep whole tables
+max_table_chars = None
+
+
+if __name__ == '__main__':
+    with tqdm(desc="Linearizing pages", unit="doc") as pbar:
+        build_text_store(
+            document_path, output_path, elements=with_elements, workers=workers, progress=pbar.update,
+            max_table_chars=max_table_chars
+        )
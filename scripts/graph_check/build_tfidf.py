@@ -0,0 +1,18 @@
+from tqdm import tqdm
+
+from src.modules.retrievers.tfidf import build_tfidf
+
+
+document_path = "datas/feverous/feverous_wikiv1.db"
+output_path = "output/graph_check/tfidf.npz"
+hash_size = 2 ** 24
+ngram = 2
+workers = 4
+# Written by build_text_store.py, None to parse every page
+text_store_path = None
+
+
+if __name__ == '__main__':
+    with tqdm(desc="Counting n-grams", unit="doc") as pbar:
+        build_tfidf(output_path, document_path, hash_size, ngram, workers, progress=pbar.update,
+                    text_store_path=text_store_path)
@@ -0,0 +1,25 @@
+import time
+
+from src.modules.retrievers.segments import SegmentedBM25Index, update_pages
+
+
+document_path = "datas/feverous/feverous_wikiv1.db"
+persist_path = "output/graph_check"
+# One page id per line. Pages missing from the DB are removed from the index.
+page_ids_path = "output/graph_check/updated_pages.txt"
+compact = False
+
+
+if __name__ == '__main__':
+    with open(page_ids_path, encoding="utf-8") as f:
+        page_ids = [line.rstrip("\n") for line in f if line.strip()]
+
+    start = time.perf_counter()
+    index = SegmentedBM25Index(persist_path)
+    num_indexed, num_deleted = update_pages(index, document_path, page_ids)
+    if compact:
+        index.compact()
+    print(
+        f"Indexed {num_indexed} pages, deleted {num_deleted} pages in {time.perf_counter() - start:.2f}s "
+        f"(version {index.version}, {len(index.segments)} segments, {index.num_docs} documents)"
+    )
@@ -15,3 +15,5 @@ class SynthesisContext(BaseModel):
     infilling_log: list[dict] = Field(default=[])
     current_latent_entity: str = Field(default=None)
     infilling_index: int = Field(default=0)
+    # Pages retrieved for already infilled latent entities, seeds for link expansion
+    retrieved_pages: list[str] = Field(default=[])
@@ -2,16 +2,14 @@ import re
 from typing import Optional
 
 from workflows import Workflow, step, Context
-from llama_index.core import Document
 from llama_index.core.llms import LLM
 from llama_index.core.prompts import ChatMessage
 from llama_index.core.retrievers import BaseRetriever
-from llama_index.core.indices import SummaryIndex
-from llama_index.retrievers.bm25 import BM25Retriever
 
 from src.modules.schema.graph_check.graph import Graph
-from src.modules.datasets.feverous.database.feverous_db import FeverousDB
-from src.modules.datasets.feverous.utils.wiki_page import WikiPage
+from src.modules.datasets.feverous.utils import split_element_id
+from src.modules.retrievers.graph_check import DEFAULT_CACHE_SIZE, DEFAULT_TOP_K, get_retriever, with_cache
+from src.modules.retrievers.links import DEFAULT_CANDIDATE_TOP_K, LinkExpansionRetriever
 from ...events.graph_check.infilling import (
     InfillingStartEvent,
     InfillingLoopInitialize,
@@ -25,38 +23,42 @@ from ...events.graph_check.infilling import (
 from ...events.graph_check.context import SynthesisContext
 
 
-def build_retriever(document_path: str) -> BM25Retriever:
-    db = FeverousDB(document_path)
-    doc_ids = db.get_doc_ids()
-
-    documents = []
-    for doc_id in doc_ids:
-        page_json = db.get_doc_json(doc_id)
-        wiki_page = WikiPage(doc_id, page_json)
-        document = Document(text=str(wiki_page))
-        documents.append(document)
-
-    index = SummaryIndex(nodes=documents)
-    retriever = BM25Retriever.from_defaults(index, similarity_top_k=10)
-
-    return retriever
-
-
 class InfillingWorkflow(Workflow):
     def __init__(self,
                  llm: LLM,
                  retriever: Optional[BaseRetriever] = None,
                  document_path: str = None,
+                 persist_path: str = None,
+                 cache_size: Optional[int] = None,
+                 cache_path: str = None,
+                 link_graph_path: str = None,
+                 candidate_top_k: int = DEFAULT_CANDIDATE_TOP_K,
+                 max_table_chars: int = None,
                  **kwargs):
         super().__init__(**kwargs)
         self.llm = llm
-        if sum(bool(val) for val in [document_path, retriever]) != 1:
-            raise ValueError("Please pass exactly one of document_path or retriever.")
-
-        if document_path:
-            retriever = build_retriever(document_path)
+        if sum(bool(val) for val in [document_path or persist_path, retriever]) != 1:
+            raise ValueError("Please pass exactly one of document_path/persist_path or retriever.")
+
+        if document_path or persist_path:
+            # Caps the tables of retrieved pages, so that one huge table cannot fill the infilling prompt.
+            # With a link graph the retriever supplies the candidates re-ranked by `LinkExpansionRetriever`
+            retriever = get_retriever(
+                document_path, persist_path,
+                similarity_top_k=candidate_top_k if link_graph_path else DEFAULT_TOP_K,
+                cache_size=DEFAULT_CACHE_SIZE if cache_size is None else cache_size, cache_path=cache_path,
+                max_table_chars=max_table_chars
+            )
+        else:
+            # Caller-supplied retrievers are only cached on request
+            retriever = with_cache(retriever, cache_size or 0, cache_path)
 
         self.retriever = retriever
+        if link_graph_path:
+            # The link graph is only loaded on the first retrieval
+            self.retriever = LinkExpansionRetriever(
+                self.retriever, link_graph_path, candidate_top_k=candidate_top_k, max_table_chars=max_table_chars
+            )
 
     @step
     async def initialize(
@@ -194,9 +196,17 @@ class InfillingWorkflow(Workflow):
 
     @step
     async def retrieve_evidence(
-            self, ev: RetrieveEvidenceEvent
+            self, ctx: Context[SynthesisContext], ev: RetrieveEvidenceEvent
     ) -> InfillEvent:
-        nodes = self.retriever.retrieve(ev.query)
+        if isinstance(self.retriever, LinkExpansionRetriever):
+            retrieved_pages = await ctx.store.get("retrieved_pages")
+            nodes = self.retriever.retrieve_with_seeds(ev.query, retrieved_pages)
+            async with ctx.store.edit_state() as ctx_state:
+                ctx_state.retrieved_pages = retrieved_pages + [
+                    split_element_id(node.node_id)[0] for node in nodes
+                ]
+        else:
+            nodes = self.retriever.retrieve(ev.query)
 
         evidence = "\n".join([node.text for node in nodes])
 
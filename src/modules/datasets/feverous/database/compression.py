@@ -0,0 +1,167 @@
+"""zstd-compressed copies of the Feverous DB.
+
+A compressed DB keeps the `wiki(id, data)` table (same ids, same rowids) but stores every
+non-empty `data` as a zstd frame, optionally compressed with a trained dictionary. A
+`wiki_meta` table marks the file as compressed and holds the dictionary. `FeverousDB`
+detects it and decompresses transparently.
+
+Requires the `zstandard` package, which is only imported when a compressed DB is used.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+META_TABLE = "wiki_meta"
+DEFAULT_LEVEL = 9
+DEFAULT_DICT_SIZE = 112 * 1024
+DEFAULT_DICT_SAMPLES = 20000
+
+
+def _import_zstd():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError(
+            "Compressed Feverous DBs require the `zstandard` package: pip install 'fact-check[compression]'"
+        ) from e
+    return zstandard
+
+
+def is_compressed(connection):
+    """Whether the DB behind `connection` was written by `compress_db`."""
+    return connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (META_TABLE,)
+    ).fetchone() is not None
+
+
+class PageCodec(object):
+    """(De)compression of page json with the settings stored in a compressed DB.
+
+    zstd contexts are not thread-safe, so every thread gets its own decompressor.
+    """
+
+    def __init__(self, dict_data=None, level=DEFAULT_LEVEL):
+        self.zstd = _import_zstd()
+        self.dict_data = self.zstd.ZstdCompressionDict(dict_data) if dict_data else None
+        self.level = level
+        self._local = threading.local()
+
+    @classmethod
+    def from_connection(cls, connection):
+        meta = dict(connection.execute(f"SELECT key, value FROM {META_TABLE}").fetchall())
+        return cls(meta.get("dict"), int(meta.get("level", DEFAULT_LEVEL)))
+
+    def _get(self, name, factory):
+        context = getattr(self._local, name, None)
+        if context is None:
+            context = factory()
+            setattr(self._local, name, context)
+        return context
+
+    def compress(self, text):
+        compressor = self._get(
+            "compressor", lambda: self.zstd.ZstdCompressor(level=self.level, dict_data=self.dict_data)
+        )
+        return compressor.compress(text.encode("utf-8"))
+
+    def decompress(self, data):
+        decompressor = self._get("decompressor", lambda: self.zstd.ZstdDecompressor(dict_data=self.dict_data))
+        return decompressor.decompress(data).decode("utf-8")
+
+
+def train_dictionary(db, dict_size=DEFAULT_DICT_SIZE, num_samples=DEFAULT_DICT_SAMPLES):
+    """Train a zstd dictionary on `num_samples` pages of the `FeverousDB` `db`, spread evenly over the rowid range."""
+    zstd = _import_zstd()
+    min_rowid, max_rowid = db.get_rowid_range()
+    step = max(1, (max_rowid - min_rowid + 1) // num_samples)
+    samples = [
+        db.decode_data(data).encode("utf-8") for data, in db.connection.execute(
+            "SELECT data FROM wiki WHERE (rowid - ?) % ? = 0 AND length(trim(data)) > 0 ORDER BY rowid",
+            (min_rowid, step)
+        )
+    ]
+    return zstd.train_dictionary(dict_size, samples).as_bytes()
+
+
+def compress_db(
+        document_path,
+        output_path,
+        level=DEFAULT_LEVEL,
+        dict_size=0,
+        batch_size=1000,
+        progress=None
+):
+    """Write a zstd-compressed copy of the Feverous DB at `document_path` to `output_path`.
+
+    With `dict_size > 0` a dictionary of that many bytes is trained first, which helps a lot with
+    the many short pages. Returns a report with the size reduction and the compression and
+    decompression throughput.
+    """
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    # Imported here, feverous_db imports this module
+    from .feverous_db import FeverousDB
+
+    source = FeverousDB(document_path, read_only=True)
+    target = sqlite3.connect(output_path)
+    target.execute("CREATE TABLE wiki (id PRIMARY KEY, data)")
+    target.execute(f"CREATE TABLE {META_TABLE} (key TEXT PRIMARY KEY, value)")
+
+    dict_data = train_dictionary(source, dict_size) if dict_size else None
+    codec = PageCodec(dict_data, level)
+    target.executemany(
+        f"INSERT INTO {META_TABLE} VALUES (?, ?)",
+        [("compression", "zstd"), ("level", level)] + ([("dict", dict_data)] if dict_data else [])
+    )
+
+    input_bytes, output_bytes, num_pages = 0, 0, 0
+    compress_time = 0.0
+    rows = []
+    for rowid, doc_id, data in source.iter_docs(batch_size):
+        if data and data.strip():
+            start = time.perf_counter()
+            compressed = codec.compress(data)
+            compress_time += time.perf_counter() - start
+            input_bytes += len(data.encode("utf-8"))
+            output_bytes += len(compressed)
+        else:
+            # Empty pages stay plain text, so that `length(trim(data))` filters keep working
+            compressed = data
+        rows.append((rowid, doc_id, compressed))
+        num_pages += 1
+        if len(rows) >= batch_size:
+            target.executemany("INSERT INTO wiki (rowid, id, data) VALUES (?, ?, ?)", rows)
+            target.commit()
+            if progress:
+                progress(len(rows))
+            rows.clear()
+    target.executemany("INSERT INTO wiki (rowid, id, data) VALUES (?, ?, ?)", rows)
+    target.commit()
+    if progress:
+        progress(len(rows))
+    source.close()
+
+    # Decompression throughput over the whole output, as a cold full-corpus pass would see it
+    decompress_time = 0.0
+    for data, in target.execute("SELECT data FROM wiki"):
+        if isinstance(data, bytes):
+            start = time.perf_counter()
+            codec.decompress(data)
+            decompress_time += time.perf_counter() - start
+    target.execute("VACUUM")
+    target.close()
+
+    mb = 1024 ** 2
+    return {
+        "pages": num_pages,
+        "input_mb": input_bytes / mb,
+        "output_mb": output_bytes / mb,
+        "dict_kb": len(dict_data) / 1024 if dict_data else 0,
+        "ratio": input_bytes / output_bytes if output_bytes else 0.0,
+        "input_file_mb": os.path.getsize(document_path) / mb,
+        "output_file_mb": os.path.getsize(output_path) / mb,
+        "compress_mb_per_s": input_bytes / mb / compress_time if compress_time else 0.0,
+        "decompress_mb_per_s": input_bytes / mb / decompress_time if decompress_time else 0.0,
+    }
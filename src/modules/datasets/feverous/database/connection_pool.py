@@ -0,0 +1,88 @@
+"""Per-thread sqlite connections."""
+
+import os
+import sqlite3
+import threading
+import weakref
+from pathlib import Path
+
+# Memory-map up to 1 GiB of the file and keep up to 64 MiB of pages in sqlite's own cache
+DEFAULT_MMAP_SIZE = 1 << 30
+DEFAULT_CACHE_SIZE_KB = 64 * 1024
+
+
+class _ThreadConnection(object):
+    """Holder of a thread's connection in the pool's thread-local, dropped when the thread exits."""
+    __slots__ = ("connection", "__weakref__")
+
+    def __init__(self, connection):
+        self.connection = connection
+
+
+def _release(lock, connections, connection, pid):
+    # A connection inherited through fork is left alone, like in `ConnectionPool.connection`
+    if pid != os.getpid():
+        return
+    with lock:
+        if connection in connections:
+            connections.remove(connection)
+    connection.close()
+
+
+class ConnectionPool(object):
+    """Hands every thread (and every forked process) its own sqlite connection.
+
+    Connections are opened lazily. With `read_only=True` they are opened through a
+    `file:...?mode=ro` URI, so any number of processes can query the same file concurrently.
+    Every connection is tuned with `mmap_size` (bytes) and `cache_size` (KiB) pragmas.
+    A thread's connection is closed when the thread exits, so short-lived worker threads
+    (e.g. of a `ThreadPoolExecutor`) do not keep theirs open until `close`.
+    """
+
+    def __init__(self, db_path, read_only=True, mmap_size=DEFAULT_MMAP_SIZE, cache_size_kb=DEFAULT_CACHE_SIZE_KB):
+        self.path = db_path
+        self.read_only = read_only
+        self.mmap_size = mmap_size
+        self.cache_size_kb = cache_size_kb
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._pid = os.getpid()
+
+    def _connect(self):
+        if self.read_only:
+            uri = Path(self.path).absolute().as_uri() + "?mode=ro"
+            connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        # Negative values are read as KiB rather than as a number of pages
+        connection.execute(f"PRAGMA cache_size = -{int(self.cache_size_kb)}")
+        return connection
+
+    def connection(self):
+        """Return the calling thread's connection, opening it on first use."""
+        if self._pid != os.getpid():
+            # Connections inherited through fork must never be used by the child
+            self._local = threading.local()
+            self._connections = []
+            self._pid = os.getpid()
+
+        holder = getattr(self._local, "holder", None)
+        if holder is None:
+            holder = _ThreadConnection(self._connect())
+            self._local.holder = holder
+            with self._lock:
+                self._connections.append(holder.connection)
+            # Runs once the thread-local is cleared on thread exit. Does not reference the pool, which
+            # must stay collectable while the main thread's connection is alive
+            weakref.finalize(holder, _release, self._lock, self._connections, holder.connection, self._pid)
+        return holder.connection
+
+    def close(self):
+        """Close every connection opened by this process."""
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+        self._local = threading.local()
@@ -0,0 +1,176 @@
+"""Precomputed Feverous elements, one indexed row per element.
+
+The store also has an `element_meta` table with the fingerprint of the DB it was built from
+(see `fingerprint`), so that it is not used after the DB was patched.
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+from pathlib import Path
+
+from .connection_pool import ConnectionPool
+from .feverous_db import FeverousDB
+from .fingerprint import HASH_SIZE, hash_data, get_file_fingerprint, update_content_hash, matches_source
+from ..utils import split_element_id, get_element_text, format_element
+from ..utils.wiki_page import WikiPage, WikiTitle
+
+# Two parameters per (page_id, element_id) pair, see MAX_QUERY_PARAMS in feverous_db
+MAX_QUERY_PAIRS = 450
+
+ELEMENT_TYPE_PATTERN = re.compile(r"(_\d+)+$")
+
+
+def get_element_type(element_id):
+    """`cell_0_1_2` -> `cell`, `table_caption_0` -> `table_caption`, `title` -> `title`."""
+    return ELEMENT_TYPE_PATTERN.sub("", element_id)
+
+
+def get_context_id(element):
+    # The page title is `_title` in WikiPage but `<page>_title` in annotations
+    return "title" if isinstance(element, WikiTitle) else element.get_id()
+
+
+def iter_element_rows(wiki_page):
+    """Yield an (element_id, type, text, context_ids) row for every element of `wiki_page`."""
+    element_ids = ["title"] + wiki_page.page_order
+    for item in wiki_page.get_page():
+        element_ids.extend(item.get_ids())
+
+    for element_id in dict.fromkeys(element_ids):
+        try:
+            text = get_element_text(wiki_page, element_id)
+            context_ids = [get_context_id(element) for element in wiki_page.get_context(element_id)]
+        except Exception:
+            continue
+        yield element_id, get_element_type(element_id), text, json.dumps(context_ids)
+
+
+def build_element_store(document_path, output_path, batch_size=1000, progress=None):
+    """Write the `elements` table of every page of the Feverous DB at `document_path` to `output_path`.
+
+    `output_path` may be `document_path` itself, in which case the table is added next to `wiki`.
+    Such a store has no file fingerprint (writing it changes the file), so checking it always
+    recomputes the content hash.
+    """
+    in_place = os.path.abspath(output_path) == os.path.abspath(document_path)
+    fingerprint = {} if in_place else get_file_fingerprint(document_path)
+    connection = sqlite3.connect(output_path)
+    connection.execute("DROP TABLE IF EXISTS elements")
+    connection.execute("DROP TABLE IF EXISTS element_meta")
+    connection.execute(
+        "CREATE TABLE elements (page_id TEXT, element_id TEXT, type TEXT, text TEXT, context_ids TEXT, "
+        "PRIMARY KEY (page_id, element_id)) WITHOUT ROWID"
+    )
+    connection.execute("CREATE TABLE element_meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    db = FeverousDB(document_path, read_only=True)
+    content_hash = hashlib.blake2b(digest_size=HASH_SIZE)
+    rows, num_pages = [], 0
+    # Every row is hashed, empty pages included, like `get_content_hash`
+    for _, page_id, data in db.iter_docs(batch_size):
+        update_content_hash(content_hash, page_id, hash_data(data))
+        if not data or not data.strip():
+            continue
+        wiki_page = WikiPage(page_id, json.loads(data))
+        rows.extend((page_id,) + row for row in iter_element_rows(wiki_page))
+        num_pages += 1
+        if num_pages % batch_size == 0:
+            connection.executemany("INSERT INTO elements VALUES (?, ?, ?, ?, ?)", rows)
+            connection.commit()
+            rows.clear()
+            if progress:
+                progress(batch_size)
+    connection.executemany("INSERT INTO elements VALUES (?, ?, ?, ?, ?)", rows)
+    meta = {"document_path": document_path, "content_hash": content_hash.hexdigest(), **fingerprint}
+    connection.execute("INSERT INTO element_meta VALUES ('meta', ?)", (json.dumps(meta),))
+    connection.commit()
+    if progress:
+        progress(num_pages % batch_size)
+
+    connection.close()
+    db.close()
+
+
+class ElementStore(object):
+    """Lookups into an `elements` table written by `build_element_store`.
+
+    Elements are addressed by their full Feverous id (`Page_cell_0_1_2`). `render` returns the
+    same string as `render_element` on the parsed page, without loading or parsing the page.
+    """
+
+    def __init__(self, db_path, **pool_kwargs):
+        self.path = db_path
+        self.pool = ConnectionPool(db_path, read_only=True, **pool_kwargs)
+        try:
+            rows = self.pool.connection().execute("SELECT value FROM element_meta WHERE key = 'meta'").fetchall()
+        except sqlite3.OperationalError:
+            # Written before the fingerprint was recorded
+            rows = []
+        self.meta = json.loads(rows[0][0]) if rows else None
+
+    def check(self, document_path):
+        """Raise a `ValueError` unless the store was built from the current content of `document_path`."""
+        if self.meta is None:
+            raise ValueError(f"{self.path} has no fingerprint of {document_path}, rebuild it with build_element_store")
+        if not matches_source(self.meta, document_path):
+            raise ValueError(
+                f"{self.path} was built from another version of {document_path}, rebuild it with build_element_store"
+            )
+
+    @staticmethod
+    def has_elements(db_path):
+        """Whether `db_path` has an `elements` table. The DB is opened read-only, so a wrong path is never created."""
+        if not os.path.isfile(db_path):
+            return False
+        connection = sqlite3.connect(Path(db_path).absolute().as_uri() + "?mode=ro", uri=True)
+        try:
+            return connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'elements'"
+            ).fetchone() is not None
+        finally:
+            connection.close()
+
+    def get_rows(self, full_ids):
+        """(type, text, context_ids) of every id of `full_ids`, in the same order (None if missing)."""
+        pairs = list(dict.fromkeys(split_element_id(full_id) for full_id in full_ids))
+        rows = {}
+        cursor = self.pool.connection().cursor()
+        for start in range(0, len(pairs), MAX_QUERY_PAIRS):
+            chunk = pairs[start:start + MAX_QUERY_PAIRS]
+            cursor.execute(
+                "SELECT page_id, element_id, type, text, context_ids FROM elements "
+                f"WHERE (page_id, element_id) IN (VALUES {', '.join(['(?, ?)'] * len(chunk))})",
+                [value for pair in chunk for value in pair],
+            )
+            for page_id, element_id, element_type, text, context_ids in cursor.fetchall():
+                rows[(page_id, element_id)] = (element_type, text, json.loads(context_ids))
+        cursor.close()
+        return [rows.get(split_element_id(full_id)) for full_id in full_ids]
+
+    def get_text(self, full_id):
+        row = self.get_rows([full_id])[0]
+        return row[1] if row else None
+
+    def get_context_ids(self, full_id):
+        """Full ids of the context elements of `full_id`, as given by `WikiPage.get_context`."""
+        row = self.get_rows([full_id])[0]
+        if row is None:
+            return None
+        page_id = split_element_id(full_id)[0]
+        return [f"{page_id}_{context_id}" for context_id in row[2]]
+
+    def render_many(self, full_ids):
+        """`render_element` output for every id of `full_ids`, in the same order (None if missing)."""
+        return [
+            format_element(split_element_id(full_id)[1], row[1]) if row else None
+            for full_id, row in zip(full_ids, self.get_rows(full_ids))
+        ]
+
+    def render(self, full_id):
+        return self.render_many([full_id])[0]
+
+    def close(self):
+        self.pool.close()
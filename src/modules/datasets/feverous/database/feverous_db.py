@@ -6,19 +6,38 @@
 # LICENSE file in the root directory of this source tree.
 """Documents, in a sqlite database."""
 
+import asyncio
 import json
-import sqlite3
+
+from .compression import PageCodec, is_compressed
+from .connection_pool import ConnectionPool
+
+# Stay below SQLITE_MAX_VARIABLE_NUMBER of older sqlite builds (999)
+MAX_QUERY_PARAMS = 900
+DEFAULT_SCAN_BATCH_SIZE = 1000
 
 
 class FeverousDB(object):
     """Sqlite backed document storage.
 
     Implements get_doc_text(doc_id).
+
+    `connection` is the calling thread's own connection (see `ConnectionPool`), so one instance
+    can be shared by threads and forked workers. With `read_only=True` connections are opened in
+    read-only URI mode.
+
+    DBs written by `compress_db` are detected and decompressed transparently. Code reading the
+    `data` column itself should go through `decode_data` / `parse_doc`.
     """
 
-    def __init__(self, db_path):
+    def __init__(self, db_path, read_only=False, **pool_kwargs):
         self.path = db_path
-        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.pool = ConnectionPool(db_path, read_only=read_only, **pool_kwargs)
+        self.codec = PageCodec.from_connection(self.connection) if is_compressed(self.connection) else None
+
+    @property
+    def connection(self):
+        return self.pool.connection()
 
     def __enter__(self):
         return self
@@ -31,8 +50,8 @@ class FeverousDB(object):
         return self.path
 
     def close(self):
-        """Close the connection to the database."""
-        self.connection.close()
+        """Close every connection to the database opened by this process."""
+        self.pool.close()
 
     def get_doc_ids(self):
         """Fetch all ids of docs stored in the db."""
@@ -52,7 +71,125 @@ class FeverousDB(object):
         )
         result = cursor.fetchone()
         cursor.close()
-        return result if result is None else json.loads(result[0])
+        return result if result is None else json.loads(self.decode_data(result[0]))
+
+    def get_rowids(self, doc_ids):
+        """Map every id of 'doc_ids' found in the db to its rowid, reading only the id index."""
+        unique_ids = list(dict.fromkeys(doc_ids))
+        rowids = {}
+        cursor = self.connection.cursor()
+        for start in range(0, len(unique_ids), MAX_QUERY_PARAMS):
+            chunk = unique_ids[start:start + MAX_QUERY_PARAMS]
+            cursor.execute(
+                f"SELECT id, rowid FROM wiki WHERE id IN ({', '.join('?' * len(chunk))})",
+                chunk,
+            )
+            rowids.update(cursor.fetchall())
+        cursor.close()
+        return rowids
+
+    def get_docs_data(self, doc_ids, rowid_sorted=False):
+        """Fetch the raw json text of every id of 'doc_ids' in a few queries, in the same order (None if missing).
+
+        With `rowid_sorted=True` the ids are first resolved to rowids and the docs are read in
+        rowid (file) order, which turns a large scattered read into a mostly sequential one.
+        """
+        unique_ids = list(dict.fromkeys(doc_ids))
+        if rowid_sorted:
+            keys, column = sorted(self.get_rowids(unique_ids).values()), "rowid"
+        else:
+            keys, column = unique_ids, "id"
+        docs = {}
+        cursor = self.connection.cursor()
+        for start in range(0, len(keys), MAX_QUERY_PARAMS):
+            chunk = keys[start:start + MAX_QUERY_PARAMS]
+            cursor.execute(
+                f"SELECT id, data FROM wiki WHERE {column} IN ({', '.join('?' * len(chunk))})",
+                chunk,
+            )
+            docs.update(cursor.fetchall())
+        cursor.close()
+        return [self.decode_data(docs.get(doc_id)) for doc_id in doc_ids]
+
+    def decode_data(self, data):
+        """Raw json text of a `data` value, decompressing it if needed."""
+        if isinstance(data, bytes):
+            return self.codec.decompress(data)
+        return data
+
+    def parse_doc(self, data):
+        """Parse a `data` value, None for missing or empty docs."""
+        data = self.decode_data(data)
+        return json.loads(data) if data and data.strip() else None
+
+    def get_docs_json(self, doc_ids):
+        """Fetch the docs for every id of 'doc_ids' in a few queries, in the same order (None if missing or empty)."""
+        return [self.parse_doc(data) for data in self.get_docs_data(doc_ids)]
+
+    async def aget_doc_json(self, doc_id):
+        """`get_doc_json` on a worker thread (which gets its own connection)."""
+        return await asyncio.to_thread(self.get_doc_json, doc_id)
+
+    async def aget_docs_json(self, doc_ids):
+        """`get_docs_json` on a worker thread (which gets its own connection)."""
+        return await asyncio.to_thread(self.get_docs_json, doc_ids)
+
+    def _scan(self, columns, batch_size, start_rowid, end_rowid, non_empty):
+        """Yield (rowid, *columns) rows in rowid order, `batch_size` at a time with keyset pagination."""
+        if start_rowid is None:
+            start_rowid = self.get_rowid_range()[0] or 0
+        if end_rowid is None:
+            end_rowid = (1 << 63) - 1
+        non_empty_filter = "AND length(trim(data)) > 0 " if non_empty else ""
+        last_rowid = start_rowid - 1
+        while True:
+            cursor = self.connection.execute(
+                f"SELECT rowid, {columns} FROM wiki WHERE rowid > ? AND rowid < ? {non_empty_filter}"
+                "ORDER BY rowid LIMIT ?",
+                (last_rowid, end_rowid, batch_size),
+            )
+            rows = cursor.fetchall()
+            cursor.close()
+            if not rows:
+                return
+            yield from rows
+            last_rowid = rows[-1][0]
+
+    def iter_docs(self, batch_size=DEFAULT_SCAN_BATCH_SIZE, start_rowid=None, end_rowid=None, non_empty=False):
+        """Stream (rowid, id, raw json text) in rowid order, i.e. in file order.
+
+        Only `batch_size` rows are in memory at a time and no cursor is held open between batches.
+        `start_rowid` (inclusive) and `end_rowid` (exclusive) restrict the scan to a range, see
+        `get_rowid_partitions`.
+        """
+        for rowid, doc_id, data in self._scan("id, data", batch_size, start_rowid, end_rowid, non_empty):
+            yield rowid, doc_id, self.decode_data(data)
+
+    def iter_docs_json(self, batch_size=DEFAULT_SCAN_BATCH_SIZE, start_rowid=None, end_rowid=None):
+        """Stream (id, doc) of every non-empty doc in rowid order, see `iter_docs`."""
+        for _, doc_id, data in self.iter_docs(batch_size, start_rowid, end_rowid, non_empty=True):
+            yield doc_id, json.loads(data)
+
+    def iter_doc_ids(self, batch_size=DEFAULT_SCAN_BATCH_SIZE, start_rowid=None, end_rowid=None, non_empty=False):
+        """Stream doc ids in rowid order without reading the docs."""
+        for _, doc_id in self._scan("id", batch_size, start_rowid, end_rowid, non_empty):
+            yield doc_id
+
+    def get_rowid_partitions(self, num_partitions):
+        """Cut the rowid range into `num_partitions` contiguous (start, end) ranges, end exclusive."""
+        min_rowid, max_rowid = self.get_rowid_range()
+        if min_rowid is None:
+            return []
+        bounds = [min_rowid + (max_rowid + 1 - min_rowid) * i // num_partitions for i in range(num_partitions + 1)]
+        return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+    def get_rowid_range(self):
+        """Return the (min, max) rowid of the wiki table."""
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT MIN(rowid), MAX(rowid) FROM wiki")
+        result = cursor.fetchone()
+        cursor.close()
+        return result
 
     def get_non_empty_doc_ids(self):
         """Fetch all ids of docs stored in the db."""
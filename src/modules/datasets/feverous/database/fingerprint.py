@@ -0,0 +1,51 @@
+"""Fingerprints of a Feverous DB, so that files derived from it can tell when they are stale.
+
+A derived file records the size and mtime of the DB file and a content hash of its pages. The size
+and mtime are compared first; the content hash is only recomputed (a full scan of the DB, without
+parsing) when they differ, e.g. for a copy of the DB.
+"""
+import hashlib
+import logging
+import os
+from typing import Optional
+
+from .feverous_db import FeverousDB, DEFAULT_SCAN_BATCH_SIZE
+
+HASH_SIZE = 16
+FINGERPRINT_KEYS = ("source_size", "source_mtime_ns")
+
+
+def hash_data(data: Optional[str]) -> bytes:
+    return hashlib.blake2b((data or "").encode("utf-8"), digest_size=HASH_SIZE).digest()
+
+
+def get_file_fingerprint(path: str) -> dict:
+    stat = os.stat(path)
+    return {"source_size": stat.st_size, "source_mtime_ns": stat.st_mtime_ns}
+
+
+def update_content_hash(content_hash, page_id: str, data_hash: bytes):
+    content_hash.update(page_id.encode("utf-8") + b"\0" + data_hash)
+
+
+def get_content_hash(document_path: str, batch_size: int = DEFAULT_SCAN_BATCH_SIZE) -> str:
+    """Hash of the (id, json) of every page of the Feverous DB at `document_path`, in rowid order.
+
+    Computed on the decoded json, so it does not change when the DB is (re)compressed.
+    """
+    content_hash = hashlib.blake2b(digest_size=HASH_SIZE)
+    db = FeverousDB(document_path, read_only=True)
+    for _, page_id, data in db.iter_docs(batch_size):
+        update_content_hash(content_hash, page_id, hash_data(data))
+    db.close()
+    return content_hash.hexdigest()
+
+
+def matches_source(meta: dict, document_path: str) -> bool:
+    """Whether `meta` (a `content_hash` and optionally a file fingerprint) describes the current `document_path`."""
+    if all(key in meta for key in FINGERPRINT_KEYS) and get_file_fingerprint(document_path) == {
+        key: meta[key] for key in FINGERPRINT_KEYS
+    }:
+        return True
+    logging.info("%s changed since it was fingerprinted, comparing content hashes", document_path)
+    return get_content_hash(document_path) == meta["content_hash"]
@@ -0,0 +1,151 @@
+"""Read-through cache of parsed `WikiPage` objects."""
+
+import itertools
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .feverous_db import FeverousDB
+from ..utils.wiki_page import WikiPage
+
+DEFAULT_MAX_ENTRIES = 4096
+DEFAULT_MAX_BYTES = 512 * 1024 ** 2
+DEFAULT_PREFETCH_WINDOW = 64
+
+_SHARED = {}
+_SHARED_LOCK = threading.Lock()
+
+
+class WikiPageCache(object):
+    """LRU of parsed pages keyed by page id, reading misses from a `FeverousDB`.
+
+    The cache holds at most `max_entries` pages and about `max_bytes` bytes, where the size of a
+    page is approximated by the size of its json in the DB. Missing or empty pages are cached as
+    `None`. Cached pages are shared, so callers must not modify them.
+
+    Pages are lazy (see `WikiPage`) unless `lazy=False`: rendering a few elements of a page only
+    builds those elements, while `str(page)` builds it whole as before.
+    """
+
+    def __init__(self, db, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES, lazy=True):
+        self.db = db
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lazy = lazy
+        self._pages = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    @classmethod
+    def shared(cls, db_path, **kwargs):
+        """Process-wide cache for the DB at `db_path`, so that every reader of a DB uses the same pages."""
+        key = os.path.abspath(db_path)
+        with _SHARED_LOCK:
+            if key not in _SHARED:
+                _SHARED[key] = cls(FeverousDB(db_path, read_only=True), **kwargs)
+            return _SHARED[key]
+
+    @property
+    def hit_rate(self):
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
+
+    @property
+    def num_bytes(self):
+        return self._bytes
+
+    def __len__(self):
+        return len(self._pages)
+
+    def __contains__(self, page_id):
+        return page_id in self._pages
+
+    def _put(self, page_id, wiki_page, size):
+        if page_id in self._pages:
+            return
+        self._pages[page_id] = (wiki_page, size)
+        self._bytes += size
+        while len(self._pages) > self.max_entries or (self._bytes > self.max_bytes and len(self._pages) > 1):
+            _, (_, evicted_size) = self._pages.popitem(last=False)
+            self._bytes -= evicted_size
+            self.stats["evictions"] += 1
+
+    def get_pages(self, page_ids):
+        """Parsed pages for every id of `page_ids`, in order, reading all misses in one bulk query."""
+        pages = {}
+        with self._lock:
+            for page_id in page_ids:
+                if page_id in pages:
+                    continue
+                if page_id in self._pages:
+                    self._pages.move_to_end(page_id)
+                    pages[page_id] = self._pages[page_id][0]
+                    self.stats["hits"] += 1
+        missing = [page_id for page_id in dict.fromkeys(page_ids) if page_id not in pages]
+
+        if missing:
+            with self._lock:
+                self.stats["misses"] += len(missing)
+            pages.update(self._load(missing))
+
+        return [pages[page_id] for page_id in page_ids]
+
+    def _load(self, page_ids, rowid_sorted=False):
+        loaded = []
+        for page_id, data in zip(page_ids, self.db.get_docs_data(page_ids, rowid_sorted)):
+            page_json = self.db.parse_doc(data)
+            wiki_page = WikiPage(page_id, page_json, lazy=self.lazy) if page_json else None
+            loaded.append((page_id, wiki_page, len(data) if data else 0))
+        with self._lock:
+            for page_id, wiki_page, size in loaded:
+                self._put(page_id, wiki_page, size)
+        return {page_id: wiki_page for page_id, wiki_page, _ in loaded}
+
+    def prefetch(self, page_ids):
+        """Load the pages of `page_ids` that are not cached yet in one rowid-sorted read.
+
+        Prefetched pages are not counted as misses, their first `get_pages` is a hit. Returns the
+        number of pages read.
+        """
+        with self._lock:
+            missing = [page_id for page_id in dict.fromkeys(page_ids) if page_id not in self._pages]
+        if missing:
+            self._load(missing, rowid_sorted=True)
+        return len(missing)
+
+    def get_page(self, page_id):
+        """Parsed page for `page_id`, or None if it is missing from the DB."""
+        return self.get_pages([page_id])[0]
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+            self._bytes = 0
+
+
+def iter_prefetched(cache, items, get_page_ids, window=DEFAULT_PREFETCH_WINDOW):
+    """Yield `items` while `cache` prefetches the pages of the next `window` items on a background thread.
+
+    `get_page_ids(item)` lists the pages an item will read. The pages of a window are loaded
+    before its first item is yielded, and the next window is read while the caller processes
+    the current one. `window` times the pages per item should fit in the cache.
+    """
+    iterator = iter(items)
+
+    def next_window():
+        batch = list(itertools.islice(iterator, window))
+        page_ids = [page_id for item in batch for page_id in get_page_ids(item)]
+        return batch, page_ids
+
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="page-prefetch") as executor:
+        batch, page_ids = next_window()
+        future = executor.submit(cache.prefetch, page_ids)
+        while batch:
+            upcoming, upcoming_ids = next_window()
+            future.result()
+            if upcoming:
+                future = executor.submit(cache.prefetch, upcoming_ids)
+            yield from batch
+            batch = upcoming
@@ -0,0 +1,89 @@
+"""Small Feverous DBs holding only the pages a dataset refers to, for development and CI runs."""
+
+import os
+import sqlite3
+
+from ..utils import split_element_id
+
+# Tables copied along with `wiki`, keyed by their page id column
+PAGE_TABLES = {"wiki": "id", "wiki_meta": None, "elements": "page_id"}
+
+
+def get_annotation_page_ids(annotation):
+    """Ids of every page referred to by the evidence and the context of `annotation`."""
+    if not hasattr(annotation, "flat_evidence"):
+        return []
+    element_ids = list(annotation.get_evidence(flat=True))
+    for evidence_id, contexts in annotation.get_context(flat=True).items():
+        element_ids.append(evidence_id)
+        element_ids.extend(contexts)
+    return list(dict.fromkeys(split_element_id(element_id)[0] for element_id in element_ids))
+
+
+def get_retrieved_page_ids(retriever, claim):
+    """Ids of the pages `retriever` returns for `claim`, element-level results included."""
+    return list(dict.fromkeys(
+        node.node.metadata.get("page_id", node.node.node_id) for node in retriever.retrieve(claim)
+    ))
+
+
+def collect_page_ids(annotations, retriever=None, progress=None):
+    """Ids of the pages needed to evaluate `annotations` (an `AnnotationProcessor`), in first-seen order.
+
+    With a `retriever`, the pages it retrieves for every claim are added, so that retrieval runs
+    on the subset see the same candidates as on the full DB.
+    """
+    page_ids = {}
+    for annotation in annotations:
+        page_ids.update(dict.fromkeys(get_annotation_page_ids(annotation)))
+        if retriever is not None:
+            page_ids.update(dict.fromkeys(get_retrieved_page_ids(retriever, annotation.get_claim())))
+        if progress:
+            progress(1)
+    return list(page_ids)
+
+
+def extract_subset(document_path, output_path, page_ids):
+    """Copy the pages `page_ids` of the Feverous DB at `document_path` to a new DB at `output_path`.
+
+    The subset has the same schema and keeps the rowids of the pages, so it is a drop-in
+    replacement for the full DB. The compression settings (`wiki_meta`) and the rows of an
+    `elements` table of the copied pages are carried over when the source has them. Returns the
+    number of pages copied.
+    """
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    connection = sqlite3.connect(output_path)
+    connection.execute("ATTACH DATABASE ? AS source", (document_path,))
+
+    connection.execute("CREATE TEMP TABLE subset_ids (id TEXT PRIMARY KEY)")
+    connection.executemany("INSERT OR IGNORE INTO subset_ids VALUES (?)", [(page_id,) for page_id in page_ids])
+
+    schemas = dict(connection.execute(
+        "SELECT name, sql FROM source.sqlite_master WHERE type = 'table' AND name IN "
+        f"({', '.join('?' * len(PAGE_TABLES))})", list(PAGE_TABLES)
+    ).fetchall())
+    for table, key in PAGE_TABLES.items():
+        if table not in schemas:
+            continue
+        connection.execute(schemas[table])
+        if key is None:
+            connection.execute(f"INSERT INTO main.{table} SELECT * FROM source.{table}")
+        elif table == "wiki":
+            # Rowid order, so that the subset is laid out like the full DB
+            connection.execute(
+                "INSERT INTO main.wiki (rowid, id, data) SELECT rowid, id, data FROM source.wiki "
+                "WHERE id IN (SELECT id FROM subset_ids) ORDER BY rowid"
+            )
+        else:
+            connection.execute(
+                f"INSERT INTO main.{table} SELECT * FROM source.{table} "
+                f"WHERE {key} IN (SELECT id FROM subset_ids)"
+            )
+    connection.commit()
+
+    num_pages = connection.execute("SELECT COUNT(*) FROM main.wiki").fetchone()[0]
+    connection.execute("DETACH DATABASE source")
+    connection.execute("VACUUM")
+    connection.close()
+    return num_pages
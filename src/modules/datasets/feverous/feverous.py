@@ -2,103 +2,150 @@ from collections import defaultdict
 from typing import Optional
 
 from .utils.annotation_processor import AnnotationProcessor
-from .utils.wiki_page import WikiPage
 from .database.feverous_db import FeverousDB
+from .database.page_cache import WikiPageCache, iter_prefetched, DEFAULT_PREFETCH_WINDOW
+from .database.element_store import ElementStore
+from .database.subset import get_annotation_page_ids
 from ..base import Dataset
-from .utils import normalize_feverous_label
+from .utils import normalize_feverous_label, split_element_id, render_element
 
 class Feverous(Dataset):
     def __init__(self,
                  annotations: AnnotationProcessor,
                  wiki_db: Optional[FeverousDB] = None,
+                 page_cache: Optional[WikiPageCache] = None,
+                 element_store: Optional[ElementStore] = None,
+                 prefetch_window: int = DEFAULT_PREFETCH_WINDOW,
                  **kwargs):
+        """
+        `prefetch_window` annotations ahead of the one being rendered have their pages read into the
+        page cache on a background thread (0 to disable). Not used with an element store, which
+        answers without pages.
+        """
         super().__init__(**kwargs)
         self.annotations = annotations
         self.wiki_db = wiki_db
+        if page_cache is None and wiki_db is not None:
+            page_cache = WikiPageCache.shared(wiki_db.path)
+        self.page_cache = page_cache
+        self.element_store = element_store
+        self.prefetch_window = prefetch_window
 
     @classmethod
-    def from_path(cls, dataset_path: str, db_path: Optional[str] = None):
+    def from_path(cls, dataset_path: str, db_path: Optional[str] = None, element_store_path: Optional[str] = None):
+        """
+        `element_store_path` is a DB written by `build_element_store`. It defaults to `db_path`
+        when the `elements` table was added to the Feverous DB itself. It must have been built from
+        the current content of `db_path`.
+        """
         anno_processor = AnnotationProcessor(dataset_path)
 
         wiki_db = None
         if db_path:
             wiki_db = FeverousDB(db_path)
 
-        return cls(anno_processor, wiki_db, claims=None)
+        if element_store_path is None and db_path and ElementStore.has_elements(db_path):
+            element_store_path = db_path
+        element_store = None
+        if element_store_path:
+            element_store = ElementStore(element_store_path)
+            if db_path:
+                # Stale elements would be served silently after the DB was patched
+                element_store.check(db_path)
+
+        return cls(anno_processor, wiki_db, element_store=element_store, claims=None)
+
+    def __len__(self):
+        return len(self.annotations)
 
     def __getitem__(self, item):
-        raise NotImplementedError
+        """
+        Sample of the annotation at position `item` (after the header line), or list of samples for a
+        slice. Annotations are read through the offset index of `AnnotationProcessor`, so any
+        position or range is reached without reading the preceding ones.
+        """
+        if isinstance(item, slice):
+            annotations = self.annotations[item]
+            if self.prefetches:
+                self.page_cache.prefetch(
+                    [page_id for annotation in annotations for page_id in get_annotation_page_ids(annotation)]
+                )
+            return [self.render_annotation(annotation) for annotation in annotations]
+        return self.render_annotation(self.annotations[item])
+
+    def render_elements(self, element_ids: list[str]) -> dict[str, str]:
+        """
+        Rendered content of every element id. Elements are looked up in the element store when there is
+        one; the others are rendered from their parsed pages, each page being read and parsed once.
+        """
+        contents = {}
+        if self.element_store is not None:
+            for element_id, content in zip(element_ids, self.element_store.render_many(element_ids)):
+                if content is not None:
+                    contents[element_id] = content
+
+        missing = [element_id for element_id in dict.fromkeys(element_ids) if element_id not in contents]
+        if missing:
+            page_ids = list(dict.fromkeys(split_element_id(element_id)[0] for element_id in missing))
+            wiki_pages = dict(zip(page_ids, self.page_cache.get_pages(page_ids)))
+            for element_id in missing:
+                page_id, in_page_id = split_element_id(element_id)
+                contents[element_id] = render_element(wiki_pages[page_id], in_page_id)
+        return contents
+
+    @property
+    def prefetches(self):
+        """Whether rendering reads pages from the page cache, which are then worth prefetching."""
+        return bool(self.prefetch_window) and self.element_store is None and self.page_cache is not None
+
+    def iter_annotations(self):
+        """The annotations, with their pages prefetched when rendering reads them from the page cache."""
+        if self.prefetches:
+            return iter_prefetched(self.page_cache, self.annotations, get_annotation_page_ids, self.prefetch_window)
+        return iter(self.annotations)
+
+    def render_annotation(self, annotation):
+        claim = annotation.get_claim()
+
+        try:
+            challenge = annotation.get_challenge()
+            label = normalize_feverous_label(annotation.get_verdict())
+            context_dicts = annotation.get_context(flat=True)
+            evidences = annotation.get_evidence(flat=True)
+
+            # Render every element the annotation refers to in one pass
+            contents = self.render_elements(
+                evidences + [context for contexts in context_dicts.values() for context in contexts]
+            )
+
+            evidence_str = ""
+            context_str = ""
+            # Process evidence + context
+            for i, evidence in enumerate(evidences):
+                content = contents[evidence]
+                evidence_str += f"- Evidence {i+1}: {content}\n"
+
+            for i, (evidence_context, contexts) in enumerate(context_dicts.items()):
+                for j, context in enumerate(contexts):
+                    content = contents[context]
+                    context_str += f"- Context {i+1}_{j+1}: {content}\n"
+
+            context = context_str
+            evidence = evidence_str
+
+        except:
+            challenge = None
+            label = None
+            context = None
+            evidence = None
+
+        return {
+            "context": context,
+            "claim": claim,
+            "evidence": evidence,
+            "label": label
+        }
 
     def __iter__(self):
-        for annotation in self.annotations:
-            claim = annotation.get_claim()
-
-            try:
-                challenge = annotation.get_challenge()
-                label = normalize_feverous_label(annotation.get_verdict())
-                context_dicts = annotation.get_context(flat=True)
-                evidences = annotation.get_evidence(flat=True)
-
-                evidence_str = ""
-                context_str = ""
-                # Process evidence + context
-                for i, evidence in enumerate(evidences):
-                    wiki_doc = evidence.split('_')[0]
-                    evidence_id = '_'.join(evidence.split('_')[1:])
-
-                    page_json = self.wiki_db.get_doc_json(wiki_doc)
-                    wiki_page = WikiPage(wiki_doc, page_json)
-
-                    # sentence: handled implicitly via get_element_by_id (sentence in page_items)
-                    # title: explicit handling needed (title not in page_items)
-                    # cell/header_cell, item, table_caption: need specialized getters
-                    content = wiki_page.get_element_by_id(evidence_id)
-                    if "title" in evidence_id:
-                        content = "Title: " + wiki_page.get_title_content()
-                    elif "cell" in evidence_id:
-                        content = "Cell: " + wiki_page.get_cell_content(evidence_id)
-                    elif "item" in evidence_id:
-                        content = "Item: " + wiki_page.get_item_by_id(evidence_id)
-                    elif "table_caption" in evidence_id:
-                        content = "Table caption: " + str(
-                            wiki_page.get_caption_content(evidence_id) or ""
-                        )
-                    evidence_str += f"- Evidence {i+1}: {str(content)}\n"
-
-                for i, (evidence_context, contexts) in enumerate(context_dicts.items()):
-                    for j, context in enumerate(contexts):
-                        wiki_doc = context.split('_')[0]
-                        context_id = '_'.join(context.split('_')[1:])
-
-                        page_json = self.wiki_db.get_doc_json(wiki_doc)
-                        wiki_page = WikiPage(wiki_doc, page_json)
-
-                        # Same evidence-type handling as above (sentence implicit, title/cell/item/table_caption explicit)
-                        content = wiki_page.get_element_by_id(context_id)
-                        if "title" in context_id:
-                            content = "Title: " + wiki_page.get_title_content()
-                        elif "cell" in context_id:
-                            content = "Cell: " + wiki_page.get_cell_content(context_id)
-                        elif "item" in context_id:
-                            content = "Item: " + wiki_page.get_item_by_id(context_id)
-                        elif "table_caption" in context_id:
-                            content = "Table caption: " + str(
-                                wiki_page.get_caption_content(context_id) or ""
-                            )
-                        context_str += f"- Context {i+1}_{j+1}: {str(content)}\n"
-
-                context = context_str
-                evidence = evidence_str
-
-            except:
-                challenge = None
-                label = None
-                context = None
-                evidence = None
-
-            yield {
-                "context": context,
-                "claim": claim,
-                "evidence": evidence,
-                "label": label
-            }
+        for annotation in self.iter_annotations():
+            yield self.render_annotation(annotation)
@@ -1 +1,7 @@
-from .feveous_utils import normalize_feverous_label
\ No newline at end of file
+from .feveous_utils import (
+    normalize_feverous_label,
+    split_element_id,
+    get_element_text,
+    format_element,
+    render_element
+)
@@ -2,6 +2,7 @@
 Simple Annotation Wrapper that converts each annotation into an object with corresponding attributes.
 """
 import itertools
+import json
 import os
 import sys
 import traceback
@@ -9,11 +10,69 @@ from enum import Enum
 from typing import Any, Dict, List
 
 import jsonlines
+import numpy as np
+
+# Sidecar of an annotation file holding the byte offset of every line
+OFFSETS_SUFFIX = ".offsets.npz"
+READ_CHUNK_SIZE = 1 << 24
+
+
+def build_line_offsets(input_path: str) -> np.ndarray:
+    """
+    Byte offsets of the start of every line of `input_path`, followed by the file size, so that
+    line i spans offsets[i]:offsets[i + 1].
+    """
+    ends = [np.zeros(1, dtype=np.int64)]
+    position = 0
+    with open(input_path, "rb") as f:
+        while chunk := f.read(READ_CHUNK_SIZE):
+            ends.append(np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord("\n")) + position + 1)
+            position += len(chunk)
+    offsets = np.concatenate(ends)
+    if offsets[-1] != position:  # Last line without a trailing newline
+        offsets = np.append(offsets, position)
+    return offsets
+
+
+def load_line_offsets(input_path: str) -> np.ndarray:
+    """
+    `build_line_offsets` of `input_path`, cached in `<input_path>.offsets.npz`. The cache is rebuilt
+    when the size or the modification time of the file changed or when it cannot be read, and only
+    kept in memory when it cannot be written next to the file.
+    """
+    index_path = input_path + OFFSETS_SUFFIX
+    stat = os.stat(input_path)
+    if os.path.exists(index_path):
+        try:
+            with np.load(index_path) as index:
+                if index["size"] == stat.st_size and index["mtime_ns"] == stat.st_mtime_ns:
+                    return index["offsets"]
+        except Exception:
+            # Truncated or otherwise corrupt sidecar, rebuilt below
+            pass
+
+    offsets = build_line_offsets(input_path)
+    # Written under a per-process name and moved into place, so that concurrent readers never see a
+    # partial file
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            np.savez(f, offsets=offsets, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        os.replace(tmp_path, index_path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return offsets
 
 
 class AnnotationProcessor:
     """
     Iterable to process the annotation files to yield annotation objects.
+
+    Annotations can also be accessed by position (`annotations[i]`, `annotations[i:j]`, `len`) through
+    a byte-offset index of the file (see `load_line_offsets`), without reading the preceding lines.
+    Position 0 is the first annotation after the header line. Unlike iteration, which skips
+    annotations that fail to process, indexing raises for them.
     """
 
     def __init__(self, input_path: str, with_content: bool = False, limit: int = None):
@@ -26,6 +85,7 @@ class AnnotationProcessor:
         self.with_content = with_content
         self.annotations = self.process_annotations()
         self.limit = limit
+        self._offsets = None
 
     def __iter__(self):
         return self.annotations
@@ -33,6 +93,41 @@ class AnnotationProcessor:
     def __next__(self):
         return next(self.annotations)
 
+    @property
+    def offsets(self) -> np.ndarray:
+        if self._offsets is None:
+            self._offsets = load_line_offsets(self.input_path)
+        return self._offsets
+
+    def __len__(self):
+        # Like `process_annotations`, `limit` counts the header line
+        num_lines = len(self.offsets) - 1
+        if self.limit:
+            num_lines = min(num_lines, self.limit)
+        return max(num_lines - 1, 0)
+
+    def read_annotation_jsons(self, start: int, stop: int) -> List[Dict[str, Any]]:
+        """Json of the annotations at positions start..stop (excluded), read with a single seek."""
+        begin, end = int(self.offsets[start + 1]), int(self.offsets[stop + 1])
+        with open(self.input_path, "rb") as f:
+            f.seek(begin)
+            data = f.read(end - begin)
+        return [json.loads(line) for line in data.splitlines()]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return [Annotation(line, self.with_content) for line in self.read_annotation_jsons(start, max(start, stop))]
+
+        num_annotations = len(self)
+        if index < 0:
+            index += num_annotations
+        if not 0 <= index < num_annotations:
+            raise IndexError("Annotation index out of range")
+        return Annotation(self.read_annotation_jsons(index, index + 1)[0], self.with_content)
+
     def process_annotations(self):
         with jsonlines.open(self.input_path) as f:
             for i, line in enumerate(f.iter()):
@@ -16,3 +16,56 @@ def normalize_feverous_label(label: object) -> str | None:
     if norm in {"NOT ENOUGH INFO", "NOT_ENOUGH_INFO"}:
         return "NEI"
     return norm or None
+
+
+def split_element_id(element_id: str) -> tuple[str, str]:
+    """
+    Split a Feverous element id such as `Page_cell_0_1_2` into its page and in-page parts
+    """
+    page_id = element_id.split('_')[0]
+    return page_id, '_'.join(element_id.split('_')[1:])
+
+
+def get_element_text(wiki_page, element_id: str) -> str:
+    """
+    String form of the in-page element `element_id` of `wiki_page`, without the prefix added by `render_element`
+    """
+    # sentence: handled implicitly via get_element_by_id (sentence in page_items)
+    # title: explicit handling needed (title not in page_items)
+    # cell/header_cell, item, table_caption: need specialized getters
+    content = wiki_page.get_element_by_id(element_id)
+    if "title" in element_id:
+        content = wiki_page.get_title_content()
+    elif "cell" in element_id:
+        content = wiki_page.get_cell_content(element_id)
+        if content is None:
+            raise KeyError(element_id)
+    elif "item" in element_id:
+        content = wiki_page.get_item_by_id(element_id)
+        if content is None:
+            raise KeyError(element_id)
+    elif "table_caption" in element_id:
+        content = wiki_page.get_caption_content(element_id) or ""
+    return str(content)
+
+
+def format_element(element_id: str, text: str) -> str:
+    """
+    Prefix the string form of an element the way evidence and context are shown
+    """
+    if "title" in element_id:
+        return "Title: " + text
+    elif "cell" in element_id:
+        return "Cell: " + text
+    elif "item" in element_id:
+        return "Item: " + text
+    elif "table_caption" in element_id:
+        return "Table caption: " + text
+    return text
+
+
+def render_element(wiki_page, element_id: str) -> str:
+    """
+    Render the in-page element `element_id` of `wiki_page` the way evidence and context are shown
+    """
+    return format_element(element_id, get_element_text(wiki_page, element_id))
@@ -1,4 +1,10 @@
+import sys
+
+
 class WikiElement(object):
+    # Subclasses declare their own `__slots__`, pages hold many elements
+    __slots__ = ()
+
     def get_ids(self) -> list:
         """Returns list of all ids in that element"""
         pass
@@ -16,4 +22,9 @@ class WikiElement(object):
 
 
 def process_text(text: str):
-    return text.strip()
\ No newline at end of file
+    return text.strip()
+
+
+def intern_id(element_id: str):
+    """Element ids (`cell_0_1_2`, ...) repeat across pages, share one copy of each."""
+    return sys.intern(element_id)
\ No newline at end of file
@@ -1,18 +1,27 @@
-from .wiki_element import WikiElement, process_text
+from .wiki_element import WikiElement, process_text, intern_id
 
 
 class WikiList(WikiElement):
+    __slots__ = ("name", "page", "list", "type", "linearized_list_str", "list_by_level", "list_items")
+
     def __init__(self, name, list_json, page):
-        self.json = list_json
-        self.name = name
+        self.name = intern_id(name)
         self.page = page
         self.list = list_json["list"]
         self.type = list_json["type"]
-        self.linearized_list, self.list_by_level = self.compile_list()
-        self.linearized_list_str = "\n".join(self.linearized_list)
+        linearized_list, self.list_by_level = self.compile_list()
+        self.linearized_list_str = "\n".join(linearized_list)
         self.list_items = {}
         for entry in self.list:
-            self.list_items[entry["id"]] = process_text(entry["value"])
+            self.list_items[intern_id(entry["id"])] = process_text(entry["value"])
+
+    @property
+    def json(self):
+        return {"type": self.type, "list": self.list}
+
+    @property
+    def linearized_list(self):
+        return self.compile_list()[0]
 
     def compile_list(self):
         lin_list = []
@@ -70,10 +79,10 @@ class WikiList(WikiElement):
         return process_text(self.linearized_list_str)
 
     def id_repr(self):
-        return " | ".join([ele["id"] for ele in self.json])
+        return " | ".join([ele["id"] for ele in self.list])
 
     def get_ids(self):
-        return [ele["id"] for ele in self.json["list"]]
+        return [ele["id"] for ele in self.list]
 
     def get_list_by_level(self, level):
         return self.list_by_level[level]
\ No newline at end of file
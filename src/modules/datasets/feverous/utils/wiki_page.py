@@ -1,5 +1,7 @@
 import itertools
 import logging
+import re
+import threading
 
 from .wiki_element import WikiElement
 from .wiki_list import WikiList
@@ -9,6 +11,8 @@ from .wiki_table import WikiTable
 
 
 class WikiTitle(WikiElement):
+    __slots__ = ("name", "content")
+
     def __init__(self, name, content):
         self.name = name.strip()
         self.content = content.strip()
@@ -26,8 +30,22 @@ class WikiTitle(WikiElement):
         return self.content
 
 
+# Placeholder of an element that could not be built, lazy pages keep them to stay in page order
+FAILED = object()
+
+ELEMENT_INDEX_PATTERN = re.compile(r"_(\d+)")
+
+
 class WikiPage:
-    def __init__(self, title, dict, filter=None, mode=None):
+    def __init__(self, title, dict, filter=None, mode=None, lazy=False):
+        """
+        With `lazy=True` only the raw json and the order are recorded, and each element is built the
+        first time it is accessed (`get_element_by_id`, `get_cell_content`, `get_item_by_id`, ...).
+        Accessing `page_items` (hence `str`, `get_ids`, `get_page`, `get_tables`, ...) builds all
+        elements. Until then `page_order` and `error_dict` do not account for the tables and lists
+        that fail to build. Builds hold a per-page lock, so lazy pages can be shared between threads
+        (see `WikiPageCache.shared`).
+        """
         self.error_dict = {
             "tables_empty": 0,
             "tables_formatting_errors": 0,
@@ -36,8 +54,23 @@ class WikiPage:
             "list_formatting_errors": 0,
             "sentences_empty": 0,
         }
-        self.page_items = {}
         self.title = WikiTitle("_title", title)
+        self.lazy = lazy
+        self._lock = threading.RLock() if lazy else None
+        self._json = dict
+        # Element id -> element, None until built, in json order like `page_items`
+        self._items = {}
+        self._page_items = None
+        self._page_order = None
+        # Contained id -> table or list, filled as elements are built
+        self._cell_tables = {}
+        self._caption_tables = {}
+        self._item_lists = {}
+        # Derived from `page_order`: element id -> position, and per position the nearest previous section
+        # and, for sections, the parent section (positions, -1 for none)
+        self._positions = None
+        self._previous_sections = None
+        self._section_parents = None
         elements_to_consider = None
         if mode == "intro":
             elements_to_consider = (
@@ -53,57 +86,157 @@ class WikiPage:
                 if len(dict[entry]["table"]) == 0:
                     self.error_dict["tables_empty"] += 1
                     continue
-                try:
-                    tab = WikiTable(entry, dict[entry], self.title.content)
-                    self.page_items[entry] = tab
-                except Exception:
-                    self.error_dict["tables_formatting_errors"] += 1
-                    # traceback.print_exc()
-                    # logging.warning("Table formatting error in {}, {}".format(title, entry))
-            if entry.startswith("list_"):
+            elif entry.startswith("list_"):
                 if (
                     len(dict[entry]["list"]) == 0
                     or len([en["value"] for en in dict[entry]["list"] if en["value"] != ""]) == 0
                 ):
                     self.error_dict["list_empty"] += 1
                     continue
-                try:
-                    tab = WikiList(entry, dict[entry], self.title.content)
-                    self.page_items[entry] = tab
-                except Exception:
+            elif not entry.startswith(("sentence_", "section_")):
+                continue
+            self._items[entry] = None
+            if not lazy:
+                self._build(entry)
+
+        self._order = dict["order"]
+        if not lazy:
+            self._items = self.page_items
+
+    def _build(self, entry):
+        if self._lock is None:
+            return self._build_element(entry)
+        with self._lock:
+            # Another thread may have built it while this one waited
+            element = self._items[entry]
+            return self._build_element(entry) if element is None else element
+
+    def _build_element(self, entry):
+        element_json = self._json[entry]
+        if entry.startswith("sentence_"):
+            element = WikiSentence(entry, element_json, self.title.content)
+        elif entry.startswith("section_"):
+            element = WikiSection(entry, element_json, self.title.content)
+        else:
+            try:
+                if entry.startswith("table_"):
+                    element = WikiTable(entry, element_json, self.title.content)
+                else:
+                    element = WikiList(entry, element_json, self.title.content)
+            except Exception:
+                if entry.startswith("table_"):
+                    self.error_dict["tables_formatting_errors"] += 1
+                else:
                     self.error_dict["list_formatting_errors"] += 1
-                    # logging.warning("List formatting error in {}, {}".format(title, entry))
-                    # traceback.print_exc()
-                    # print(title, entry)
-            elif entry.startswith("sentence_"):
-                text = WikiSentence(entry, dict[entry], self.title.content)
-                self.page_items[entry] = text
-            elif entry.startswith("section_"):
-                section = WikiSection(entry, dict[entry], self.title.content)
-                # print(str(section))
-                self.page_items[entry] = section
-
-        self.page_order = [el for el in dict["order"] if el in self.page_items]
+                # traceback.print_exc()
+                # logging.warning("Formatting error in {}, {}".format(self.title.content, entry))
+                element = FAILED
+                self._page_order = None
+        if isinstance(element, WikiTable):
+            for cell_id in element.all_cells:
+                self._cell_tables.setdefault(cell_id, element)
+            self._caption_tables.setdefault(element.caption_id, element)
+        elif isinstance(element, WikiList):
+            for item_id in element.list_items:
+                self._item_lists.setdefault(item_id, element)
+        self._items[entry] = element
+        return element
+
+    @property
+    def page_items(self):
+        if self._page_items is None:
+            if self._lock is None:
+                self._build_all()
+            else:
+                with self._lock:
+                    if self._page_items is None:
+                        self._build_all()
+        return self._page_items
+
+    def _build_all(self):
+        for entry, element in list(self._items.items()):
+            if element is None:
+                self._build(entry)
+        # Published last, once every element is built, and only then is the raw json dropped
+        self._page_items = {entry: element for entry, element in self._items.items() if element is not FAILED}
+        self._json = None
+
+    @property
+    def page_order(self):
+        if self._page_order is None:
+            self._page_order = [el for el in self._order if self._items.get(el, FAILED) is not FAILED]
+            self._positions = None
+        return self._page_order
+
+    def _get_position(self, element_id):
+        page_order = self.page_order
+        if self._positions is None:
+            self._positions = {el: i for i, el in reversed(list(enumerate(page_order)))}
+            self._previous_sections = None
+        if element_id not in self._positions:
+            raise ValueError("{!r} is not in list".format(element_id))
+        return self._positions[element_id]
+
+    def _index_sections(self):
+        """Nearest previous section of every position, and the section `_get_section_context` goes to from a section.
+
+        From a section s, the walk back skips sections of the same level and stops at the first other
+        one t: t is the parent of s if it is of a lower level, else s has none. `diff_levels[s]` is
+        that first previous section of another level, which for consecutive sections of the same
+        level is the same.
+        """
+        page_order = self.page_order
+        previous_sections = [-1] * len(page_order)
+        section_parents = [-1] * len(page_order)
+        diff_levels = [-1] * len(page_order)
+        levels = {}
+        last = -1
+        for i, el in enumerate(page_order):
+            previous_sections[i] = last
+            if not el.startswith("section_"):
+                continue
+            levels[i] = self.get_element_by_id(el).level
+            if last >= 0:
+                diff_levels[i] = last if levels[last] != levels[i] else diff_levels[last]
+            if diff_levels[i] >= 0 and levels[diff_levels[i]] < levels[i]:
+                section_parents[i] = diff_levels[i]
+            last = i
+        self._previous_sections = previous_sections
+        self._section_parents = section_parents
 
     def get_element_by_id(self, id):
-        return self.page_items[id] if id in self.page_items else None
+        element = self._items.get(id)
+        if element is None and id in self._items:
+            element = self._build(id)
+        return None if element is FAILED else element
+
+    def _lookup(self, index, prefix, element_id):
+        """The element holding `element_id` in `index`. Lazy pages first build the `prefix` element with
+        the same number, then every element."""
+        if element_id not in index and self._page_items is None:
+            match = ELEMENT_INDEX_PATTERN.search(element_id)
+            if match:
+                self.get_element_by_id(prefix + match.group(1))
+            if element_id not in index:
+                self.page_items
+        return index.get(element_id)
 
     def get_previous_k_elements(self, element_id, k=1):
-        element_position = self.page_order.index(element_id)
+        element_position = self._get_position(element_id)
         return [
             self.get_element_by_id(ele) for ele in reversed(self.page_order[element_position - k : element_position])
         ]
         # return self.get_element_by_id(self.page_order[element_position-1]) if element_position-1 >=0 else None
 
     def get_next_k_elements(self, element_id, k=1):
-        element_position = self.page_order.index(element_id)
+        element_position = self._get_position(element_id)
         return [
             self.get_element_by_id(ele) for ele in self.page_order[element_position + 1 : element_position + (k + 1)]
         ]
         # return self.get_element_by_id(self.page_order[element_position-1]) if element_position-1 >=0 else None
 
     def get_next_element(self, element_id):
-        element_position = self.page_order.index(element_id)
+        element_position = self._get_position(element_id)
         return self.get_element_by_id(self.page_order[element_position - 1]) if element_position - 1 >= 0 else None
 
     def get_title_content(self):
@@ -113,35 +246,30 @@ class WikiPage:
         return self.page_items
 
     def get_cell_content(self, cell_id):
-        for tab in self.get_tables():
-            if cell_id in tab.all_cells:
-                return tab.get_cell_content(cell_id)
+        tab = self.get_table_from_cell_id(cell_id)
+        if tab is not None:
+            return tab.get_cell_content(cell_id)
 
     def get_cell(self, cell_id):
-        for tab in self.get_tables():
-            if cell_id in tab.all_cells:
-                return tab.get_cell(cell_id)
+        tab = self.get_table_from_cell_id(cell_id)
+        if tab is not None:
+            return tab.get_cell(cell_id)
 
     def get_table_from_cell_id(self, cell_id):
-        for tab in self.get_tables():
-            if cell_id in tab.all_cells:
-                return tab
+        return self._lookup(self._cell_tables, "table_", cell_id)
 
     def get_item_content(self, item_id):
-        for list in self.get_lists():
-            if item_id in list.list_items:
-                return list.list_items[item_id]
+        list = self._lookup(self._item_lists, "list_", item_id)
+        if list is not None:
+            return list.list_items[item_id]
 
     def get_caption_content(self, caption_id):
-        for tab in self.get_tables():
-            if caption_id == tab.caption_id:
-                return tab.caption
+        tab = self._lookup(self._caption_tables, "table_", caption_id)
+        if tab is not None:
+            return tab.caption
 
     def get_item_by_id(self, item_id):
-        for item_dict in self.get_list_items():
-            for k, v in item_dict.items():
-                if k == item_id:
-                    return item_dict[k]
+        return self.get_item_content(item_id)
 
     def get_error_dict(self):
         return self.error_dict
@@ -150,7 +278,8 @@ class WikiPage:
         return list(itertools.chain.from_iterable([value.get_ids() for ele, value in self.page_items.items()]))
 
     def get_page(self):
-        return [self.page_items[el] for el in self.page_order]
+        page_items = self.page_items
+        return [page_items[el] for el in self.page_order]
 
     def get_tables(self):
         return [ele for key, ele in self.page_items.items() if key.startswith("table_")]
@@ -190,16 +319,19 @@ class WikiPage:
     def __str__(self):
         return "\n".join([str(el) for el in self.get_page()])
 
+    def linearize(self, max_table_chars=None, query=None):
+        """`str(self)` with every table capped at `max_table_chars` characters, see `WikiTable.linearize`."""
+        if max_table_chars is None:
+            return str(self)
+        return "\n".join([
+            el.linearize(max_table_chars, query) if isinstance(el, WikiTable) else str(el) for el in self.get_page()
+        ])
+
     def convert_ids_to_objects(self, id_list):
         return [self.page_items[el] for el in id_list]
 
     def _get_caption_context(self, caption):
-        table = None
-        for ele in self.get_tables():
-            if caption in ele.get_ids():
-                # if ele.name.split('_')[-1] == cell.split('_')[1]:
-                table = ele
-                break
+        table = self._lookup(self._caption_tables, "table_", caption)
         if table == None:
             logging.warning("Table not found in context, {}".format(caption))
         section_context = self._get_section_context(table.name)
@@ -210,93 +342,67 @@ class WikiPage:
         return [self.title] + section_context
 
     def _get_list_context(self, item):
-        list_id = None
-        for ele in self.get_lists():
-            if ele.name.split("_")[-1] == item.split("_")[1]:
-                list_id = ele
-                break
+        list_id = self.get_element_by_id("list_" + item.split("_")[1])
         if list_id == None:
             logging.warning("List not found in context, {}".format(item))
         section_context = self._get_section_context(list_id.name)
         return [self.title] + section_context
 
     def _get_cell_header_context(self, cell):
-        table = None
-        for ele in self.get_tables():
-            if ele.name.split("_")[-1] == cell.split("_")[2]:
-                table = ele
-                break
+        table = self.get_element_by_id("table_" + cell.split("_")[2])
         if table == None:
             logging.warning("Table not found in context, {}".format(cell))
         section_context = self._get_section_context(table.name)
         return [self.title] + section_context
 
     def get_table_from_cell(self, cell):
-        table = None
-        for ele in self.get_tables():
-            if ele.name.split("_")[-1] == cell.split("_")[1]:
-                table = ele
-                break
-        return table
+        return self.get_element_by_id("table_" + cell.split("_")[1])
 
     def _get_cell_context(self, cell):
-        table = None
-        for ele in self.get_tables():
-            if ele.name.split("_")[-1] == cell.split("_")[1]:
-                table = ele
-                break
+        table = self.get_table_from_cell(cell)
         if table == None:
             logging.warning("Table not found in context, {}".format(cell))
         cell_row = table.all_cells[cell].row_num
         cell_col = table.all_cells[cell].col_num
         headers_row = [cell for i, cell in enumerate(table.rows[cell_row].row) if cell_col > i]
         headers_row.reverse()
-        context_row = set([])
+        context_row = []
         encountered_header = False
         for ele in headers_row:
             if ele.is_header:
-                context_row.add(ele)
+                context_row.append(ele)
                 encountered_header = True
             elif encountered_header:
                 break
         headers_column = [row.row[cell_col] for row in table.rows if cell_row > row.row_num]
         headers_column.reverse()
-        context_column = set([])
+        context_column = []
         encountered_header = False
         for ele in headers_column:
             if ele.is_header:
-                context_column.add(ele)
+                context_column.append(ele)
                 encountered_header = True
             elif encountered_header:
                 break
 
-        return self._get_section_context(table.name) + list(context_row) + list(context_column)
+        return self._get_section_context(table.name) + context_row + context_column
 
     def _get_section_context(self, element_id):
-        section_context = []
-        if element_id not in self.page_order:
+        try:
+            page_position = self._get_position(element_id)
+        except ValueError:
             print("NOT IN")
             print(self.page_order)
             print(element_id)
             print(self.title.content)
             print(self.page_items.keys())
-        page_position = self.page_order.index(element_id)
-
-        before_elements = self.page_order[:page_position]
-        before_elements = self.convert_ids_to_objects(before_elements)
-        before_elements.reverse()
-        for ele in before_elements:
-            if ele.name.startswith("section_"):
-                if not section_context:
-                    section_context.append(ele)
-                elif section_context[-1].level > ele.level:
-                    section_context.append(ele)
-                elif section_context[-1].level < ele.level:
-                    break
-        return section_context
+            raise
+        if self._previous_sections is None:
+            self._index_sections()
 
-    def __del__(self):
-        for ele, item in self.page_items.items():
-            del item
-        del self.title
-        del self.page_order
\ No newline at end of file
+        section_context = []
+        section_position = self._previous_sections[page_position]
+        while section_position >= 0:
+            section_context.append(self.get_element_by_id(self.page_order[section_position]))
+            section_position = self._section_parents[section_position]
+        return section_context
@@ -1,11 +1,13 @@
-from .wiki_element import WikiElement
+from .wiki_element import WikiElement, intern_id
 
 
 class WikiSection(WikiElement):
+    __slots__ = ("content", "level", "name", "page")
+
     def __init__(self, name, section, page):
         self.content = section["value"]
         self.level = section["level"]
-        self.name = name
+        self.name = intern_id(name)
         self.page = page
 
     def id_repr(self):
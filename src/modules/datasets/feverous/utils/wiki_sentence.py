@@ -1,9 +1,11 @@
-from .wiki_element import WikiElement, process_text
+from .wiki_element import WikiElement, process_text, intern_id
 
 
 class WikiSentence(WikiElement):
+    __slots__ = ("name", "content", "page")
+
     def __init__(self, name, sentence, page):
-        self.name = name
+        self.name = intern_id(name)
         self.content = process_text(sentence)
         self.page = page
 
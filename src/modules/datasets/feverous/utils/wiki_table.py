@@ -1,47 +1,189 @@
 import itertools
+import re
+from collections import Counter
 
-from .wiki_element import WikiElement, process_text
+import numpy as np
+
+from .wiki_element import WikiElement, process_text, intern_id
+
+WORD_PATTERN = re.compile(r"(?u)\b\w\w+\b")
+
+TRUNCATION_MARKER = "[... {} rows omitted ...]"
+
+# Rows kept from the top and from the bottom of a truncated table when no query picks them
+DEFAULT_EDGE_ROWS = 5
 
 
 class WikiTable(WikiElement):
+    __slots__ = (
+        "name", "page", "cells", "grid", "caption", "caption_id", "type", "rows", "header_rows",
+        "linearized_table", "all_cells",
+    )
+
     def __init__(self, name, table_json, page):
-        self.name = name
+        self.name = intern_id(name)
         self.page = page
-        self.table = table_json["table"]
-        self.table = self.normalize_table()
+        cells, self.grid = self.normalize_table(table_json["table"])
         self.caption = table_json["caption"] if "caption" in table_json else ""
-        self.caption_id = "table_caption_" + self.name.split("_")[-1]
+        self.caption_id = intern_id("table_caption_" + self.name.split("_")[-1])
         self.type = table_json["type"]
-        self.rows = [Row(row, i, self.page) for i, row in enumerate(self.table)]
+
+        # A spanned cell fills several positions but is one `Cell`, at its last position in row-major order
+        # (None for cells entirely overwritten by others)
+        last_positions = np.full(len(cells), -1, dtype=np.int64)
+        np.maximum.at(last_positions, self.grid.ravel(), np.arange(self.grid.size))
+        col_size = self.grid.shape[1]
+        self.cells = [
+            Cell(cell, position // col_size, position % col_size, self.page) if position >= 0 else None
+            for cell, position in zip(cells, last_positions.tolist())
+        ]
+
+        grid_rows = self.grid.tolist()
+        self.rows = [Row([self.cells[k] for k in row], i, self.page, self) for i, row in enumerate(grid_rows)]
         self.header_rows = [row for row in self.rows if row.is_header_row() == True]
-        self.cell_ids = [row.cell_ids for row in self.rows]
-        self.cell_ids = list(itertools.chain(*self.cell_ids))
-        self.linearized_table = "\n".join([str(row) for row in self.rows])
-        self.linearized_table_id = "\n".join([row.id_repr() for row in self.rows])
+        cell_strs = [str(cell) for cell in self.cells]
+        self.linearized_table = "\n".join([" | ".join([cell_strs[k] for k in row]) for row in grid_rows])
         self.all_cells = {}
         for row in self.rows:
             for cell in row.row:
                 self.all_cells[cell.name] = cell
 
-    def consecutive_non_nulls(self, row):
-        count = 0
-        while count < len(row) and row[count] != 0:
-            count += 1
-        return count
-
-    def normalize_table(self):
-        col_size = sum(int(cell["column_span"]) for cell in self.table[0])
-        row_size = len(self.table)
-        normalized_table = [[0 for j in range(col_size)] for i in range(row_size)]
-        for i, row in enumerate(self.table):
-            for j, col in enumerate(row):
-                cell = self.table[i][j]
-                lowest_col = self.consecutive_non_nulls(normalized_table[i])
-                for k in range(min(int(cell["column_span"]), col_size - lowest_col)):
-                    normalized_table[i][lowest_col + k] = self.table[i][j]
-                for k in range(min(int(cell["row_span"]), row_size - i)):
-                    normalized_table[i + k][lowest_col] = self.table[i][j]
-        return normalized_table
+    def normalize_table(self, table):
+        """
+        Lay out the cells of `table` (rows of cell json) on a grid with their spans.
+
+        Returns the cells in row order and the (rows x columns) grid of indices into them. A cell goes
+        to the first free column of its row, fills `column_span` columns of that row and `row_span`
+        rows of its first column, overwriting cells placed earlier. The number of columns is given by
+        the first row. Positions left empty raise.
+        """
+        col_size = sum(int(cell["column_span"]) for cell in table[0])
+        row_size = len(table)
+        grid = [-1] * (row_size * col_size)
+        cells = [cell for row in table for cell in row]
+        index = 0
+        for i, row in enumerate(table):
+            row_start = i * col_size
+            # Positions are only ever filled, so the first free column of a row only moves right
+            lowest_col = 0
+            for cell in row:
+                while lowest_col < col_size and grid[row_start + lowest_col] != -1:
+                    lowest_col += 1
+                col_span = int(cell["column_span"])
+                row_span = int(cell["row_span"])
+                if col_span == 1 and row_span == 1 and lowest_col < col_size:
+                    grid[row_start + lowest_col] = index
+                else:
+                    col_span = min(col_span, col_size - lowest_col)
+                    if col_span > 0:
+                        grid[row_start + lowest_col:row_start + lowest_col + col_span] = [index] * col_span
+                    row_span = min(row_span, row_size - i)
+                    if row_span > 0:
+                        if lowest_col >= col_size:
+                            raise IndexError("Row {} of {} is wider than its first row".format(i, self.name))
+                        start = row_start + lowest_col
+                        grid[start:start + row_span * col_size:col_size] = [index] * row_span
+                index += 1
+
+        grid = np.array(grid, dtype=np.int32).reshape(row_size, col_size)
+        if (grid == -1).any():
+            raise ValueError("Empty positions in {}".format(self.name))
+        return cells, grid
+
+    def linearize(self, max_chars=None, query=None, edge_rows=DEFAULT_EDGE_ROWS):
+        """`str(self)` capped at `max_chars` characters.
+
+        Tables that fit are rendered as is. Otherwise the caption and the header rows are kept,
+        then as many other rows as fit: first those sharing the most words with `query`, then the
+        first and last `edge_rows` rows, then the remaining ones from the top. Rows stay in table
+        order and every run of dropped rows is replaced by a truncation marker line, so the result
+        is never shorter than one marker.
+
+        The caption is deliberately only added to truncated tables: `str(self)` never had it, and
+        a table that fits keeps that rendering, while a truncated one needs it to tell which table
+        the remaining rows come from.
+        """
+        if max_chars is None or len(self.linearized_table) <= max_chars:
+            return self.linearized_table
+
+        row_strs = [str(row) for row in self.rows]
+        body = [i for i, row in enumerate(self.rows) if not row.is_header_row()]
+        priority = [i for i, row in enumerate(self.rows) if row.is_header_row()]
+        if query:
+            query_words = set(WORD_PATTERN.findall(query.lower()))
+            scores = {i: len(query_words.intersection(WORD_PATTERN.findall(row_strs[i].lower()))) for i in body}
+            priority += sorted((i for i in body if scores[i] > 0), key=lambda i: -scores[i])
+        priority += body[:edge_rows] + body[::-1][:edge_rows] + body[edge_rows:]
+
+        # Dropped rows start as one run, i.e. one marker line
+        marker_size = len(TRUNCATION_MARKER.format(len(self.rows))) + 1
+        budget = max_chars - marker_size
+        lines = []
+        if self.caption and len(self.caption) + 1 <= budget:
+            lines.append(self.caption)
+            budget -= len(self.caption) + 1
+        kept = set()
+
+        def is_dropped(i):
+            return 0 <= i < len(row_strs) and i not in kept
+
+        for i in priority:
+            if i in kept:
+                continue
+            # Keeping a row splits its run of dropped rows (+1 marker), shortens it or closes it (-1)
+            new_runs = is_dropped(i - 1) + is_dropped(i + 1) - 1
+            size = len(row_strs[i]) + 1 + new_runs * marker_size
+            if size <= budget:
+                kept.add(i)
+                budget -= size
+
+        omitted = 0
+        for i, row_str in enumerate(row_strs):
+            if i not in kept:
+                omitted += 1
+                continue
+            if omitted:
+                lines.append(TRUNCATION_MARKER.format(omitted))
+                omitted = 0
+            lines.append(row_str)
+        if omitted:
+            lines.append(TRUNCATION_MARKER.format(omitted))
+        return "\n".join(lines)
+
+    @property
+    def table(self):
+        """
+        The normalized table as rows of cell json, rebuilt from the grid and the cells.
+
+        A spanned cell is the same dict at each of its positions. Values are the (stripped) cell
+        contents and spans are the ones laid out on the grid, i.e. cut at the table borders.
+        """
+        grid_rows = self.grid.tolist()
+        first_positions, col_spans, row_spans = {}, Counter(), Counter()
+        for i, row in enumerate(grid_rows):
+            for j, k in enumerate(row):
+                first_i, first_j = first_positions.setdefault(k, (i, j))
+                col_spans[k] += i == first_i
+                row_spans[k] += j == first_j
+        cell_jsons = {
+            k: {
+                "id": self.cells[k].name,
+                "value": self.cells[k].content,
+                "is_header": self.cells[k].is_header,
+                "column_span": col_spans[k],
+                "row_span": row_spans[k],
+            }
+            for k in first_positions
+        }
+        return [[cell_jsons[k] for k in row] for row in grid_rows]
+
+    @property
+    def cell_ids(self):
+        return list(itertools.chain.from_iterable([row.cell_ids for row in self.rows]))
+
+    @property
+    def linearized_table_id(self):
+        return self.id_repr()
 
     def __str__(self):
         return self.linearized_table
@@ -86,13 +228,15 @@ class WikiTable(WikiElement):
 
 
 class Cell:
+    __slots__ = ("row_num", "col_num", "page", "is_header", "content", "name")
+
     def __init__(self, cell, row_num, col_num, page):
         self.row_num = row_num
         self.col_num = col_num
         self.page = page
         self.is_header = cell["is_header"]
         self.content = process_text(cell["value"])
-        self.name = cell["id"]
+        self.name = intern_id(cell["id"])
 
     def __str__(self):
         str = self.content if not self.is_header else "[H] " + self.content
@@ -112,16 +256,33 @@ class Cell:
 
 
 class Row:
-    def __init__(self, row_json, row_num, page):
-        self.json = row_json
+    __slots__ = ("row_num", "page", "row", "table", "_is_header_row")
+
+    def __init__(self, row, row_num, page, table=None):
         self.row_num = row_num
         self.page = page
-        self.row = [Cell(cell, row_num, i, self.page) for i, cell in enumerate(row_json)]
-        self.cell_ids = [cell.name for cell in self.row]
-        self.id = " | ".join(self.cell_ids)
-        self.cell_content = [cell.content for cell in self.row]
+        self.table = table
+        # Cells spanning several positions appear once per position
+        self.row = row
         self._is_header_row = len([ele for ele in self.row if ele.is_header == False]) == 0
 
+    @property
+    def json(self):
+        """This row of `WikiTable.table`."""
+        return self.table.table[self.row_num] if self.table is not None else None
+
+    @property
+    def cell_ids(self):
+        return [cell.name for cell in self.row]
+
+    @property
+    def id(self):
+        return " | ".join(self.cell_ids)
+
+    @property
+    def cell_content(self):
+        return [cell.content for cell in self.row]
+
     def __str__(self):
         return " | ".join([str(ele) for ele in self.row])
 
@@ -141,4 +302,4 @@ class Row:
         return " | ".join([cell.joint_repr() for cell in self.row])
 
     def id_repr(self):
-        return " | ".join(self.cell_ids)
\ No newline at end of file
+        return self.id
\ No newline at end of file
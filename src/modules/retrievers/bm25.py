@@ -0,0 +1,421 @@
+"""
+Memory-mapped BM25 index.
+
+On disk an index is a directory of plain `.npy` arrays:
+- `vocab` / `doc_ids`: sorted vocabulary and document ids (see `save_string_array`)
+- `postings_indptr`, `postings_indices`, `postings_tfs`: term x document CSR matrix of raw term frequencies
+- `doc_lens`: number of tokens per document
+- `bm25_meta.json`: BM25 parameters and corpus statistics
+
+Everything is opened with `np.load(mmap_mode='r')`, so loading is O(1) and processes that open the same
+index share the OS page cache. Document texts are not stored: page ids are resolved through `FeverousDB`.
+"""
+import heapq
+import itertools
+import json
+import multiprocessing as mp
+import os
+import shutil
+from array import array
+from collections import Counter
+from typing import Callable, Iterable, Optional, Sequence
+
+import numpy as np
+import scipy.sparse as sp
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+
+from src.modules.datasets.feverous.database.feverous_db import FeverousDB
+from .text_store import iter_page_texts, open_text_store
+from .utils import tokenize, save_string_array, StringArray, PageTextLoader
+
+META_FILE = "bm25_meta.json"
+DEFAULT_K1 = 1.5
+DEFAULT_B = 0.75
+
+
+def write_index(
+        index_path: str,
+        vocab: list[str],
+        postings: sp.csr_matrix,
+        doc_ids: list[str],
+        doc_lens: np.ndarray,
+        k1: float = DEFAULT_K1,
+        b: float = DEFAULT_B,
+        **meta
+):
+    """Write a (sorted `vocab`) x (documents) term frequency matrix in the memory-mappable layout."""
+    os.makedirs(index_path, exist_ok=True)
+    doc_lens = np.asarray(doc_lens, dtype=np.int32)
+
+    save_string_array(index_path, "vocab", vocab)
+    save_string_array(index_path, "doc_ids", doc_ids)
+    np.save(os.path.join(index_path, "postings_indptr.npy"), postings.indptr.astype(np.int64))
+    np.save(os.path.join(index_path, "postings_indices.npy"), postings.indices.astype(np.int32))
+    np.save(os.path.join(index_path, "postings_tfs.npy"), postings.data.astype(np.int32))
+    np.save(os.path.join(index_path, "doc_lens.npy"), doc_lens)
+
+    meta.update({
+        "k1": k1,
+        "b": b,
+        "num_docs": len(doc_ids),
+        "num_terms": len(vocab),
+        "avg_doc_len": float(doc_lens.mean()) if len(doc_lens) else 0.0,
+    })
+    with open(os.path.join(index_path, META_FILE), "w") as f:
+        json.dump(meta, f, indent=2)
+
+
+def bm25_weights(
+        tfs: np.ndarray,
+        doc_lens: np.ndarray,
+        doc_freq: int,
+        num_docs: int,
+        avg_doc_len: float,
+        k1: float,
+        b: float
+) -> np.ndarray:
+    """BM25 contribution of one term to every document of its postings list."""
+    idf = np.log(1 + (num_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+    tfs = tfs.astype(np.float32)
+    norm = k1 * (1 - b + b * doc_lens / avg_doc_len)
+    return idf * tfs * (k1 + 1) / (tfs + norm)
+
+
+def sum_scores(all_indices: list[np.ndarray], all_weights: list[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+    """Sum per-term weights into one score per distinct document index."""
+    if not all_indices:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    doc_indices, inverse = np.unique(np.concatenate(all_indices), return_inverse=True)
+    return doc_indices, np.bincount(inverse, weights=np.concatenate(all_weights))
+
+
+def select_top_k(doc_indices: np.ndarray, scores: np.ndarray, k: int) -> list[tuple[int, float]]:
+    if len(scores) > k:
+        best = np.argpartition(-scores, k)[:k]
+        doc_indices, scores = doc_indices[best], scores[best]
+    order = np.argsort(-scores, kind="stable")
+    return [(int(doc_indices[i]), float(scores[i])) for i in order]
+
+
+class BM25Index:
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+        self.meta = self.read_meta(index_path)
+
+        self.k1 = self.meta["k1"]
+        self.b = self.meta["b"]
+        self.vocab = StringArray(index_path, "vocab")
+        self.doc_ids = StringArray(index_path, "doc_ids")
+        self.indptr = np.load(os.path.join(index_path, "postings_indptr.npy"), mmap_mode="r")
+        self.indices = np.load(os.path.join(index_path, "postings_indices.npy"), mmap_mode="r")
+        self.tfs = np.load(os.path.join(index_path, "postings_tfs.npy"), mmap_mode="r")
+        self.doc_lens = np.load(os.path.join(index_path, "doc_lens.npy"), mmap_mode="r")
+        self.num_docs = self.meta["num_docs"]
+        self.avg_doc_len = self.meta["avg_doc_len"]
+
+    @staticmethod
+    def is_index(path: str) -> bool:
+        return os.path.isfile(os.path.join(path, META_FILE))
+
+    @staticmethod
+    def read_meta(path: str) -> dict:
+        """Meta of the index at `path`, without opening its arrays (a compacted segmented index only has this file)."""
+        with open(os.path.join(path, META_FILE)) as f:
+            return json.load(f)
+
+    @classmethod
+    def build(
+            cls,
+            index_path: str,
+            documents: Iterable[tuple[str, str]],
+            k1: float = DEFAULT_K1,
+            b: float = DEFAULT_B,
+            **meta
+    ) -> "BM25Index":
+        """Index (doc_id, text) pairs in memory and write them to `index_path`."""
+        term_to_id = {}
+        term_ids, doc_indices, tfs = array("i"), array("i"), array("i")
+        doc_ids, doc_lens = [], array("i")
+        for doc_idx, (doc_id, text) in enumerate(documents):
+            tokens = tokenize(text)
+            for term, tf in Counter(tokens).items():
+                term_ids.append(term_to_id.setdefault(term, len(term_to_id)))
+                doc_indices.append(doc_idx)
+                tfs.append(tf)
+            doc_ids.append(doc_id)
+            doc_lens.append(len(tokens))
+
+        vocab = sorted(term_to_id)
+        rank = np.empty(len(vocab), dtype=np.int64)
+        rank[[term_to_id[term] for term in vocab]] = np.arange(len(vocab))
+        postings = sp.csr_matrix(
+            (np.frombuffer(tfs, dtype=np.int32),
+             (rank[np.frombuffer(term_ids, dtype=np.int32)], np.frombuffer(doc_indices, dtype=np.int32))),
+            shape=(len(vocab), len(doc_ids))
+        )
+        postings.sort_indices()
+
+        write_index(index_path, vocab, postings, doc_ids, np.frombuffer(doc_lens, dtype=np.int32), k1, b, **meta)
+        return cls(index_path)
+
+    def get_postings(self, term: str) -> tuple[np.ndarray, np.ndarray]:
+        """Return (document indices, term frequencies) for `term`."""
+        term_id = self.vocab.search(term)
+        if term_id < 0:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+        start, end = self.indptr[term_id], self.indptr[term_id + 1]
+        return self.indices[start:end], self.tfs[start:end]
+
+    def score(self, tokens: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        """Return the indices of every document matching `tokens` and their BM25 scores."""
+        all_indices, all_weights = [], []
+        for term in set(tokens):
+            indices, tfs = self.get_postings(term)
+            if not len(indices):
+                continue
+            all_indices.append(indices)
+            all_weights.append(bm25_weights(
+                tfs, self.doc_lens[indices], len(indices), self.num_docs, self.avg_doc_len, self.k1, self.b
+            ))
+        return sum_scores(all_indices, all_weights)
+
+    def top_k(self, tokens: list[str], k: int) -> list[tuple[int, float]]:
+        return select_top_k(*self.score(tokens), k)
+
+
+# ------------------------------------------------------------------------------
+# Streaming merge of several indexes (shards) into one.
+# ------------------------------------------------------------------------------
+
+
+def _open_array(path: str, dtype, size: int) -> np.ndarray:
+    """Create a `.npy` file of `size` elements and return a writable memory map over it."""
+    if size == 0:
+        # Empty files cannot be memory-mapped
+        np.save(path, np.empty(0, dtype=dtype))
+        return np.empty(0, dtype=dtype)
+    return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(size,))
+
+
+def _merge_string_arrays(index_path: str, name: str, arrays: list[StringArray], keeps: list[np.ndarray]):
+    """Concatenate the kept entries of several string arrays straight into a memory-mapped output."""
+    lengths = [np.diff(array.offsets)[keep] for array, keep in zip(arrays, keeps)]
+    total_bytes = int(sum(length.sum() for length in lengths))
+    offsets = _open_array(
+        os.path.join(index_path, f"{name}_offsets.npy"), np.int64, sum(len(length) for length in lengths) + 1
+    )
+    blob = _open_array(os.path.join(index_path, f"{name}.npy"), np.uint8, total_bytes)
+
+    offsets[0] = 0
+    position, byte_position = 1, 0
+    for array, keep, length in zip(arrays, keeps, lengths):
+        data = array.blob[np.repeat(keep, np.diff(array.offsets))]
+        blob[byte_position:byte_position + len(data)] = data
+        offsets[position:position + len(length)] = byte_position + np.cumsum(length)
+        position += len(length)
+        byte_position += len(data)
+    for array in (blob, offsets):
+        if isinstance(array, np.memmap):
+            array.flush()
+
+
+def merge_indexes(
+        index_path: str,
+        indexes: list["BM25Index"],
+        keeps: Optional[list[Optional[np.ndarray]]] = None,
+        string_arrays: Sequence[str] = (),
+        **meta
+) -> "BM25Index":
+    """
+    Merge `indexes` into a single index at `index_path`, keeping documents in order.
+
+    `keeps` optionally holds one boolean mask per index selecting the documents to keep, and
+    `string_arrays` names per-document string arrays (e.g. `sections`) merged along. Vocabularies
+    are k-way merged and postings are written term by term into memory-mapped arrays, so peak memory
+    does not depend on the total index size.
+    """
+    os.makedirs(index_path, exist_ok=True)
+    keeps = [
+        np.ones(index.num_docs, dtype=bool) if keep is None else np.asarray(keep, dtype=bool)
+        for index, keep in zip(indexes, keeps or [None] * len(indexes))
+    ]
+    remaps, num_docs = [], 0
+    for keep in keeps:
+        remaps.append((np.cumsum(keep) - 1 + num_docs).astype(np.int32))
+        num_docs += int(keep.sum())
+
+    def merged_postings():
+        """Yield (term, doc indices, tfs) in vocabulary order, skipping terms without kept documents."""
+        def vocab_stream(i):
+            vocab = indexes[i].vocab
+            for term_id in range(len(vocab)):
+                yield vocab.get_bytes(term_id), i, term_id
+
+        streams = [vocab_stream(i) for i in range(len(indexes))]
+        for term, group in itertools.groupby(heapq.merge(*streams), key=lambda entry: entry[0]):
+            all_indices, all_tfs = [], []
+            for _, i, term_id in group:
+                start, end = indexes[i].indptr[term_id], indexes[i].indptr[term_id + 1]
+                indices = indexes[i].indices[start:end]
+                kept = keeps[i][indices]
+                all_indices.append(remaps[i][indices[kept]])
+                all_tfs.append(indexes[i].tfs[start:end][kept])
+            indices = np.concatenate(all_indices)
+            if len(indices):
+                yield term, indices, np.concatenate(all_tfs)
+
+    # First pass only measures the output, second pass writes it
+    num_terms, vocab_bytes, nnz = 0, 0, 0
+    for term, indices, _ in merged_postings():
+        num_terms += 1
+        vocab_bytes += len(term)
+        nnz += len(indices)
+
+    def open_array(name, dtype, size):
+        return _open_array(os.path.join(index_path, f"{name}.npy"), dtype, size)
+
+    vocab_blob = open_array("vocab", np.uint8, vocab_bytes)
+    vocab_offsets = open_array("vocab_offsets", np.int64, num_terms + 1)
+    indptr = open_array("postings_indptr", np.int64, num_terms + 1)
+    out_indices = open_array("postings_indices", np.int32, nnz)
+    out_tfs = open_array("postings_tfs", np.int32, nnz)
+    vocab_offsets[0], indptr[0] = 0, 0
+    byte_position, position = 0, 0
+    for term_id, (term, indices, tfs) in enumerate(merged_postings()):
+        vocab_blob[byte_position:byte_position + len(term)] = np.frombuffer(term, dtype=np.uint8)
+        byte_position += len(term)
+        vocab_offsets[term_id + 1] = byte_position
+        out_indices[position:position + len(indices)] = indices
+        out_tfs[position:position + len(indices)] = tfs
+        position += len(indices)
+        indptr[term_id + 1] = position
+    for array in (vocab_blob, vocab_offsets, indptr, out_indices, out_tfs):
+        if isinstance(array, np.memmap):
+            array.flush()
+
+    _merge_string_arrays(index_path, "doc_ids", [index.doc_ids for index in indexes], keeps)
+    for name in string_arrays:
+        _merge_string_arrays(index_path, name, [StringArray(index.index_path, name) for index in indexes], keeps)
+    doc_lens = np.concatenate([index.doc_lens[keep] for index, keep in zip(indexes, keeps)]).astype(np.int32)
+    np.save(os.path.join(index_path, "doc_lens.npy"), doc_lens)
+
+    merged_meta = {key: value for key, value in indexes[0].meta.items()
+                   if key not in ("num_docs", "num_terms", "avg_doc_len")} if indexes else {}
+    merged_meta.update(meta)
+    merged_meta.update({
+        "num_docs": num_docs,
+        "num_terms": num_terms,
+        "avg_doc_len": float(doc_lens.mean()) if len(doc_lens) else 0.0,
+    })
+    merged_meta.setdefault("k1", DEFAULT_K1)
+    merged_meta.setdefault("b", DEFAULT_B)
+    with open(os.path.join(index_path, META_FILE), "w") as f:
+        json.dump(merged_meta, f, indent=2)
+
+    return BM25Index(index_path)
+
+
+# ------------------------------------------------------------------------------
+# Parallel sharded build: every worker opens its own read-only connection, indexes
+# a contiguous rowid range into a shard on disk, and the shards are merged at the end.
+# ------------------------------------------------------------------------------
+
+
+def _build_shard(task: tuple[str, str, int, int, Optional[str], Optional[int]]) -> str:
+    document_path, shard_path, start_rowid, end_rowid, text_store_path, max_table_chars = task
+    documents = (
+        (doc_id, text)
+        for _, doc_id, text in iter_page_texts(
+            document_path, text_store_path, start_rowid, end_rowid, max_table_chars=max_table_chars
+        )
+    )
+    BM25Index.build(shard_path, documents)
+    return shard_path
+
+
+def build_sharded_index(
+        index_path: str,
+        document_path: str,
+        workers: int = 4,
+        num_shards: int = 64,
+        progress: Optional[Callable[[str], None]] = None,
+        text_store_path: Optional[str] = None,
+        max_table_chars: Optional[int] = None,
+        build_shard: Callable[[tuple], str] = _build_shard,
+        string_arrays: Sequence[str] = (),
+        **meta
+) -> BM25Index:
+    """
+    Build a `BM25Index` of every page of the Feverous DB at `document_path` with `workers` processes.
+
+    The rowid space is cut into `num_shards` contiguous ranges; more shards means smaller
+    per-worker memory. Shards are written under `<index_path>/shards` and removed after the merge.
+    Page texts are read from the store at `text_store_path` (see `build_text_store`) when given,
+    instead of parsing every page; the store must have been built with the same `max_table_chars`.
+    The cap is kept in the index meta, so that retrievers render results with it.
+
+    `build_shard` indexes one task (document_path, shard_path, start_rowid, end_rowid, text_store_path,
+    max_table_chars) and must be picklable; the string arrays it saves next to the shard and names in
+    `string_arrays` are merged along (see `build_element_index`). `meta` is added to the index meta.
+    """
+    if text_store_path:
+        open_text_store(text_store_path, document_path, max_table_chars).close()
+    db = FeverousDB(document_path, read_only=True)
+    partitions = db.get_rowid_partitions(num_shards)
+    db.close()
+
+    shard_dir = os.path.join(index_path, "shards")
+    tasks = [
+        (document_path, os.path.join(shard_dir, f"{i:05d}"), start, end, text_store_path, max_table_chars)
+        for i, (start, end) in enumerate(partitions)
+    ]
+
+    with mp.Pool(processes=workers) as pool:
+        for shard_path in pool.imap_unordered(build_shard, tasks):
+            if progress:
+                progress(shard_path)
+
+    shards = [BM25Index(shard_path) for _, shard_path, *_ in tasks]
+    index = merge_indexes(
+        index_path, shards, string_arrays=string_arrays, document_path=document_path,
+        text_store_path=text_store_path, max_table_chars=max_table_chars, **meta
+    )
+    shutil.rmtree(shard_dir)
+    return index
+
+
+class MmapBM25Retriever(BaseRetriever):
+    """
+    `BaseRetriever` over a `BM25Index`. Page texts are rendered from the Feverous DB the index was built from,
+    with tables capped at `max_table_chars`, by default the cap the index was built with.
+    """
+    index_class = BM25Index
+
+    def __init__(
+            self,
+            index_path: str,
+            document_path: Optional[str] = None,
+            similarity_top_k: int = 10,
+            max_table_chars: Optional[int] = None,
+            **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.index = self.index_class(index_path)
+        self.similarity_top_k = similarity_top_k
+        if max_table_chars is None:
+            max_table_chars = self.index.meta.get("max_table_chars")
+        self.pages = PageTextLoader(document_path or self.index.meta.get("document_path"), max_table_chars)
+
+    def retrieve_ids(self, query: str, k: Optional[int] = None) -> list[tuple[str, float]]:
+        """Top-k (doc_id, score) pairs, without rendering any page."""
+        hits = self.index.top_k(tokenize(query), k or self.similarity_top_k)
+        return [(self.index.doc_ids[doc_idx], score) for doc_idx, score in hits]
+
+    def _retrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+        hits = self.retrieve_ids(query_bundle.query_str)
+        texts = self.pages.get_texts([doc_id for doc_id, _ in hits], query_bundle.query_str)
+        return [
+            NodeWithScore(node=TextNode(id_=doc_id, text=text), score=score)
+            for (doc_id, score), text in zip(hits, texts)
+        ]
@@ -0,0 +1,269 @@
+"""
+Retrieval result cache in front of any `BaseRetriever`.
+
+Entries are keyed by (retriever id, index version, top-k, normalized query). The index version is read
+from the wrapped retriever on every lookup, so rebuilding or updating the index invalidates the cache
+without any explicit call.
+"""
+import json
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+
+from src.modules.datasets.feverous.database.connection_pool import ConnectionPool
+from .bm25 import META_FILE
+from .segments import MANIFEST_FILE
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """Case-, unicode- and whitespace-insensitive form of `query`."""
+    return WHITESPACE_PATTERN.sub(" ", unicodedata.normalize("NFKC", query).lower()).strip()
+
+
+def unwrap_retriever(retriever: BaseRetriever) -> BaseRetriever:
+    """The retriever actually doing the work behind `LazyRetriever` proxies."""
+    while hasattr(retriever, "get_retriever"):
+        retriever = retriever.get_retriever()
+    return retriever
+
+
+def is_lazy(retriever: BaseRetriever) -> bool:
+    """Whether `retriever` is a `LazyRetriever`, whose id and version are derived from its paths."""
+    return hasattr(retriever, "source_path")
+
+
+def get_path_version(path: str) -> str:
+    """Modification time of the index or DB at `path`, without opening it.
+
+    Index directories are versioned by their meta file and, for segmented indexes, their manifest,
+    which is rewritten on every update.
+    """
+    if not os.path.exists(path):
+        return ""
+    if os.path.isdir(path):
+        files = [os.path.join(path, name) for name in (META_FILE, MANIFEST_FILE)]
+        files = [file for file in files if os.path.exists(file)] or [path]
+        return ".".join(str(os.stat(file).st_mtime_ns) for file in files)
+    return str(os.stat(path).st_mtime_ns)
+
+
+def get_index_path(retriever: BaseRetriever) -> Optional[str]:
+    index = getattr(retriever, "index", None)
+    for path in (getattr(index, "index_path", None), getattr(retriever, "db_path", None),
+                 getattr(retriever, "tfidf_path", None)):
+        if path:
+            return path
+    return None
+
+
+def get_retriever_id(retriever: BaseRetriever) -> str:
+    if is_lazy(retriever):
+        # Keyed on the index (or the DB an in-memory index is built from), so that ids are stable across processes
+        name = type(retriever).__name__
+        if retriever.max_table_chars is not None:
+            name = f"{name}[max_table_chars={retriever.max_table_chars}]"
+        path = retriever.source_path
+        return f"{name}:{os.path.abspath(path)}" if path else f"{name}:{id(retriever)}"
+
+    retriever = unwrap_retriever(retriever)
+    path = get_index_path(retriever)
+    name = type(retriever).__name__
+    if getattr(retriever, "level", None):
+        name = f"{name}[{retriever.level}]"
+    # Texts rendered with capped tables must not be served to an uncapped retriever of the same index
+    max_table_chars = getattr(getattr(retriever, "pages", None), "max_table_chars", None)
+    if max_table_chars is not None:
+        name = f"{name}[max_table_chars={max_table_chars}]"
+    return f"{name}:{os.path.abspath(path)}" if path else f"{name}:{id(retriever)}"
+
+
+def get_index_version(retriever: BaseRetriever) -> str:
+    """`index_version` of the retriever if it has one, otherwise the modification time of its index.
+
+    Lazy retrievers are versioned by the modification time of their source, without being loaded.
+    """
+    if is_lazy(retriever):
+        path = retriever.source_path
+        return get_path_version(path) if path else ""
+
+    retriever = unwrap_retriever(retriever)
+    version = getattr(retriever, "index_version", None)
+    if version is not None:
+        return str(version)
+    path = get_index_path(retriever)
+    if path is None:
+        return ""
+    if os.path.isdir(path) and os.path.exists(os.path.join(path, META_FILE)):
+        path = os.path.join(path, META_FILE)
+    return str(os.stat(path).st_mtime_ns) if os.path.exists(path) else ""
+
+
+class CachedRetriever(BaseRetriever):
+    """
+    Serve repeated queries of `retriever` from an in-memory LRU of `cache_size` entries and, when
+    `cache_path` is given, from a sqlite file shared across runs and processes.
+
+    Cache statistics are in `stats` (`hit_rate` for short). Returned nodes are shared between hits,
+    so callers must not modify them. A `LazyRetriever` is only loaded on the first miss.
+
+    With `cache_path`, entries are keyed by the index path of the retriever, which must then have
+    one (or be a `LazyRetriever`) unless `retriever_id` is given.
+    """
+    def __init__(
+            self,
+            retriever: BaseRetriever,
+            cache_size: int = 1024,
+            cache_path: Optional[str] = None,
+            retriever_id: Optional[str] = None,
+            **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.retriever = retriever
+        self.cache_size = cache_size
+        self.cache_path = cache_path
+        self._retriever_id = retriever_id
+        self._version = None
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+        self.pool = None
+        if cache_path:
+            if retriever_id is None and not is_lazy(retriever) and get_index_path(unwrap_retriever(retriever)) is None:
+                raise ValueError(
+                    f"{type(retriever).__name__} has no index path to key a persistent cache on, "
+                    "pass retriever_id or only use cache_size"
+                )
+            os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+            self.pool = ConnectionPool(cache_path, read_only=False)
+            connection = self.pool.connection()
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS retrieval_cache "
+                "(retriever_id TEXT, version TEXT, key TEXT, nodes TEXT, PRIMARY KEY (retriever_id, version, key))"
+            )
+            connection.commit()
+
+    @property
+    def similarity_top_k(self) -> Optional[int]:
+        retriever = self.retriever if is_lazy(self.retriever) else unwrap_retriever(self.retriever)
+        return getattr(retriever, "similarity_top_k", None)
+
+    @similarity_top_k.setter
+    def similarity_top_k(self, value: int):
+        retriever = self.retriever if is_lazy(self.retriever) else unwrap_retriever(self.retriever)
+        retriever.similarity_top_k = value
+
+    @property
+    def retriever_id(self) -> str:
+        if self._retriever_id is None:
+            self._retriever_id = get_retriever_id(self.retriever)
+        return self._retriever_id
+
+    @property
+    def hit_rate(self) -> float:
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+    def _check_version(self) -> str:
+        """Current index version; drops every entry of older versions when it changed."""
+        version = get_index_version(self.retriever)
+        if version != self._version:
+            with self._lock:
+                if version != self._version:
+                    self._memory.clear()
+                    if self.pool is not None and self._version is not None:
+                        connection = self.pool.connection()
+                        connection.execute(
+                            "DELETE FROM retrieval_cache WHERE retriever_id = ? AND version != ?",
+                            (self.retriever_id, version)
+                        )
+                        connection.commit()
+                    self._version = version
+        return version
+
+    def _get(self, version: str, key: str) -> Optional[list]:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return self._memory[key]
+
+        if self.pool is not None:
+            row = self.pool.connection().execute(
+                "SELECT nodes FROM retrieval_cache WHERE retriever_id = ? AND version = ? AND key = ?",
+                (self.retriever_id, version, key)
+            ).fetchone()
+            if row is not None:
+                value = json.loads(row[0])
+                self._put_memory(key, value)
+                with self._lock:
+                    self.stats["disk_hits"] += 1
+                return value
+
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    def _put_memory(self, key: str, value: list):
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.cache_size:
+                self._memory.popitem(last=False)
+
+    def _put(self, version: str, key: str, value: list):
+        self._put_memory(key, value)
+        if self.pool is not None:
+            connection = self.pool.connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO retrieval_cache VALUES (?, ?, ?, ?)",
+                (self.retriever_id, version, key, json.dumps(value))
+            )
+            connection.commit()
+
+    def _make_key(self, kind: str, query: str, k: Optional[int]) -> str:
+        return f"{kind}\t{k}\t{normalize_query(query)}"
+
+    def retrieve_ids(self, query: str, k: Optional[int] = None) -> list[tuple[str, float]]:
+        """Cached `retrieve_ids` of the wrapped retriever, falling back to the ids of `retrieve`."""
+        version = self._check_version()
+        key = self._make_key("ids", query, k or self.similarity_top_k)
+        cached = self._get(version, key)
+        if cached is not None:
+            return [(doc_id, score) for doc_id, score in cached]
+
+        if hasattr(self.retriever, "retrieve_ids"):
+            hits = self.retriever.retrieve_ids(query, k)
+        else:
+            hits = [(node.node_id, node.score) for node in self.retriever.retrieve(query)][:k]
+        self._put(version, key, [[doc_id, score] for doc_id, score in hits])
+        return hits
+
+    def _retrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+        version = self._check_version()
+        key = self._make_key("nodes", query_bundle.query_str, self.similarity_top_k)
+        cached = self._get(version, key)
+        if cached is not None:
+            return [NodeWithScore(node=TextNode.from_dict(node), score=score) for node, score in cached]
+
+        nodes = self.retriever.retrieve(query_bundle)
+        self._put(version, key, [[node.node.to_dict(), node.score] for node in nodes])
+        return nodes
+
+    def clear(self):
+        """Drop every cached entry of this retriever, in memory and on disk."""
+        with self._lock:
+            self._memory.clear()
+        if self.pool is not None:
+            connection = self.pool.connection()
+            connection.execute("DELETE FROM retrieval_cache WHERE retriever_id = ?", (self.retriever_id,))
+            connection.commit()
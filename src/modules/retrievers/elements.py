@@ -0,0 +1,143 @@
+"""
+Element-level evidence index for Feverous.
+
+Instead of one document per `WikiPage`, every sentence, table cell, list item and table caption
+is indexed on its own under its Feverous element id (e.g. `Page_cell_0_1_2`). Retrieval therefore
+returns short evidence pieces whose ids can be compared directly with gold evidence.
+"""
+from collections import defaultdict
+from typing import Callable, Iterator, Optional
+
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+
+from src.modules.datasets.feverous.utils import split_element_id, render_element
+from src.modules.datasets.feverous.utils.wiki_page import WikiPage
+from src.modules.datasets.feverous.utils.wiki_section import WikiSection
+from .bm25 import BM25Index, build_sharded_index
+from .text_store import iter_element_texts, open_text_store
+from .utils import tokenize, save_string_array, StringArray, PageTextLoader
+
+ELEMENT_PREFIXES = ("sentence_", "cell_", "header_cell_", "item_", "table_caption_")
+
+
+def get_section_path(wiki_page: WikiPage, element_id: str) -> str:
+    """Titles of the sections enclosing `element_id`, outermost first (e.g. `Career > 2000s`)."""
+    try:
+        context = wiki_page.get_context(element_id)
+    except Exception:
+        return ""
+    sections = [str(ele) for ele in context if isinstance(ele, WikiSection)]
+    return " > ".join(reversed(sections))
+
+
+def iter_page_elements(wiki_page: WikiPage) -> Iterator[tuple[str, str, str]]:
+    """Yield (element_id, rendered content, section path) for every evidence element, in page order."""
+    for item in wiki_page.get_page():
+        for element_id in item.get_ids():
+            if not element_id.startswith(ELEMENT_PREFIXES):
+                continue
+            try:
+                content = render_element(wiki_page, element_id)
+            except Exception:
+                continue
+            yield element_id, content, get_section_path(wiki_page, element_id)
+
+
+def make_element_node(full_id: str, content: str, section: str, score: float) -> NodeWithScore:
+    page_id, element_id = split_element_id(full_id)
+    header = f"{page_id} > {section}" if section else page_id
+    node = TextNode(
+        id_=full_id,
+        text=f"{header}: {content}",
+        metadata={"page_id": page_id, "element_id": element_id, "section": section}
+    )
+    return NodeWithScore(node=node, score=score)
+
+
+def _build_element_shard(task: tuple[str, str, int, int, Optional[str], Optional[int]]) -> str:
+    document_path, shard_path, start_rowid, end_rowid, text_store_path, _ = task
+    sections = []
+
+    def documents():
+        for _, page_id, element_id, content, section in iter_element_texts(
+                document_path, text_store_path, start_rowid, end_rowid
+        ):
+            sections.append(section)
+            yield f"{page_id}_{element_id}", f"{page_id} {section} {content}"
+
+    BM25Index.build(shard_path, documents())
+    save_string_array(shard_path, "sections", sections)
+    return shard_path
+
+
+def build_element_index(
+        index_path: str,
+        document_path: str,
+        text_store_path: Optional[str] = None,
+        workers: int = 4,
+        num_shards: int = 64,
+        progress: Optional[Callable[[str], None]] = None
+) -> BM25Index:
+    """
+    Index every evidence element of the Feverous DB at `document_path`.
+
+    Each element is indexed together with its page title and section path, which are also stored
+    (as the `sections` string array) so that results carry their context without re-parsing pages.
+    Elements are read from the store at `text_store_path` when given, which must have been built
+    with `elements=True`. Like `build_sharded_index`, rowid ranges are indexed by `workers` processes
+    into `num_shards` shards that are merged at the end.
+    """
+    max_table_chars = None
+    if text_store_path:
+        store = open_text_store(text_store_path, document_path)
+        has_elements, max_table_chars = store.has_elements, store.meta.get("max_table_chars")
+        store.close()
+        if not has_elements:
+            raise ValueError(f"{text_store_path} was built without elements")
+    # Elements are rendered uncapped; the store's cap only has to pass `build_sharded_index`'s check
+    return build_sharded_index(
+        index_path, document_path, workers, num_shards, progress, text_store_path, max_table_chars,
+        build_shard=_build_element_shard, string_arrays=("sections",), unit="element"
+    )
+
+
+class ElementRetriever(BaseRetriever):
+    """
+    `BaseRetriever` over an index written by `build_element_index`.
+
+    Node ids are Feverous element ids; texts are the rendered elements prefixed with their page
+    title and section, and `page_id`/`element_id`/`section` are kept as metadata.
+    """
+    def __init__(
+            self,
+            index_path: str,
+            document_path: Optional[str] = None,
+            similarity_top_k: int = 10,
+            **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.index = BM25Index(index_path)
+        self.sections = StringArray(index_path, "sections")
+        self.similarity_top_k = similarity_top_k
+        self.pages = PageTextLoader(document_path or self.index.meta.get("document_path"))
+
+    def _retrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+        hits = self.index.top_k(tokenize(query_bundle.query_str), self.similarity_top_k)
+
+        # Parse each page once, even when several of its elements were retrieved
+        page_hits = defaultdict(list)
+        for doc_idx, score in hits:
+            page_id, element_id = split_element_id(self.index.doc_ids[doc_idx])
+            page_hits[page_id].append((doc_idx, element_id))
+
+        contents = {}
+        for page_id, elements in page_hits.items():
+            wiki_page = self.pages.get_page(page_id)
+            for doc_idx, element_id in elements:
+                contents[doc_idx] = render_element(wiki_page, element_id) if wiki_page else ""
+
+        return [
+            make_element_node(self.index.doc_ids[doc_idx], contents[doc_idx], self.sections[doc_idx], score)
+            for doc_idx, score in hits
+        ]
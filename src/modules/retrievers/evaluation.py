@@ -0,0 +1,171 @@
+"""
+Retrieval quality and throughput against Feverous gold evidence.
+
+Works with any `BaseRetriever` whose node ids are page ids (page-level) or Feverous element ids
+(element-level). Retrievers exposing `retrieve_ids` / `batch_closest_docs` can be benchmarked
+without rendering any text.
+"""
+import os
+import re
+import resource
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import numpy as np
+from llama_index.core.retrievers import BaseRetriever
+
+from src.modules.datasets.feverous.utils import split_element_id
+from src.modules.datasets.feverous.utils.annotation_processor import AnnotationProcessor
+from .elements import ELEMENT_PREFIXES
+
+# Node ids of llama-index indexes that were not keyed by page id, e.g. older persisted `BM25Retriever`s
+UUID_PATTERN = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+
+def load_claims(annotation_path: str, limit: Optional[int] = None) -> list[tuple[str, set[str], set[str]]]:
+    """(claim, gold page ids, gold element ids) for every annotation with evidence."""
+    claims = []
+    for annotation in AnnotationProcessor(annotation_path, limit=limit):
+        if not hasattr(annotation, "flat_evidence") or not annotation.has_evidence():
+            continue
+        evidence = annotation.get_evidence(flat=True)
+        pages = {split_element_id(element_id)[0] for element_id in evidence}
+        claims.append((annotation.get_claim(), pages, set(evidence)))
+    return claims
+
+
+def is_element_id(doc_id: str) -> bool:
+    return split_element_id(doc_id)[1].startswith(ELEMENT_PREFIXES)
+
+
+def retrieve_batch(retriever: BaseRetriever, queries: list[str], k: int, ids_only: bool = False) -> list[list[str]]:
+    """Retrieved ids for a batch of queries, using the retriever's batch / id-only APIs when it has them."""
+    if ids_only and hasattr(retriever, "batch_closest_docs"):
+        return [[doc_id for doc_id, _ in hits] for hits in retriever.batch_closest_docs(queries, k)]
+    if ids_only and hasattr(retriever, "retrieve_ids"):
+        return [[doc_id for doc_id, _ in retriever.retrieve_ids(query, k)] for query in queries]
+    if hasattr(retriever, "retrieve_batch"):
+        results = retriever.retrieve_batch(queries)
+    else:
+        results = [retriever.retrieve(query) for query in queries]
+    return [[node.node_id for node in nodes][:k] for nodes in results]
+
+
+def run_queries(
+        retriever: BaseRetriever,
+        queries: list[str],
+        k: int,
+        batch_size: int = 1,
+        workers: int = 1,
+        ids_only: bool = False
+) -> tuple[list[list[str]], np.ndarray, float]:
+    """
+    Run every query, `batch_size` at a time on `workers` threads.
+
+    @return: retrieved ids per query, per-query latencies (batch latency / batch size) and wall time.
+    """
+    batches = [queries[start:start + batch_size] for start in range(0, len(queries), batch_size)]
+
+    def task(batch):
+        start = time.perf_counter()
+        results = retrieve_batch(retriever, batch, k, ids_only)
+        return results, (time.perf_counter() - start) / len(batch)
+
+    start = time.perf_counter()
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            outputs = list(executor.map(task, batches))
+    else:
+        outputs = [task(batch) for batch in batches]
+    wall_time = time.perf_counter() - start
+
+    retrieved, latencies = [], []
+    for results, latency in outputs:
+        retrieved.extend(results)
+        latencies.extend([latency] * len(results))
+    return retrieved, np.asarray(latencies), wall_time
+
+
+def recall_at_k(
+        retrieved: list[list[str]],
+        claims: list[tuple[str, set[str], set[str]]],
+        ks: list[int]
+) -> dict[str, Optional[float]]:
+    """
+    Mean per-claim page- and element-level recall@k. Element recall is None for page-level retrievers.
+    Claims without gold pages (resp. elements) are left out of the page (resp. element) mean.
+    Raises a `ValueError` when the retrieved ids are node UUIDs rather than page or element ids.
+    """
+    all_ids = [doc_id for ids in retrieved for doc_id in ids]
+    if all_ids and all(UUID_PATTERN.fullmatch(doc_id) for doc_id in all_ids):
+        raise ValueError(
+            "The retriever returns node UUIDs instead of Feverous page or element ids, "
+            "rebuild its index with scripts/graph_check/build_index.py"
+        )
+    has_elements = any(is_element_id(doc_id) for doc_id in all_ids)
+    metrics = {}
+    for k in ks:
+        page_recalls, element_recalls = [], []
+        for ids, (_, gold_pages, gold_elements) in zip(retrieved, claims):
+            top = ids[:k]
+            if gold_pages:
+                pages = {split_element_id(doc_id)[0] for doc_id in top}
+                page_recalls.append(len(pages & gold_pages) / len(gold_pages))
+            if gold_elements:
+                element_recalls.append(len(set(top) & gold_elements) / len(gold_elements))
+        metrics[f"page_recall@{k}"] = float(np.mean(page_recalls)) if page_recalls else 0.0
+        metrics[f"element_recall@{k}"] = float(np.mean(element_recalls)) if has_elements and element_recalls else None
+    return metrics
+
+
+def get_rss_mb() -> tuple[float, float]:
+    """(current, peak) resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except OSError:
+        current = peak
+    return current, peak
+
+
+def benchmark_retriever(
+        retriever: BaseRetriever,
+        claims: list[tuple[str, set[str], set[str]]],
+        ks: list[int] = (1, 5, 10),
+        batch_sizes: list[int] = (1,),
+        workers: list[int] = (1,),
+        ids_only: bool = False
+) -> dict:
+    """
+    Recall@k over `claims`, then queries/sec and latency for every (batch size, workers) combination.
+    The first query is run on its own so that lazily loaded indexes report their load time separately.
+    """
+    queries = [claim for claim, _, _ in claims]
+    k = max(ks)
+    if hasattr(retriever, "similarity_top_k"):
+        retriever.similarity_top_k = k
+
+    start = time.perf_counter()
+    retrieve_batch(retriever, queries[:1], k, ids_only)
+    first_query_time = time.perf_counter() - start
+
+    retrieved, _, _ = run_queries(retriever, queries, k, ids_only=ids_only)
+    results = {"num_claims": len(claims), "first_query_s": first_query_time, **recall_at_k(retrieved, claims, ks)}
+
+    sweeps = []
+    for batch_size in batch_sizes:
+        for num_workers in workers:
+            _, latencies, wall_time = run_queries(retriever, queries, k, batch_size, num_workers, ids_only)
+            sweeps.append({
+                "batch_size": batch_size,
+                "workers": num_workers,
+                "queries_per_s": len(queries) / wall_time if wall_time else float("inf"),
+                "p50_latency_ms": float(np.percentile(latencies, 50) * 1000) if len(latencies) else 0.0,
+                "p95_latency_ms": float(np.percentile(latencies, 95) * 1000) if len(latencies) else 0.0,
+            })
+    results["sweeps"] = sweeps
+
+    results["rss_mb"], results["peak_rss_mb"] = get_rss_mb()
+    return results
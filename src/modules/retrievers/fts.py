@@ -0,0 +1,220 @@
+"""
+SQLite FTS5 retrieval directly over a Feverous DB.
+
+`build_fts` copies the DB and adds contentless FTS5 tables keyed by rowid:
+- `wiki_fts`: one row per page, `rowid` = `wiki.rowid`
+- `wiki_elements_fts` (optional): one row per evidence element, described by `wiki_elements`
+- `fts_meta`: whether elements were indexed, the level `load_retriever` opens and the
+  `max_table_chars` page texts were rendered with
+
+Queries are plain `MATCH ... ORDER BY bm25()` statements, so there is no index to load and
+nothing to keep resident besides sqlite's page cache.
+"""
+import json
+import os
+import shutil
+import sqlite3
+from pathlib import Path
+from typing import Callable, Optional
+
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+
+from src.modules.datasets.feverous.database.connection_pool import ConnectionPool
+from src.modules.datasets.feverous.database.feverous_db import FeverousDB
+from src.modules.datasets.feverous.utils import split_element_id, render_element
+from src.modules.datasets.feverous.utils.wiki_page import WikiPage
+from .elements import iter_page_elements, make_element_node
+from .text_store import open_text_store
+from .utils import tokenize, PageTextLoader
+
+FTS_TOKENIZER = "porter unicode61"
+
+
+def build_fts(
+        document_path: str,
+        output_path: str,
+        elements: bool = False,
+        batch_size: int = 1000,
+        progress: Optional[Callable[[int], None]] = None,
+        text_store_path: Optional[str] = None,
+        max_table_chars: Optional[int] = None,
+        level: str = "page"
+):
+    """Copy the Feverous DB at `document_path` to `output_path` and add FTS5 tables to the copy.
+
+    Page texts have their tables capped at `max_table_chars`. Page and element texts are read from
+    the store at `text_store_path` when given, see `build_text_store`, which must have been built
+    with the same cap. `level` is the level `FTSRetriever` defaults to on the result, `"element"`
+    requires `elements`.
+    """
+    if level not in ("page", "element"):
+        raise ValueError(f"Invalid level: {level}")
+    if level == "element" and not elements:
+        raise ValueError("level='element' requires elements=True")
+    store = open_text_store(text_store_path, document_path, max_table_chars) if text_store_path else None
+    # Checked before the DB is copied, rather than once the page table has been indexed
+    if store is not None and elements and not store.has_elements:
+        store.close()
+        raise ValueError(f"{text_store_path} was built without elements")
+    if os.path.abspath(document_path) != os.path.abspath(output_path):
+        shutil.copyfile(document_path, output_path)
+
+    connection = sqlite3.connect(output_path)
+    connection.execute("DROP TABLE IF EXISTS fts_meta")
+    connection.execute("CREATE TABLE fts_meta (key TEXT PRIMARY KEY, value TEXT)")
+    connection.execute("DROP TABLE IF EXISTS wiki_fts")
+    connection.execute(f"CREATE VIRTUAL TABLE wiki_fts USING fts5(text, content='', tokenize='{FTS_TOKENIZER}')")
+    if elements:
+        connection.execute("DROP TABLE IF EXISTS wiki_elements_fts")
+        connection.execute("DROP TABLE IF EXISTS wiki_elements")
+        connection.execute(
+            f"CREATE VIRTUAL TABLE wiki_elements_fts USING fts5(text, content='', tokenize='{FTS_TOKENIZER}')"
+        )
+        connection.execute(
+            "CREATE TABLE wiki_elements (rowid INTEGER PRIMARY KEY, element_id TEXT, section TEXT)"
+        )
+
+    db = FeverousDB(output_path)
+    pages, element_rows, element_texts = [], [], []
+
+    def flush():
+        connection.executemany("INSERT INTO wiki_fts (rowid, text) VALUES (?, ?)", pages)
+        if elements:
+            connection.executemany("INSERT INTO wiki_elements VALUES (?, ?, ?)", element_rows)
+            connection.executemany("INSERT INTO wiki_elements_fts (rowid, text) VALUES (?, ?)", element_texts)
+        connection.commit()
+        if progress:
+            progress(len(pages))
+        pages.clear()
+        element_rows.clear()
+        element_texts.clear()
+
+    element_rowid = 0
+    if store is not None:
+        # Rowids of the store are those of `wiki`
+        for rowid, page_id, text in store.iter_texts(batch_size):
+            pages.append((rowid, f"{page_id}\n{text}"))
+            if len(pages) >= batch_size:
+                flush()
+        flush()
+        if elements:
+            for _, page_id, element_id, content, section in store.iter_elements(batch_size):
+                element_rowid += 1
+                element_rows.append((element_rowid, f"{page_id}_{element_id}", section))
+                element_texts.append((element_rowid, f"{page_id} {section} {content}"))
+                if len(element_rows) >= batch_size:
+                    flush()
+            flush()
+        store.close()
+    else:
+        for rowid, page_id, data in db.iter_docs(batch_size, non_empty=True):
+            wiki_page = WikiPage(page_id, json.loads(data))
+            pages.append((rowid, f"{page_id}\n{wiki_page.linearize(max_table_chars)}"))
+            if elements:
+                for element_id, content, section in iter_page_elements(wiki_page):
+                    element_rowid += 1
+                    element_rows.append((element_rowid, f"{page_id}_{element_id}", section))
+                    element_texts.append((element_rowid, f"{page_id} {section} {content}"))
+            if len(pages) >= batch_size:
+                flush()
+        flush()
+
+    connection.execute("INSERT INTO wiki_fts (wiki_fts) VALUES ('optimize')")
+    if elements:
+        connection.execute("INSERT INTO wiki_elements_fts (wiki_elements_fts) VALUES ('optimize')")
+    meta = {"elements": elements, "level": level, "max_table_chars": max_table_chars}
+    connection.execute("INSERT INTO fts_meta VALUES ('meta', ?)", (json.dumps(meta),))
+    connection.commit()
+    connection.close()
+    db.close()
+
+
+def read_fts_meta(db_path: str) -> dict:
+    """Meta written by `build_fts`, empty for DBs built before it was recorded (page level, whole tables)."""
+    connection = sqlite3.connect(Path(db_path).absolute().as_uri() + "?mode=ro", uri=True)
+    try:
+        rows = connection.execute("SELECT value FROM fts_meta WHERE key = 'meta'").fetchall()
+    except sqlite3.OperationalError:
+        # No fts_meta table
+        rows = []
+    finally:
+        connection.close()
+    return json.loads(rows[0][0]) if rows else {}
+
+
+def make_match_query(query: str) -> str:
+    """FTS5 query OR-ing every query token, quoted so that no token is read as an operator."""
+    return " OR ".join(f'"{token}"' for token in dict.fromkeys(tokenize(query)))
+
+
+class FTSRetriever(BaseRetriever):
+    """
+    `BaseRetriever` over the FTS5 tables written by `build_fts`.
+
+    With `level="page"` nodes are whole pages keyed by page id; with `level="element"` they are
+    evidence elements keyed by Feverous element id. `level` and `max_table_chars` default to those
+    the DB was built with. Every thread queries through its own read-only connection, so the
+    retriever can be shared by concurrent workers.
+    """
+    def __init__(
+            self,
+            db_path: str,
+            level: Optional[str] = None,
+            similarity_top_k: int = 10,
+            max_table_chars: Optional[int] = None,
+            **kwargs
+    ):
+        super().__init__(**kwargs)
+        meta = read_fts_meta(db_path)
+        level = level or meta.get("level", "page")
+        if max_table_chars is None:
+            max_table_chars = meta.get("max_table_chars")
+        if level not in ("page", "element"):
+            raise ValueError(f"Invalid level: {level}")
+        self.db_path = db_path
+        self.level = level
+        self.similarity_top_k = similarity_top_k
+        self.pool = ConnectionPool(db_path, read_only=True)
+        self.pages = PageTextLoader(db_path, max_table_chars)
+
+    def _query(self, query: str, k: Optional[int] = None) -> list[tuple]:
+        match = make_match_query(query)
+        if not match:
+            return []
+        if self.level == "page":
+            sql = (
+                "SELECT wiki.id, bm25(wiki_fts) AS score FROM wiki_fts "
+                "JOIN wiki ON wiki.rowid = wiki_fts.rowid "
+                "WHERE wiki_fts MATCH ? ORDER BY score LIMIT ?"
+            )
+        else:
+            sql = (
+                "SELECT wiki_elements.element_id, bm25(wiki_elements_fts) AS score, wiki_elements.section "
+                "FROM wiki_elements_fts "
+                "JOIN wiki_elements ON wiki_elements.rowid = wiki_elements_fts.rowid "
+                "WHERE wiki_elements_fts MATCH ? ORDER BY score LIMIT ?"
+            )
+        cursor = self.pool.connection().execute(sql, (match, k or self.similarity_top_k))
+        return cursor.fetchall()
+
+    def retrieve_ids(self, query: str, k: Optional[int] = None) -> list[tuple[str, float]]:
+        # bm25() is lower-is-better, flip it so that scores follow the usual convention
+        return [(row[0], -row[1]) for row in self._query(query, k)]
+
+    def _retrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+        rows = self._query(query_bundle.query_str)
+        if self.level == "page":
+            texts = self.pages.get_texts([page_id for page_id, _ in rows], query_bundle.query_str)
+            return [
+                NodeWithScore(node=TextNode(id_=page_id, text=text), score=-score)
+                for (page_id, score), text in zip(rows, texts)
+            ]
+
+        pages = self.pages.get_pages([split_element_id(full_id)[0] for full_id, _, _ in rows])
+        nodes = []
+        for (full_id, score, section), wiki_page in zip(rows, pages):
+            element_id = split_element_id(full_id)[1]
+            content = render_element(wiki_page, element_id) if wiki_page else ""
+            nodes.append(make_element_node(full_id, content, section, -score))
+        return nodes
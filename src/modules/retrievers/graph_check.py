@@ -0,0 +1,242 @@
+import os
+import threading
+from typing import Callable, Optional
+
+from llama_index.core import Document
+from llama_index.core.indices import SummaryIndex
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.retrievers.bm25 import BM25Retriever
+
+from .bm25 import BM25Index, MmapBM25Retriever
+from .cache import CachedRetriever
+from .elements import ElementRetriever
+from .tfidf import TfidfRetriever
+from .fts import FTSRetriever
+from .segments import SegmentedBM25Index, SegmentedBM25Retriever
+from .text_store import iter_page_texts, open_text_store
+
+DEFAULT_TOP_K = 10
+# In-memory cache entries of the retrievers workflows build themselves
+DEFAULT_CACHE_SIZE = 1024
+
+_REGISTRY: dict[tuple, "LazyRetriever"] = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+def build_retriever(
+        document_path: str,
+        similarity_top_k: int = DEFAULT_TOP_K,
+        text_store_path: Optional[str] = None,
+        max_table_chars: Optional[int] = None
+) -> BM25Retriever:
+    """Index every page of the Feverous DB at `document_path` with BM25.
+
+    Page texts are read from the store at `text_store_path` when given, see `build_text_store`,
+    which must have been built with the same `max_table_chars`. Otherwise tables are capped at
+    `max_table_chars` in the indexed (and returned) texts.
+    """
+    if text_store_path:
+        open_text_store(text_store_path, document_path, max_table_chars).close()
+    documents = [
+        Document(id_=doc_id, text=text)
+        for _, doc_id, text in iter_page_texts(document_path, text_store_path, max_table_chars=max_table_chars)
+    ]
+
+    index = SummaryIndex(nodes=documents)
+    retriever = BM25Retriever.from_defaults(index, similarity_top_k=similarity_top_k)
+
+    return retriever
+
+
+def load_retriever(
+        persist_path: str,
+        document_path: Optional[str] = None,
+        similarity_top_k: int = DEFAULT_TOP_K,
+        max_table_chars: Optional[int] = None
+) -> BaseRetriever:
+    """
+    Load an index persisted by `scripts/graph_check/build_index.py`.
+
+    Memory-mapped `BM25Index` directories (page- or element-level, possibly with incremental
+    segments) are opened in place, older llama-index
+    `BM25Retriever.persist` directories are deserialized, `.npz` files are loaded
+    as hashed TF-IDF matrices and `.db` files are queried through their FTS5 tables, at the
+    level recorded by `build_fts`.
+    Page-level retrievers rendering pages cap their tables at `max_table_chars`.
+    """
+    if persist_path.endswith(".db"):
+        return FTSRetriever(persist_path, similarity_top_k=similarity_top_k, max_table_chars=max_table_chars)
+    if persist_path.endswith(".npz"):
+        return TfidfRetriever(
+            persist_path, document_path, similarity_top_k=similarity_top_k, max_table_chars=max_table_chars
+        )
+    if BM25Index.is_index(persist_path):
+        if BM25Index.read_meta(persist_path).get("unit") == "element":
+            return ElementRetriever(persist_path, document_path, similarity_top_k=similarity_top_k)
+        if SegmentedBM25Index.is_segmented(persist_path):
+            return SegmentedBM25Retriever(
+                persist_path, document_path, similarity_top_k=similarity_top_k, max_table_chars=max_table_chars
+            )
+        return MmapBM25Retriever(
+            persist_path, document_path, similarity_top_k=similarity_top_k, max_table_chars=max_table_chars
+        )
+    retriever = BM25Retriever.from_persist_dir(persist_path)
+    retriever.similarity_top_k = similarity_top_k
+    return retriever
+
+
+class LazyRetriever(BaseRetriever):
+    """
+    Retriever proxy that builds (or loads) the wrapped retriever on the first retrieval.
+
+    Construction is cheap, so workflows can be instantiated eagerly while the
+    index is only paid for once a claim is actually processed.
+
+    The paths and settings the factory uses are kept, so that `CachedRetriever` can key and
+    version its entries (and serve hits) without loading the index.
+    """
+    def __init__(
+            self,
+            factory: Callable[[], BaseRetriever],
+            document_path: Optional[str] = None,
+            persist_path: Optional[str] = None,
+            similarity_top_k: Optional[int] = None,
+            max_table_chars: Optional[int] = None,
+            **kwargs
+    ):
+        super().__init__(**kwargs)
+        self._factory = factory
+        self._retriever: Optional[BaseRetriever] = None
+        self._lock = threading.Lock()
+        self.document_path = document_path
+        self.persist_path = persist_path
+        self.max_table_chars = max_table_chars
+        self._similarity_top_k = similarity_top_k
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._retriever is not None
+
+    @property
+    def source_path(self) -> Optional[str]:
+        """The persisted index the factory loads, or else the Feverous DB it builds the index from."""
+        if self.persist_path and os.path.exists(self.persist_path):
+            return self.persist_path
+        return self.document_path
+
+    @property
+    def similarity_top_k(self) -> Optional[int]:
+        return self._similarity_top_k
+
+    @similarity_top_k.setter
+    def similarity_top_k(self, value: int):
+        self._similarity_top_k = value
+        if self._retriever is not None:
+            self._retriever.similarity_top_k = value
+
+    def get_retriever(self) -> BaseRetriever:
+        if self._retriever is None:
+            with self._lock:
+                if self._retriever is None:
+                    retriever = self._factory()
+                    if self._similarity_top_k is not None:
+                        retriever.similarity_top_k = self._similarity_top_k
+                    self._retriever = retriever
+        return self._retriever
+
+    def retrieve_ids(self, query: str, k: Optional[int] = None) -> list[tuple[str, float]]:
+        """
+        Top-k (doc_id, score) pairs of the wrapped retriever.
+
+        Retrievers without `retrieve_ids` (e.g. llama-index's `BM25Retriever`) return at most their
+        `similarity_top_k` nodes, so it is raised to `k` first; `retrieve` still cuts its results
+        to this proxy's `similarity_top_k`.
+        """
+        retriever = self.get_retriever()
+        if hasattr(retriever, "retrieve_ids"):
+            return retriever.retrieve_ids(query, k)
+        k = k or self._similarity_top_k
+        if k and (retriever.similarity_top_k or 0) < k:
+            retriever.similarity_top_k = k
+        return [(node.node_id, node.score or 0.0) for node in retriever.retrieve(query)][:k]
+
+    def _retrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+        return self.get_retriever().retrieve(query_bundle)[:self._similarity_top_k]
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+        return (await self.get_retriever().aretrieve(query_bundle))[:self._similarity_top_k]
+
+
+def get_retriever(
+        document_path: Optional[str] = None,
+        persist_path: Optional[str] = None,
+        similarity_top_k: int = DEFAULT_TOP_K,
+        cache_size: int = 0,
+        cache_path: Optional[str] = None,
+        max_table_chars: Optional[int] = None
+) -> BaseRetriever:
+    """
+    Return the process-wide retriever for (document_path, persist_path, similarity_top_k, max_table_chars).
+
+    If `persist_path` points to an existing index it is loaded from disk, otherwise the
+    index is built from the Feverous DB at `document_path`. Either way this happens once,
+    on first retrieval, and every caller asking for the same configuration shares it.
+
+    With `cache_size` and/or `cache_path` the retriever is wrapped in a `CachedRetriever`
+    (see `with_cache`), also shared by every caller asking for the same cache.
+    """
+    if not document_path and not persist_path:
+        raise ValueError("Please pass document_path, persist_path or both.")
+
+    key = (
+        os.path.abspath(document_path) if document_path else None,
+        os.path.abspath(persist_path) if persist_path else None,
+        similarity_top_k,
+        max_table_chars
+    )
+
+    def factory() -> BaseRetriever:
+        if persist_path and os.path.exists(persist_path):
+            return load_retriever(persist_path, document_path, similarity_top_k, max_table_chars)
+        if not document_path:
+            raise FileNotFoundError(f"No persisted index found at {persist_path}")
+        return build_retriever(document_path, similarity_top_k, max_table_chars=max_table_chars)
+
+    with _REGISTRY_LOCK:
+        if key not in _REGISTRY:
+            _REGISTRY[key] = LazyRetriever(
+                factory,
+                document_path=document_path,
+                persist_path=persist_path,
+                similarity_top_k=similarity_top_k,
+                max_table_chars=max_table_chars
+            )
+        retriever = _REGISTRY[key]
+
+        if not cache_size and not cache_path:
+            return retriever
+        cache_key = key + (cache_size, os.path.abspath(cache_path) if cache_path else None)
+        if cache_key not in _REGISTRY:
+            _REGISTRY[cache_key] = with_cache(retriever, cache_size, cache_path)
+        return _REGISTRY[cache_key]
+
+
+def with_cache(
+        retriever: BaseRetriever,
+        cache_size: int = 0,
+        cache_path: Optional[str] = None
+) -> BaseRetriever:
+    """
+    Put a result cache of `cache_size` in-memory entries (plus an on-disk tier at `cache_path`)
+    in front of `retriever`. Without either, or if `retriever` is already cached, it is returned as is.
+    """
+    if (not cache_size and not cache_path) or isinstance(retriever, CachedRetriever):
+        return retriever
+    return CachedRetriever(retriever, cache_size=cache_size, cache_path=cache_path)
+
+
+def clear_registry():
+    """Drop every shared retriever, e.g. after the underlying index was rebuilt."""
+    with _REGISTRY_LOCK:
+        _REGISTRY.clear()
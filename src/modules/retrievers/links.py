@@ -0,0 +1,232 @@
+"""
+Hyperlink graph over the Feverous DB, for multi-hop evidence expansion.
+
+Feverous element texts keep their wikipedia links as `[[Target_page|anchor text]]`. `build_link_graph`
+extracts them once into a (pages x pages) CSR matrix of link counts, saved with `save_sparse_csr`
+together with the page ids (sorted, so that ids are resolved with a binary search instead of a dict).
+"""
+import bisect
+import math
+import re
+import threading
+from array import array
+from collections import Counter
+from typing import Callable, Iterable, Iterator, Optional, Union
+
+import numpy as np
+import scipy.sparse as sp
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+
+from src.modules.datasets.feverous.database.feverous_db import FeverousDB
+from src.modules.datasets.feverous.database.utils import save_sparse_csr, load_sparse_csr
+from src.modules.datasets.feverous.utils import split_element_id
+from .utils import PageTextLoader
+
+LINK_PATTERN = re.compile(r"\[\[([^\[\]|]+)(?:\|[^\[\]]*)?\]\]")
+# Results asked from the wrapped retriever of `LinkExpansionRetriever`, to be re-ranked
+DEFAULT_CANDIDATE_TOP_K = 20
+
+
+def extract_links(text: str) -> list[str]:
+    """Link targets of `text`, as page titles (underscores replaced by spaces)."""
+    return [target.replace("_", " ").strip() for target in LINK_PATTERN.findall(text)]
+
+
+def iter_strings(value) -> Iterator[str]:
+    """Every string nested in a page json: sentences, cell and item values, captions..."""
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from iter_strings(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from iter_strings(item)
+
+
+def find_page(doc_ids: list[str], title: str) -> int:
+    """Index of `title` in the sorted `doc_ids`, also trying it with an upper-cased first letter, or -1."""
+    for candidate in (title, title[:1].upper() + title[1:]):
+        position = bisect.bisect_left(doc_ids, candidate)
+        if position < len(doc_ids) and doc_ids[position] == candidate:
+            return position
+    return -1
+
+
+def build_link_graph(
+        document_path: str,
+        output_path: str,
+        progress: Optional[Callable[[int], None]] = None
+):
+    """
+    Extract the links between pages of the Feverous DB at `document_path` and save them to `output_path`
+    (`.npz`). Links to pages missing from the DB and self links are dropped.
+    """
+    db = FeverousDB(document_path, read_only=True)
+    doc_ids = sorted(db.iter_doc_ids())
+
+    rows, cols, counts = array("i"), array("i"), array("i")
+    num_pages = 0
+    for doc_id, page_json in db.iter_docs_json():
+        source = find_page(doc_ids, doc_id)
+        targets = Counter(
+            find_page(doc_ids, title) for text in iter_strings(page_json) for title in extract_links(text)
+        )
+        for target, count in targets.items():
+            if target >= 0 and target != source:
+                rows.append(source)
+                cols.append(target)
+                counts.append(count)
+        num_pages += 1
+        if progress and num_pages % 1000 == 0:
+            progress(1000)
+    db.close()
+    if progress:
+        progress(num_pages % 1000)
+
+    graph = sp.csr_matrix(
+        (np.frombuffer(counts, dtype=np.int32),
+         (np.frombuffer(rows, dtype=np.int32), np.frombuffer(cols, dtype=np.int32))),
+        shape=(len(doc_ids), len(doc_ids))
+    )
+    save_sparse_csr(output_path, graph, {"doc_ids": doc_ids, "document_path": document_path})
+
+
+class LinkGraph:
+    """Out- and in-links between pages, loaded from a graph saved by `build_link_graph`."""
+    def __init__(self, graph_path: str):
+        self.graph_path = graph_path
+        self.matrix, metadata = load_sparse_csr(graph_path)
+        self.doc_ids = list(metadata["doc_ids"])
+        self.document_path = metadata["document_path"]
+        self._backlinks = None
+
+    @property
+    def backlinks(self) -> sp.csr_matrix:
+        if self._backlinks is None:
+            self._backlinks = self.matrix.transpose().tocsr()
+        return self._backlinks
+
+    def get_index(self, page_id: str) -> int:
+        position = bisect.bisect_left(self.doc_ids, page_id)
+        if position < len(self.doc_ids) and self.doc_ids[position] == page_id:
+            return position
+        return -1
+
+    def _neighbours(self, matrix: sp.csr_matrix, page_id: str) -> list[str]:
+        index = self.get_index(page_id)
+        if index < 0:
+            return []
+        return [self.doc_ids[i] for i in matrix.indices[matrix.indptr[index]:matrix.indptr[index + 1]]]
+
+    def get_links(self, page_id: str) -> list[str]:
+        """Pages linked from `page_id`."""
+        return self._neighbours(self.matrix, page_id)
+
+    def get_backlinks(self, page_id: str) -> list[str]:
+        """Pages linking to `page_id`."""
+        return self._neighbours(self.backlinks, page_id)
+
+    def link_counts(self, seed_ids: Iterable[str], both_directions: bool = True) -> Counter:
+        """Number of seed pages linked from (and, with `both_directions`, linking to) every page."""
+        counts = Counter()
+        for page_id in set(seed_ids):
+            neighbours = set(self.get_links(page_id))
+            if both_directions:
+                neighbours.update(self.get_backlinks(page_id))
+            counts.update(neighbours)
+        return counts
+
+
+class LinkExpansionRetriever(BaseRetriever):
+    """
+    Re-rank and expand the results of a page- or element-level `retriever` with a `LinkGraph`.
+
+    `retrieve_with_seeds` takes the pages already retrieved for resolved latent entities as seeds.
+    The first `candidate_top_k` results of the wrapped retriever are the candidates, so its own
+    `similarity_top_k` should be at least that. A candidate whose page is connected to `n` seed pages
+    has its score multiplied by `1 + link_weight * log(1 + n)`. Up to `expand_k` connected pages that
+    were not retrieved at all are then added, as page nodes with score 0, in place of the lowest-ranked
+    candidates. Without seeds this is the wrapped retriever cut to `similarity_top_k`.
+
+    Candidates keep the nodes of the wrapped retriever; only added pages are rendered here, with their
+    tables capped at `max_table_chars` (see `PageTextLoader`).
+
+    `graph` is either a `LinkGraph` or the path of one, which is then only loaded on the first retrieval.
+    """
+    def __init__(
+            self,
+            retriever: BaseRetriever,
+            graph: Union[LinkGraph, str],
+            candidate_top_k: int = DEFAULT_CANDIDATE_TOP_K,
+            similarity_top_k: int = 10,
+            link_weight: float = 0.5,
+            expand_k: int = 0,
+            max_table_chars: Optional[int] = None,
+            **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.retriever = retriever
+        self.candidate_top_k = candidate_top_k
+        self.similarity_top_k = similarity_top_k
+        self.link_weight = link_weight
+        self.expand_k = expand_k
+        self.max_table_chars = max_table_chars
+        self._graph = graph if isinstance(graph, LinkGraph) else None
+        self._graph_path = graph if isinstance(graph, str) else graph.graph_path
+        self._pages = None
+        self._lock = threading.Lock()
+
+    @property
+    def graph(self) -> LinkGraph:
+        if self._graph is None:
+            with self._lock:
+                if self._graph is None:
+                    self._graph = LinkGraph(self._graph_path)
+        return self._graph
+
+    @property
+    def pages(self) -> PageTextLoader:
+        if self._pages is None:
+            self._pages = PageTextLoader(self.graph.document_path, self.max_table_chars)
+        return self._pages
+
+    def rerank(self, hits: list[tuple[str, float]], seed_ids: Iterable[str] = ()) -> list[tuple[str, float]]:
+        """Re-rank and expand (doc_id, score) candidates given the seed pages."""
+        seed_ids = set(seed_ids)
+        counts = self.graph.link_counts(seed_ids)
+        if not counts:
+            return hits[:self.similarity_top_k]
+
+        ranked = sorted(
+            ((doc_id, score * (1 + self.link_weight * math.log1p(counts[split_element_id(doc_id)[0]])))
+             for doc_id, score in hits),
+            key=lambda hit: -hit[1]
+        )
+        retrieved_pages = {split_element_id(doc_id)[0] for doc_id, _ in hits}
+        expanded = [
+            (page_id, 0.0) for page_id, _ in counts.most_common()
+            if page_id not in retrieved_pages and page_id not in seed_ids
+        ][:min(self.expand_k, self.similarity_top_k)]
+        return ranked[:self.similarity_top_k - len(expanded)] + expanded
+
+    def retrieve_with_seeds(self, query: str, seed_ids: Iterable[str] = ()) -> list[NodeWithScore]:
+        retrieved = self.retriever.retrieve(query)[:self.candidate_top_k]
+        hits = [(node.node_id, node.score or 0.0) for node in retrieved]
+        nodes = {node.node_id: node.node for node in retrieved}
+
+        results = []
+        for doc_id, score in self.rerank(hits, seed_ids):
+            node = nodes.get(doc_id) or TextNode(id_=doc_id, text=self._render_page(doc_id, query))
+            results.append(NodeWithScore(node=node, score=score))
+        return results
+
+    def _render_page(self, page_id: str, query: Optional[str] = None) -> str:
+        wiki_page = self.pages.get_page(page_id)
+        if wiki_page is None:
+            return ""
+        return wiki_page.linearize(self.max_table_chars, query)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+        return self.retrieve_with_seeds(query_bundle.query_str)
@@ -0,0 +1,383 @@
+"""
+Incremental updates of a persisted `BM25Index`.
+
+An updatable index is a base `BM25Index` directory plus:
+- `segments.json`: the ordered list of live segments (`"."` is the base index itself), the next
+  segment number and a version that is bumped on every update
+- `seg_XXXXX/`: small `BM25Index` directories holding documents added after the base was built
+- `base_XXXXX/`: the base written by the last `compact`, listed first in place of `"."`; the
+  directory itself then only keeps the meta file of the original build
+- `deleted.npy` (per segment): packed bitmap of documents that were deleted or replaced
+- `doc_ids_order.npy` (per segment): permutation sorting the segment's doc ids, for id lookups
+
+Corpus statistics (N, document frequencies, average length) are computed over live documents only,
+so scores match a fresh build of the same corpus. `compact` folds every segment back into the base.
+"""
+import json
+import os
+import shutil
+import threading
+from typing import Iterable, Optional
+
+import numpy as np
+
+from src.modules.datasets.feverous.database.feverous_db import FeverousDB
+from src.modules.datasets.feverous.utils.wiki_page import WikiPage
+from .bm25 import META_FILE, BM25Index, MmapBM25Retriever, merge_indexes, bm25_weights, sum_scores, select_top_k
+
+MANIFEST_FILE = "segments.json"
+DELETED_FILE = "deleted.npy"
+ORDER_FILE = "doc_ids_order.npy"
+BASE_SEGMENT = "."
+
+
+class Segment:
+    """One `BM25Index` of a segmented index, with its deletion bitmap."""
+    def __init__(self, index_path: str, name: str):
+        self.name = name
+        self.path = os.path.normpath(os.path.join(index_path, name))
+        self.index = BM25Index(self.path)
+
+        deleted_path = os.path.join(self.path, DELETED_FILE)
+        if os.path.exists(deleted_path):
+            packed = np.load(deleted_path)
+            self.deleted = np.unpackbits(packed, count=self.index.num_docs).astype(bool)
+        else:
+            self.deleted = np.zeros(self.index.num_docs, dtype=bool)
+        self._order = None
+
+    @property
+    def num_live(self) -> int:
+        return self.index.num_docs - int(self.deleted.sum())
+
+    @property
+    def live_length(self) -> int:
+        return int(self.index.doc_lens[~self.deleted].sum()) if self.index.num_docs else 0
+
+    @property
+    def order(self) -> np.ndarray:
+        """Permutation sorting the doc ids, computed on first use and persisted next to the segment."""
+        if self._order is None:
+            order_path = os.path.join(self.path, ORDER_FILE)
+            if os.path.exists(order_path):
+                self._order = np.load(order_path, mmap_mode="r")
+            else:
+                doc_ids = self.index.doc_ids
+                order = np.asarray(sorted(range(len(doc_ids)), key=doc_ids.get_bytes), dtype=np.int64)
+                np.save(order_path, order)
+                self._order = order
+        return self._order
+
+    def find(self, doc_id: str) -> int:
+        """Local index of the live document `doc_id`, or -1."""
+        doc_idx = self.index.doc_ids.search(doc_id, order=self.order)
+        if doc_idx < 0 or self.deleted[doc_idx]:
+            return -1
+        return doc_idx
+
+    def save_deleted(self):
+        np.save(os.path.join(self.path, DELETED_FILE), np.packbits(self.deleted))
+
+
+class SegmentDocIds:
+    """Doc ids of a segmented index, addressed by global document index."""
+    def __init__(self, segments: list[Segment], offsets: np.ndarray):
+        self.segments = segments
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def __getitem__(self, doc_idx: int) -> str:
+        segment = int(np.searchsorted(self.offsets, doc_idx, side="right")) - 1
+        return self.segments[segment].index.doc_ids[doc_idx - int(self.offsets[segment])]
+
+
+class SegmentedBM25Index:
+    """
+    `BM25Index` that supports adding, replacing and deleting documents by id without a full rebuild.
+
+    Exposes the read API of `BM25Index` (`score`, `top_k`, `doc_ids`, `meta`), with document indices
+    running over the concatenation of all segments. Deleted documents never match. A directory without
+    `segments.json` is opened as a single base segment, so any `BM25Index` can be updated in place.
+
+    Readers pick up changes made by other processes through `refresh`. Updates themselves are not
+    synchronized across processes: run a single writer at a time.
+    """
+    def __init__(self, index_path: str, max_segments: int = 8, max_deleted_ratio: float = 0.2):
+        self.index_path = index_path
+        self.max_segments = max_segments
+        self.max_deleted_ratio = max_deleted_ratio
+        self._lock = threading.RLock()
+        self._manifest_mtime = None
+        self.load()
+
+    @staticmethod
+    def is_segmented(path: str) -> bool:
+        return os.path.isfile(os.path.join(path, MANIFEST_FILE))
+
+    # ------------------------------------------------------------------------------
+    # Loading
+    # ------------------------------------------------------------------------------
+
+    def _read_manifest(self) -> dict:
+        manifest_path = os.path.join(self.index_path, MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            return {"segments": [BASE_SEGMENT], "next_segment": 1, "version": 0}
+        with open(manifest_path) as f:
+            return json.load(f)
+
+    def _write_manifest(self):
+        manifest_path = os.path.join(self.index_path, MANIFEST_FILE)
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, manifest_path)
+        self._manifest_mtime = os.stat(manifest_path).st_mtime_ns
+
+    def load(self):
+        """(Re)open every segment listed in the manifest and recompute the live corpus statistics."""
+        with self._lock:
+            manifest_path = os.path.join(self.index_path, MANIFEST_FILE)
+            self._manifest_mtime = os.stat(manifest_path).st_mtime_ns if os.path.exists(manifest_path) else None
+            self.manifest = self._read_manifest()
+            self._set_segments([Segment(self.index_path, name) for name in self.manifest["segments"]])
+
+    def _set_segments(self, segments: list[Segment]):
+        base = segments[0].index
+        self.meta = base.meta
+        self.k1 = base.k1
+        self.b = base.b
+        self._update_stats(segments)
+
+    def _update_stats(self, segments: list[Segment]):
+        offsets = np.zeros(len(segments) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([segment.index.num_docs for segment in segments])
+        num_docs = sum(segment.num_live for segment in segments)
+        total_length = sum(segment.live_length for segment in segments)
+        # Swapped in one assignment so that concurrent queries never mix two versions
+        self._state = (segments, offsets, num_docs, total_length / num_docs if num_docs else 0.0)
+
+    def refresh(self) -> bool:
+        """Reload if another process updated the index since it was opened. Returns whether it did."""
+        manifest_path = os.path.join(self.index_path, MANIFEST_FILE)
+        mtime = os.stat(manifest_path).st_mtime_ns if os.path.exists(manifest_path) else None
+        if mtime == self._manifest_mtime:
+            return False
+        self.load()
+        return True
+
+    @property
+    def segments(self) -> list[Segment]:
+        return self._state[0]
+
+    @property
+    def num_docs(self) -> int:
+        return self._state[2]
+
+    @property
+    def avg_doc_len(self) -> float:
+        return self._state[3]
+
+    @property
+    def version(self) -> int:
+        return self.manifest["version"]
+
+    @property
+    def doc_ids(self) -> SegmentDocIds:
+        segments, offsets, _, _ = self._state
+        return SegmentDocIds(segments, offsets)
+
+    # ------------------------------------------------------------------------------
+    # Scoring
+    # ------------------------------------------------------------------------------
+
+    def score(self, tokens: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        """Return the global indices of every live document matching `tokens` and their BM25 scores."""
+        segments, offsets, num_docs, avg_doc_len = self._state
+        all_indices, all_weights = [], []
+        for term in set(tokens):
+            term_indices, term_lens, term_tfs = [], [], []
+            for segment, offset in zip(segments, offsets):
+                indices, tfs = segment.index.get_postings(term)
+                if not len(indices):
+                    continue
+                live = ~segment.deleted[indices]
+                indices, tfs = indices[live], tfs[live]
+                term_indices.append(indices.astype(np.int64) + offset)
+                term_lens.append(segment.index.doc_lens[indices])
+                term_tfs.append(tfs)
+            if not term_indices:
+                continue
+            indices = np.concatenate(term_indices)
+            if not len(indices):
+                continue
+            all_indices.append(indices)
+            all_weights.append(bm25_weights(
+                np.concatenate(term_tfs), np.concatenate(term_lens), len(indices),
+                num_docs, avg_doc_len, self.k1, self.b
+            ))
+        return sum_scores(all_indices, all_weights)
+
+    def top_k(self, tokens: list[str], k: int) -> list[tuple[int, float]]:
+        return select_top_k(*self.score(tokens), k)
+
+    # ------------------------------------------------------------------------------
+    # Updates
+    # ------------------------------------------------------------------------------
+
+    def _delete(self, doc_ids: Iterable[str]) -> list[Segment]:
+        touched = {}
+        for doc_id in doc_ids:
+            for segment in self.segments:
+                doc_idx = segment.find(doc_id)
+                if doc_idx >= 0:
+                    segment.deleted[doc_idx] = True
+                    touched[segment.name] = segment
+        for segment in touched.values():
+            segment.save_deleted()
+        return list(touched.values())
+
+    def delete_documents(self, doc_ids: Iterable[str]) -> int:
+        """Delete documents by id. Unknown ids are ignored. Returns the number of deleted documents."""
+        with self._lock:
+            before = self.num_docs
+            if self._delete(doc_ids):
+                self._commit(self.segments)
+            return before - self.num_docs
+
+    def add_documents(self, documents: Iterable[tuple[str, str]]):
+        """
+        Add (doc_id, text) pairs as a new segment. Documents whose id is already indexed are replaced.
+        """
+        with self._lock:
+            documents = list({doc_id: text for doc_id, text in documents}.items())
+            if not documents:
+                return
+
+            # The replaced documents are only deleted once their new versions are on disk
+            name = self._next_name("seg")
+            BM25Index.build(
+                os.path.join(self.index_path, name), documents, self.k1, self.b, **self._segment_meta()
+            )
+            segment = Segment(self.index_path, name)
+            self._delete(doc_id for doc_id, _ in documents)
+            self._commit(self.segments + [segment])
+
+    def _next_name(self, prefix: str) -> str:
+        """Directory name for a new segment or base. A leftover of an interrupted update is removed."""
+        name = f"{prefix}_{self.manifest['next_segment']:05d}"
+        self.manifest["next_segment"] += 1
+        path = os.path.join(self.index_path, name)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        return name
+
+    def _segment_meta(self) -> dict:
+        return {
+            key: value for key, value in self.meta.items()
+            if key not in ("k1", "b", "num_docs", "num_terms", "avg_doc_len")
+        }
+
+    def _commit(self, segments: list[Segment]):
+        self.manifest["segments"] = [segment.name for segment in segments]
+        self.manifest["version"] += 1
+        self._write_manifest()
+        self._update_stats(segments)
+        if self.needs_compaction():
+            self.compact()
+
+    def needs_compaction(self) -> bool:
+        total = sum(segment.index.num_docs for segment in self.segments)
+        deleted = total - self.num_docs
+        return len(self.segments) > self.max_segments or (total and deleted / total > self.max_deleted_ratio)
+
+    def compact(self):
+        """Merge every segment, minus deleted documents, into a new base index.
+
+        The merged index is written to its own `base_XXXXX` directory and the manifest is switched to
+        it in one atomic write, so readers and crashes only ever see the old or the new index. The
+        previous segments are removed afterwards; open memory maps keep their files alive until the
+        previous state is dropped.
+        """
+        with self._lock:
+            segments = self.segments
+            name = self._next_name("base")
+            base_path = os.path.join(self.index_path, name)
+            merge_indexes(
+                base_path, [segment.index for segment in segments], keeps=[~segment.deleted for segment in segments],
+                **self._segment_meta()
+            )
+
+            self.manifest["segments"] = [name]
+            self.manifest["version"] += 1
+            self._write_manifest()
+            self._set_segments([Segment(self.index_path, name)])
+
+            for segment in segments:
+                if segment.name != BASE_SEGMENT:
+                    shutil.rmtree(segment.path)
+                    continue
+                # The original base lives in the index directory itself, whose meta file stays as its marker
+                for file_name in os.listdir(base_path) + [DELETED_FILE, ORDER_FILE]:
+                    file_path = os.path.join(self.index_path, file_name)
+                    if file_name != META_FILE and os.path.isfile(file_path):
+                        os.remove(file_path)
+
+
+def update_pages(
+        index: SegmentedBM25Index,
+        document_path: str,
+        page_ids: Iterable[str],
+        batch_size: int = 1000
+) -> tuple[int, int]:
+    """
+    Re-index `page_ids` from the Feverous DB at `document_path`: pages found in the DB are added or
+    replaced, pages missing from it (or empty) are deleted. Only page-level indexes are supported.
+
+    Pages are rendered as `WikiPage.linearize` with the `max_table_chars` of the index meta, i.e. the
+    same texts as a rebuild (and as a text store built with that cap, which the patched DB no longer
+    matches), so that the corpus statistics do not drift from those of a fresh index.
+
+    @return: number of (indexed, deleted) pages.
+    """
+    if index.meta.get("unit", "page") != "page":
+        raise ValueError("Only page-level indexes can be updated from a Feverous DB.")
+
+    max_table_chars = index.meta.get("max_table_chars")
+    db = FeverousDB(document_path, read_only=True)
+    num_indexed, num_deleted = 0, 0
+    page_ids = list(dict.fromkeys(page_ids))
+    for start in range(0, len(page_ids), batch_size):
+        batch = page_ids[start:start + batch_size]
+        documents, missing = [], []
+        # None for pages missing from the DB and for empty ones
+        for page_id, page_json in zip(batch, db.get_docs_json(batch)):
+            if page_json is None:
+                missing.append(page_id)
+            else:
+                documents.append((page_id, WikiPage(page_id, page_json).linearize(max_table_chars)))
+        index.add_documents(documents)
+        num_indexed += len(documents)
+        # Pages that were never indexed are not counted
+        num_deleted += index.delete_documents(missing)
+    db.close()
+
+    return num_indexed, num_deleted
+
+
+class SegmentedBM25Retriever(MmapBM25Retriever):
+    """`MmapBM25Retriever` over a `SegmentedBM25Index`, picking up updates made by other processes."""
+    index_class = SegmentedBM25Index
+
+    @property
+    def index_version(self) -> str:
+        # Picks up updates made by other processes, so that caches never serve results of an older manifest
+        self.index.refresh()
+        # The base index modification time tells a rebuilt index apart from an updated one
+        base_mtime = os.stat(os.path.join(self.index.index_path, META_FILE)).st_mtime_ns
+        return f"{base_mtime}.{self.index.version}"
+
+    def retrieve_ids(self, query: str, k: Optional[int] = None) -> list[tuple[str, float]]:
+        self.index.refresh()
+        return super().retrieve_ids(query, k)
@@ -0,0 +1,336 @@
+"""
+Linearized Feverous pages, written once and streamed by every index builder.
+
+Parsing page json into a `WikiPage` dominates every index build. `build_text_store` does it once
+and writes a sidecar sqlite file with:
+- `pages`: one row per page of the DB, `rowid` = `wiki.rowid`, with `WikiPage.linearize` (NULL
+  for empty pages) and a hash of the page json
+- `elements` (optional): one row per evidence element, as yielded by `iter_page_elements`
+- `text_meta`: the content hash of the whole DB, the size and mtime of the file it was read from
+  and the `max_table_chars` the texts were rendered with
+
+Rebuilding a store only parses the pages whose json hash changed since the previous build.
+"""
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import sqlite3
+from typing import Callable, Iterator, Optional
+
+from src.modules.datasets.feverous.database.connection_pool import ConnectionPool
+from src.modules.datasets.feverous.database.feverous_db import FeverousDB, DEFAULT_SCAN_BATCH_SIZE
+from src.modules.datasets.feverous.database.fingerprint import (
+    HASH_SIZE, hash_data, get_file_fingerprint, get_content_hash, update_content_hash, matches_source
+)
+from src.modules.datasets.feverous.utils.wiki_page import WikiPage
+
+SCHEMA = [
+    "CREATE TABLE pages (rowid INTEGER PRIMARY KEY, page_id TEXT UNIQUE, data_hash BLOB, text TEXT)",
+    "CREATE TABLE elements (rowid INTEGER PRIMARY KEY, page_rowid INTEGER, page_id TEXT, element_id TEXT, "
+    "text TEXT, section TEXT)",
+    "CREATE INDEX elements_page_rowid ON elements (page_rowid)",
+    "CREATE TABLE text_meta (key TEXT PRIMARY KEY, value TEXT)",
+]
+
+
+class TextStore(object):
+    """Read access to a store written by `build_text_store`."""
+
+    def __init__(self, store_path: str, **pool_kwargs):
+        self.path = store_path
+        self.pool = ConnectionPool(store_path, read_only=True, **pool_kwargs)
+        self.meta = json.loads(self._execute("SELECT value FROM text_meta WHERE key = 'meta'")[0][0])
+
+    def _execute(self, sql: str, parameters=()) -> list[tuple]:
+        cursor = self.pool.connection().execute(sql, parameters)
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
+
+    @property
+    def has_elements(self) -> bool:
+        return self.meta["elements"]
+
+    def check(self, document_path: str):
+        """Raise a `ValueError` unless the store was built from the current content of `document_path`.
+
+        See `matches_source`: the content hash is only recomputed when the size or mtime of the file changed.
+        """
+        if not matches_source(self.meta, document_path):
+            raise ValueError(
+                f"{self.path} was built from another version of {document_path}, rebuild it with build_text_store"
+            )
+
+    def get_page(self, page_id: str) -> Optional[tuple[int, bytes, Optional[str]]]:
+        """(rowid, data hash, text) of `page_id`, or None."""
+        rows = self._execute("SELECT rowid, data_hash, text FROM pages WHERE page_id = ?", (page_id,))
+        return rows[0] if rows else None
+
+    def get_page_elements(self, page_rowid: int) -> list[tuple[str, str, str]]:
+        """(element_id, text, section) of every element of the page at `page_rowid`, in page order."""
+        return self._execute(
+            "SELECT element_id, text, section FROM elements WHERE page_rowid = ? ORDER BY rowid", (page_rowid,)
+        )
+
+    def get_rowid_partitions(self, num_partitions: int) -> list[tuple[int, int]]:
+        """Same ranges as `FeverousDB.get_rowid_partitions` on the DB the store was built from."""
+        min_rowid, max_rowid = self._execute("SELECT MIN(rowid), MAX(rowid) FROM pages")[0]
+        if min_rowid is None:
+            return []
+        bounds = [min_rowid + (max_rowid + 1 - min_rowid) * i // num_partitions for i in range(num_partitions + 1)]
+        return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+    def _scan(self, sql: str, batch_size: int, start_rowid: int, end_rowid: int) -> Iterator[tuple]:
+        """Keyset pagination over `sql`, which selects `rowid` first and takes (last rowid, end, limit)."""
+        last_rowid = start_rowid - 1
+        while True:
+            rows = self._execute(sql, (last_rowid, end_rowid, batch_size))
+            if not rows:
+                return
+            yield from rows
+            last_rowid = rows[-1][0]
+
+    def iter_texts(
+            self,
+            batch_size: int = DEFAULT_SCAN_BATCH_SIZE,
+            start_rowid: Optional[int] = None,
+            end_rowid: Optional[int] = None,
+            non_empty: bool = True
+    ) -> Iterator[tuple[int, str, Optional[str]]]:
+        """Stream (rowid, page_id, text) in rowid order, like `FeverousDB.iter_docs`. Empty pages have no text."""
+        non_empty_filter = "AND text IS NOT NULL " if non_empty else ""
+        yield from self._scan(
+            f"SELECT rowid, page_id, text FROM pages WHERE rowid > ? AND rowid < ? {non_empty_filter}"
+            "ORDER BY rowid LIMIT ?",
+            batch_size,
+            0 if start_rowid is None else start_rowid,
+            (1 << 63) - 1 if end_rowid is None else end_rowid,
+        )
+
+    def iter_elements(
+            self,
+            batch_size: int = DEFAULT_SCAN_BATCH_SIZE,
+            start_rowid: Optional[int] = None,
+            end_rowid: Optional[int] = None
+    ) -> Iterator[tuple[int, str, str, str, str]]:
+        """Stream (page rowid, page_id, element_id, text, section) in page order.
+
+        `start_rowid` and `end_rowid` are page rowids, as in `iter_texts`.
+        """
+        if not self.has_elements:
+            raise ValueError(f"{self.path} was built without elements")
+        bounds = []
+        for page_rowid in (start_rowid, end_rowid):
+            rows = [(None,)]
+            if page_rowid is not None:
+                rows = self._execute("SELECT MIN(rowid) FROM elements WHERE page_rowid >= ?", (page_rowid,))
+            bounds.append(rows[0][0])
+        start, end = bounds
+        if start is None and start_rowid is not None:
+            return
+        for _, page_rowid, page_id, element_id, text, section in self._scan(
+                "SELECT rowid, page_rowid, page_id, element_id, text, section FROM elements "
+                "WHERE rowid > ? AND rowid < ? ORDER BY rowid LIMIT ?",
+                batch_size,
+                0 if start is None else start,
+                (1 << 63) - 1 if end is None else end,
+        ):
+            yield page_rowid, page_id, element_id, text, section
+
+    def close(self):
+        self.pool.close()
+
+
+# ------------------------------------------------------------------------------
+# Building: every worker scans a rowid range of the DB, reuses the rows of the
+# previous store for unchanged pages and parses the others. The parent writes the
+# partitions in rowid order.
+# ------------------------------------------------------------------------------
+
+_DB: Optional[FeverousDB] = None
+_PREVIOUS: Optional[TextStore] = None
+_ELEMENTS = False
+_MAX_TABLE_CHARS: Optional[int] = None
+
+
+def _init_worker(document_path: str, previous_path: Optional[str], elements: bool, max_table_chars: Optional[int]):
+    global _DB, _PREVIOUS, _ELEMENTS, _MAX_TABLE_CHARS
+    _DB = FeverousDB(document_path, read_only=True)
+    _PREVIOUS = TextStore(previous_path) if previous_path else None
+    _ELEMENTS = elements
+    _MAX_TABLE_CHARS = max_table_chars
+
+
+def _render_partition(partition: tuple[int, int]):
+    # Imported here, elements imports this module
+    from .elements import iter_page_elements
+
+    start_rowid, end_rowid = partition
+    pages, elements, num_reused = [], [], 0
+    for rowid, page_id, data in _DB.iter_docs(start_rowid=start_rowid, end_rowid=end_rowid):
+        data_hash = hash_data(data)
+        previous = _PREVIOUS.get_page(page_id) if _PREVIOUS is not None else None
+        if previous is not None and previous[1] == data_hash:
+            text = previous[2]
+            if _ELEMENTS:
+                elements.extend(
+                    (rowid, page_id) + element for element in _PREVIOUS.get_page_elements(previous[0])
+                )
+            num_reused += 1
+        elif data and data.strip():
+            wiki_page = WikiPage(page_id, json.loads(data))
+            text = wiki_page.linearize(_MAX_TABLE_CHARS)
+            if _ELEMENTS:
+                elements.extend((rowid, page_id) + element for element in iter_page_elements(wiki_page))
+        else:
+            text = None
+        pages.append((rowid, page_id, data_hash, text))
+    return pages, elements, num_reused
+
+
+def build_text_store(
+        document_path: str,
+        output_path: str,
+        elements: bool = False,
+        workers: int = 4,
+        num_partitions: Optional[int] = None,
+        progress: Optional[Callable[[int], None]] = None,
+        max_table_chars: Optional[int] = None
+) -> TextStore:
+    """Write the text (and with `elements=True` the evidence elements) of every page of `document_path`.
+
+    Page texts are `WikiPage.linearize(max_table_chars)`, so that huge tables do not dominate the
+    documents of the indexes built from the store. When `output_path` already holds a store built
+    with the same `max_table_chars`, pages whose json did not change are copied from it instead of
+    being parsed again. The rowid range is cut into `num_partitions` (default `64 * workers`)
+    ranges read by `workers` processes.
+    """
+    previous_path = None
+    if os.path.exists(output_path):
+        previous = TextStore(output_path)
+        if (previous.has_elements or not elements) and previous.meta.get("max_table_chars") == max_table_chars:
+            previous_path = output_path
+        previous.close()
+
+    tmp_path = output_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    fingerprint = get_file_fingerprint(document_path)
+    connection = sqlite3.connect(tmp_path)
+    for statement in SCHEMA:
+        connection.execute(statement)
+
+    db = FeverousDB(document_path, read_only=True)
+    partitions = db.get_rowid_partitions(num_partitions or 64 * workers)
+    db.close()
+
+    content_hash = hashlib.blake2b(digest_size=HASH_SIZE)
+    num_pages, num_reused = 0, 0
+    with mp.Pool(
+            processes=workers,
+            initializer=_init_worker,
+            initargs=(document_path, previous_path, elements, max_table_chars)
+    ) as pool:
+        # Ordered, so that the store is written in rowid order
+        for pages, element_rows, part_reused in pool.imap(_render_partition, partitions):
+            connection.executemany("INSERT INTO pages VALUES (?, ?, ?, ?)", pages)
+            connection.executemany(
+                "INSERT INTO elements (page_rowid, page_id, element_id, text, section) VALUES (?, ?, ?, ?, ?)",
+                element_rows,
+            )
+            connection.commit()
+            for _, page_id, data_hash, _ in pages:
+                update_content_hash(content_hash, page_id, data_hash)
+            num_pages += len(pages)
+            num_reused += part_reused
+            if progress:
+                progress(len(pages))
+
+    meta = {
+        "document_path": document_path,
+        "content_hash": content_hash.hexdigest(),
+        "elements": elements,
+        "max_table_chars": max_table_chars,
+        "num_pages": num_pages,
+        "num_reused": num_reused,
+        **fingerprint,
+    }
+    connection.execute("INSERT INTO text_meta VALUES ('meta', ?)", (json.dumps(meta),))
+    connection.commit()
+    connection.close()
+    os.replace(tmp_path, output_path)
+
+    return TextStore(output_path)
+
+
+def open_text_store(text_store_path: str, document_path: str, max_table_chars: Optional[int] = ...) -> TextStore:
+    """Open the store at `text_store_path` after checking that it matches `document_path`.
+
+    When `max_table_chars` is passed (None included), the store must also have been built with that cap.
+    """
+    store = TextStore(text_store_path)
+    try:
+        store.check(document_path)
+        if max_table_chars is not ... and store.meta.get("max_table_chars") != max_table_chars:
+            raise ValueError(
+                f"{text_store_path} was built with max_table_chars={store.meta.get('max_table_chars')}, "
+                f"not {max_table_chars}"
+            )
+    except ValueError:
+        store.close()
+        raise
+    return store
+
+
+def iter_page_texts(
+        document_path: str,
+        text_store_path: Optional[str] = None,
+        start_rowid: Optional[int] = None,
+        end_rowid: Optional[int] = None,
+        non_empty: bool = True,
+        max_table_chars: Optional[int] = None
+) -> Iterator[tuple[int, str, Optional[str]]]:
+    """Stream (rowid, page_id, `str(WikiPage)`) in rowid order, from the store when one is given.
+
+    Without a store every page of `document_path` is parsed and its tables are capped at
+    `max_table_chars`; a store has the cap it was built with. With `non_empty=False` empty pages
+    are included, with a None text.
+    """
+    if text_store_path:
+        store = TextStore(text_store_path)
+        yield from store.iter_texts(start_rowid=start_rowid, end_rowid=end_rowid, non_empty=non_empty)
+        store.close()
+        return
+
+    db = FeverousDB(document_path, read_only=True)
+    for rowid, page_id, data in db.iter_docs(start_rowid=start_rowid, end_rowid=end_rowid, non_empty=non_empty):
+        text = WikiPage(page_id, json.loads(data)).linearize(max_table_chars) if data and data.strip() else None
+        yield rowid, page_id, text
+    db.close()
+
+
+def iter_element_texts(
+        document_path: str,
+        text_store_path: Optional[str] = None,
+        start_rowid: Optional[int] = None,
+        end_rowid: Optional[int] = None
+) -> Iterator[tuple[int, str, str, str, str]]:
+    """Stream (page rowid, page_id, element_id, rendered content, section path) of every evidence element.
+
+    `start_rowid` and `end_rowid` bound the page rowids, as in `iter_page_texts`.
+    """
+    if text_store_path:
+        store = TextStore(text_store_path)
+        yield from store.iter_elements(start_rowid=start_rowid, end_rowid=end_rowid)
+        store.close()
+        return
+
+    from .elements import iter_page_elements
+
+    db = FeverousDB(document_path, read_only=True)
+    for rowid, page_id, data in db.iter_docs(start_rowid=start_rowid, end_rowid=end_rowid, non_empty=True):
+        wiki_page = WikiPage(page_id, json.loads(data))
+        for element_id, content, section in iter_page_elements(wiki_page):
+            yield rowid, page_id, element_id, content, section
+    db.close()
@@ -0,0 +1,241 @@
+"""
+Hashed unigram + bigram TF-IDF retriever, following DrQA's document retriever.
+
+N-grams are hashed into `hash_size` buckets with murmurhash, so the index is a single
+(hash_size x num_docs) CSR matrix with no vocabulary. Queries are scored with one sparse
+matrix-vector product (matrix-matrix for a batch) and the top-k is taken with `argpartition`.
+"""
+import multiprocessing as mp
+from collections import Counter
+from functools import partial
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+import regex
+import scipy.sparse as sp
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+
+from src.modules.datasets.feverous.database.feverous_db import FeverousDB
+from src.modules.datasets.feverous.database.utils import (
+    hash,
+    filter_ngram,
+    normalize,
+    save_sparse_csr,
+    load_sparse_csr
+)
+from .text_store import iter_page_texts, open_text_store
+from .utils import PageTextLoader
+
+DEFAULT_HASH_SIZE = 2 ** 24
+DEFAULT_NGRAM = 2
+
+TOKEN_PATTERN = regex.compile(r"[\p{L}\p{N}\p{M}]+|[^\p{Z}\p{C}]", flags=regex.IGNORECASE + regex.UNICODE)
+
+
+def ngrams(text: str, n: int = DEFAULT_NGRAM) -> list[str]:
+    """Lowercased 1..n-grams of `text`, dropping n-grams containing stopwords or punctuation."""
+    tokens = [token.lower() for token in TOKEN_PATTERN.findall(normalize(text))]
+    grams = []
+    for size in range(1, n + 1):
+        for start in range(len(tokens) - size + 1):
+            gram = tokens[start:start + size]
+            if not filter_ngram(gram, mode="any"):
+                grams.append(" ".join(gram))
+    return grams
+
+
+def hash_ngrams(text: str, hash_size: int = DEFAULT_HASH_SIZE, n: int = DEFAULT_NGRAM) -> Counter:
+    return Counter(hash(gram, hash_size) for gram in ngrams(text, n))
+
+
+# ------------------------------------------------------------------------------
+# Index building: every worker scans a rowid range of the DB (or of its text store)
+# sequentially and streams back the doc ids and (bucket, column, count) triplets
+# of its pages.
+# ------------------------------------------------------------------------------
+
+def _count_partition(
+        partition: tuple[int, int],
+        document_path: str,
+        text_store_path: Optional[str],
+        hash_size: int,
+        n: int
+):
+    start_rowid, end_rowid = partition
+    doc_ids, rows, cols, data = [], [], [], []
+    for _, doc_id, text in iter_page_texts(document_path, text_store_path, start_rowid, end_rowid, non_empty=False):
+        # Empty pages keep their (empty) column, like every other page of the DB
+        if text is not None:
+            counts = hash_ngrams(text, hash_size, n)
+            rows.extend(counts.keys())
+            cols.extend([len(doc_ids)] * len(counts))
+            data.extend(counts.values())
+        doc_ids.append(doc_id)
+    return doc_ids, rows, cols, data
+
+
+def build_count_matrix(
+        document_path: str,
+        hash_size: int = DEFAULT_HASH_SIZE,
+        n: int = DEFAULT_NGRAM,
+        workers: int = 4,
+        num_partitions: Optional[int] = None,
+        progress: Optional[Callable[[int], None]] = None,
+        text_store_path: Optional[str] = None
+) -> tuple[sp.csr_matrix, list[str]]:
+    """Count hashed n-grams of every page in a multi-process streaming pass.
+
+    The rowid range is cut into `num_partitions` (default `8 * workers`) ranges that are each
+    read sequentially. Returns the count matrix and the doc id of every column, in rowid order.
+    Page texts come from the store at `text_store_path` when given, see `build_text_store`.
+    """
+    if text_store_path:
+        open_text_store(text_store_path, document_path).close()
+    db = FeverousDB(document_path, read_only=True)
+    partitions = db.get_rowid_partitions(num_partitions or 8 * workers)
+    db.close()
+
+    # Seeded with empty arrays, so that a DB without pages gives an empty (hash_size, 0) matrix
+    doc_ids = []
+    rows, cols, data = [np.empty(0, np.int64)], [np.empty(0, np.int32)], [np.empty(0, np.float32)]
+    with mp.Pool(processes=workers) as pool:
+        # Ordered, so that the columns of a partition follow those of the previous ones
+        for part_ids, part_rows, part_cols, part_data in pool.imap(
+                partial(
+                    _count_partition,
+                    document_path=document_path,
+                    text_store_path=text_store_path,
+                    hash_size=hash_size,
+                    n=n
+                ),
+                partitions
+        ):
+            rows.append(np.asarray(part_rows, dtype=np.int64))
+            cols.append(np.asarray(part_cols, dtype=np.int32) + len(doc_ids))
+            data.append(np.asarray(part_data, dtype=np.float32))
+            doc_ids.extend(part_ids)
+            if progress:
+                progress(len(part_ids))
+
+    count_matrix = sp.csr_matrix(
+        (np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(hash_size, len(doc_ids))
+    )
+    count_matrix.sum_duplicates()
+    return count_matrix, doc_ids
+
+
+def get_doc_freqs(count_matrix: sp.csr_matrix) -> np.ndarray:
+    """Number of documents each hash bucket appears in."""
+    binary = (count_matrix > 0).astype(int)
+    return np.array(binary.sum(1)).squeeze()
+
+
+def get_tfidf_matrix(count_matrix: sp.csr_matrix, doc_freqs: np.ndarray) -> sp.csr_matrix:
+    """tfidf = log(tf + 1) * log((N - Nt + 0.5) / (Nt + 0.5)), clipped at 0."""
+    num_docs = count_matrix.shape[1]
+    idfs = np.log((num_docs - doc_freqs + 0.5) / (doc_freqs + 0.5))
+    idfs[idfs < 0] = 0
+    tfs = count_matrix.log1p()
+    return (sp.diags(idfs, 0) @ tfs).tocsr()
+
+
+def build_tfidf(
+        output_path: str,
+        document_path: str,
+        hash_size: int = DEFAULT_HASH_SIZE,
+        n: int = DEFAULT_NGRAM,
+        workers: int = 4,
+        progress: Optional[Callable[[int], None]] = None,
+        text_store_path: Optional[str] = None
+):
+    count_matrix, doc_ids = build_count_matrix(
+        document_path, hash_size, n, workers, progress=progress, text_store_path=text_store_path
+    )
+    doc_freqs = get_doc_freqs(count_matrix)
+    tfidf = get_tfidf_matrix(count_matrix, doc_freqs)
+
+    metadata = {
+        "doc_freqs": doc_freqs,
+        "doc_ids": doc_ids,
+        "hash_size": hash_size,
+        "ngram": n,
+        "document_path": document_path,
+    }
+    save_sparse_csr(output_path, tfidf, metadata)
+
+
+class TfidfRetriever(BaseRetriever):
+    """
+    `BaseRetriever` over a hashed TF-IDF matrix saved by `build_tfidf`, usable in place of `BM25Retriever`.
+    """
+    def __init__(
+            self,
+            tfidf_path: str,
+            document_path: Optional[str] = None,
+            similarity_top_k: int = 10,
+            max_table_chars: Optional[int] = None,
+            **kwargs
+    ):
+        super().__init__(**kwargs)
+        matrix, metadata = load_sparse_csr(tfidf_path)
+        self.tfidf_path = tfidf_path
+        self.doc_mat = matrix
+        self.doc_freqs = metadata["doc_freqs"]
+        self.doc_ids = metadata["doc_ids"]
+        self.hash_size = metadata["hash_size"]
+        self.ngram = metadata["ngram"]
+        self.num_docs = len(self.doc_ids)
+        self.similarity_top_k = similarity_top_k
+        self.pages = PageTextLoader(document_path or metadata["document_path"], max_table_chars)
+
+    def text2spvec(self, query: str) -> sp.csr_matrix:
+        """Hashed TF-IDF (1 x hash_size) vector of `query`."""
+        counts = hash_ngrams(query, self.hash_size, self.ngram)
+        if not counts:
+            return sp.csr_matrix((1, self.hash_size))
+
+        wids = np.fromiter(counts.keys(), dtype=np.int64)
+        tfs = np.log1p(np.fromiter(counts.values(), dtype=np.float32))
+        doc_freqs = self.doc_freqs[wids]
+        idfs = np.log((self.num_docs - doc_freqs + 0.5) / (doc_freqs + 0.5))
+        idfs[idfs < 0] = 0
+        return sp.csr_matrix((tfs * idfs, wids, [0, len(wids)]), shape=(1, self.hash_size))
+
+    def _top_k(self, scores: np.ndarray, k: int) -> list[tuple[int, float]]:
+        if len(scores) > k:
+            best = np.argpartition(-scores, k)[:k]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return [(int(i), float(scores[i])) for i in best if scores[i] > 0]
+
+    def closest_docs(self, query: str, k: int = None) -> list[tuple[str, float]]:
+        scores = (self.text2spvec(query) @ self.doc_mat).toarray().ravel()
+        return [(self.doc_ids[i], score) for i, score in self._top_k(scores, k or self.similarity_top_k)]
+
+    def retrieve_ids(self, query: str, k: Optional[int] = None) -> list[tuple[str, float]]:
+        return self.closest_docs(query, k)
+
+    def batch_closest_docs(self, queries: Iterable[str], k: int = None) -> list[list[tuple[str, float]]]:
+        """Score a batch of queries with a single (num_queries x hash_size) @ (hash_size x num_docs) product."""
+        query_mat = sp.vstack([self.text2spvec(query) for query in queries], format="csr")
+        results = []
+        for scores in query_mat @ self.doc_mat:
+            top = self._top_k(scores.toarray().ravel(), k or self.similarity_top_k)
+            results.append([(self.doc_ids[i], score) for i, score in top])
+        return results
+
+    def _to_nodes(self, hits: list[tuple[str, float]], query: Optional[str] = None) -> list[NodeWithScore]:
+        texts = self.pages.get_texts([doc_id for doc_id, _ in hits], query)
+        return [
+            NodeWithScore(node=TextNode(id_=doc_id, text=text), score=score)
+            for (doc_id, score), text in zip(hits, texts)
+        ]
+
+    def _retrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+        return self._to_nodes(self.closest_docs(query_bundle.query_str), query_bundle.query_str)
+
+    def retrieve_batch(self, queries: list[str]) -> list[list[NodeWithScore]]:
+        return [self._to_nodes(hits, query) for hits, query in zip(self.batch_closest_docs(queries), queries)]
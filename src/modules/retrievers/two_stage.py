@@ -0,0 +1,134 @@
+import logging
+import math
+from collections import Counter, OrderedDict, defaultdict
+from time import perf_counter
+from typing import Optional
+
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+
+from .elements import iter_page_elements, make_element_node
+from .utils import tokenize, PageTextLoader
+
+logger = logging.getLogger(__name__)
+
+
+class TwoStageRetriever(BaseRetriever):
+    """
+    Page -> element retrieval with bounded candidate sets.
+
+    Stage 1 asks `page_retriever` (any page-level retriever, ideally one exposing `retrieve_ids`
+    such as `MmapBM25Retriever`, `TfidfRetriever` or `LazyRetriever`) for the top `page_top_k` pages.
+    Without `retrieve_ids` the retriever's `similarity_top_k` is raised to `page_top_k`.
+    Stage 2 re-scores only the evidence elements of those pages with BM25 whose statistics are
+    computed over the candidate set, and returns the top `similarity_top_k` elements.
+
+    Parsed page elements are kept in an LRU cache of `cache_size` pages. Per-stage timings of the last
+    query are in `last_timings`, running totals in `timings`.
+    """
+    def __init__(
+            self,
+            page_retriever: BaseRetriever,
+            document_path: Optional[str] = None,
+            page_top_k: int = 20,
+            similarity_top_k: int = 10,
+            cache_size: int = 1024,
+            k1: float = 1.2,
+            b: float = 0.75,
+            **kwargs
+    ):
+        super().__init__(**kwargs)
+        if document_path is None and hasattr(page_retriever, "pages"):
+            document_path = page_retriever.pages.document_path
+        if document_path is None:
+            raise ValueError("Please pass document_path or a page retriever with a `pages` loader.")
+
+        if not hasattr(page_retriever, "retrieve_ids") and (page_retriever.similarity_top_k or 0) < page_top_k:
+            # `retrieve` returns at most `similarity_top_k` pages
+            page_retriever.similarity_top_k = page_top_k
+        self.page_retriever = page_retriever
+        self.pages = PageTextLoader(document_path)
+        self.page_top_k = page_top_k
+        self.similarity_top_k = similarity_top_k
+        self.cache_size = cache_size
+        self.k1 = k1
+        self.b = b
+
+        self._elements = OrderedDict()
+        self.last_timings = {}
+        self.timings = defaultdict(float)
+
+    def retrieve_pages(self, query: str) -> list[str]:
+        if hasattr(self.page_retriever, "retrieve_ids"):
+            return [page_id for page_id, _ in self.page_retriever.retrieve_ids(query, self.page_top_k)]
+        return [node.node_id for node in self.page_retriever.retrieve(query)[:self.page_top_k]]
+
+    def get_elements(self, page_id: str) -> list[tuple[str, str, str, Counter, int]]:
+        """(full element id, content, section, term counts, length) of every evidence element of a page."""
+        if page_id in self._elements:
+            self._elements.move_to_end(page_id)
+            return self._elements[page_id]
+
+        elements = []
+        wiki_page = self.pages.get_page(page_id)
+        if wiki_page:
+            for element_id, content, section in iter_page_elements(wiki_page):
+                tokens = tokenize(f"{page_id} {section} {content}")
+                elements.append((f"{page_id}_{element_id}", content, section, Counter(tokens), len(tokens)))
+
+        self._elements[page_id] = elements
+        if len(self._elements) > self.cache_size:
+            self._elements.popitem(last=False)
+        return elements
+
+    def score(self, query_tokens: list[str], candidates: list[tuple]) -> list[float]:
+        """BM25 of every candidate element, with idf and average length taken over the candidates."""
+        num_docs = len(candidates)
+        avg_len = sum(candidate[4] for candidate in candidates) / num_docs or 1.0
+        query_terms = set(query_tokens)
+        doc_freqs = Counter(term for candidate in candidates for term in query_terms & candidate[3].keys())
+        idfs = {
+            term: math.log(1 + (num_docs - df + 0.5) / (df + 0.5)) for term, df in doc_freqs.items()
+        }
+
+        scores = []
+        for _, _, _, counts, length in candidates:
+            norm = self.k1 * (1 - self.b + self.b * length / avg_len)
+            scores.append(sum(
+                idfs[term] * counts[term] * (self.k1 + 1) / (counts[term] + norm)
+                for term in query_terms if term in counts
+            ))
+        return scores
+
+    def _retrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+        query = query_bundle.query_str
+
+        start = perf_counter()
+        page_ids = self.retrieve_pages(query)
+        pages_done = perf_counter()
+        candidates = [element for page_id in page_ids for element in self.get_elements(page_id)]
+        elements_done = perf_counter()
+
+        nodes = []
+        if candidates:
+            scores = self.score(tokenize(query), candidates)
+            ranked = sorted(range(len(candidates)), key=lambda i: -scores[i])[:self.similarity_top_k]
+            nodes = [
+                make_element_node(candidates[i][0], candidates[i][1], candidates[i][2], scores[i])
+                for i in ranked if scores[i] > 0
+            ]
+        scoring_done = perf_counter()
+
+        self.last_timings = {
+            "pages": pages_done - start,
+            "elements": elements_done - pages_done,
+            "scoring": scoring_done - elements_done,
+            "num_pages": len(page_ids),
+            "num_candidates": len(candidates),
+        }
+        for key, value in self.last_timings.items():
+            self.timings[key] += value
+        self.timings["queries"] += 1
+        logger.debug(f"Two-stage retrieval timings: {self.last_timings}")
+
+        return nodes
@@ -0,0 +1,105 @@
+import bisect
+import os
+import re
+from typing import Iterable, Optional
+
+import numpy as np
+
+from src.modules.datasets.feverous.database.page_cache import WikiPageCache
+from src.modules.datasets.feverous.database.utils import STOPWORDS
+from src.modules.datasets.feverous.utils.wiki_page import WikiPage
+
+TOKEN_PATTERN = re.compile(r"(?u)\b\w\w+\b")
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercase word tokens with english stopwords removed (shared by index build and query time)."""
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def save_string_array(path: str, name: str, strings: Iterable[str]):
+    """
+    Persist `strings` as one utf-8 blob (`<name>.npy`) plus int64 offsets (`<name>_offsets.npy`)
+    so that they can be opened with `np.load(mmap_mode='r')` without decoding the whole list.
+    """
+    offsets = [0]
+    chunks = []
+    for string in strings:
+        encoded = string.encode("utf-8")
+        chunks.append(encoded)
+        offsets.append(offsets[-1] + len(encoded))
+    np.save(os.path.join(path, f"{name}.npy"), np.frombuffer(b"".join(chunks), dtype=np.uint8))
+    np.save(os.path.join(path, f"{name}_offsets.npy"), np.asarray(offsets, dtype=np.int64))
+
+
+class StringArray:
+    """Read-only, memory-mapped view over an array written by `save_string_array`."""
+    def __init__(self, path: str, name: str):
+        self.blob = np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, f"{name}_offsets.npy"), mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def get_bytes(self, index: int) -> bytes:
+        return self.blob[self.offsets[index]:self.offsets[index + 1]].tobytes()
+
+    def __getitem__(self, index: int) -> str:
+        return self.get_bytes(index).decode("utf-8")
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def search(self, string: str, order: Optional[np.ndarray] = None) -> int:
+        """
+        Binary search for `string`, returning its index or -1.
+
+        The array must be sorted, or `order` must be the permutation that sorts it.
+        """
+        target = string.encode("utf-8")
+
+        def key(position):
+            return self.get_bytes(position if order is None else order[position])
+
+        position = bisect.bisect_left(range(len(self)), target, key=key)
+        if position < len(self) and key(position) == target:
+            return position if order is None else int(order[position])
+        return -1
+
+
+class PageTextLoader:
+    """
+    Renders the text of retrieved pages from a Feverous DB that is only opened on first use.
+    Parsed pages come from the process-wide `WikiPageCache` of that DB, shared with dataset rendering.
+
+    With `max_table_chars` tables are capped at that many characters, keeping the rows most
+    relevant to the query the texts are rendered for (see `WikiTable.linearize`).
+    """
+    def __init__(self, document_path: Optional[str], max_table_chars: Optional[int] = None):
+        self.document_path = document_path
+        self.max_table_chars = max_table_chars
+        self._cache = None
+
+    @property
+    def cache(self) -> WikiPageCache:
+        if self._cache is None:
+            self._cache = WikiPageCache.shared(self.document_path)
+        return self._cache
+
+    def get_page(self, page_id: str) -> Optional[WikiPage]:
+        return self.cache.get_page(page_id)
+
+    def get_pages(self, page_ids: list[str]) -> list[Optional[WikiPage]]:
+        """`get_page` for several pages, reading the uncached ones in one bulk query."""
+        return self.cache.get_pages(page_ids)
+
+    def get_text(self, page_id: str, query: Optional[str] = None) -> str:
+        wiki_page = self.get_page(page_id)
+        return wiki_page.linearize(self.max_table_chars, query) if wiki_page else ""
+
+    def get_texts(self, page_ids: list[str], query: Optional[str] = None) -> list[str]:
+        return [
+            wiki_page.linearize(self.max_table_chars, query) if wiki_page else ""
+            for wiki_page in self.get_pages(page_ids)
+        ]
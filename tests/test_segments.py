@@ -0,0 +1,72 @@
+import json
+import sqlite3
+
+import pytest
+
+from src.modules.retrievers.bm25 import build_sharded_index
+from src.modules.retrievers.segments import SegmentedBM25Index, update_pages
+from src.modules.retrievers.utils import tokenize
+
+WORDS = "alpha beta gamma delta river mountain guitar band season league album song".split()
+QUERIES = ["alpha river", "guitar band season", "league song delta", "gamma 3"]
+
+
+def make_page(title, num_rows, offset=0):
+    cells = [
+        [
+            {
+                "id": f"header_cell_0_{r}_{c}" if r == 0 else f"cell_0_{r}_{c}",
+                "value": f"{WORDS[(r + c + offset) % len(WORDS)]} {r * c}",
+                "is_header": r == 0,
+                "row_span": 1,
+                "column_span": 1,
+            }
+            for c in range(3)
+        ]
+        for r in range(num_rows)
+    ]
+    return {
+        "title": title,
+        "order": ["sentence_0", "table_0"],
+        "sentence_0": f"{title} {WORDS[offset % len(WORDS)]} {WORDS[(offset * 5) % len(WORDS)]}",
+        "table_0": {"type": "infobox", "table": cells, "caption": "Stats"},
+    }
+
+
+def write_db(path, pages):
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE IF NOT EXISTS wiki (id PRIMARY KEY, data json)")
+    connection.executemany(
+        "INSERT OR REPLACE INTO wiki VALUES (?, ?)",
+        [(title, json.dumps(page) if page else "") for title, page in pages.items()],
+    )
+    connection.commit()
+    connection.close()
+
+
+def ranking(index, query):
+    return {index.doc_ids[doc_idx]: round(score, 5) for doc_idx, score in index.top_k(tokenize(query), 100)}
+
+
+@pytest.mark.parametrize("max_table_chars", [None, 60])
+def test_update_equals_rebuild(tmp_path, max_table_chars):
+    document_path = str(tmp_path / "wiki.db")
+    write_db(document_path, {f"Page {i}": make_page(f"Page {i}", 3 + i % 7, i) for i in range(20)})
+    index_path = str(tmp_path / "index")
+    build_sharded_index(index_path, document_path, workers=1, num_shards=3, max_table_chars=max_table_chars)
+
+    # Page 1 gets a larger table, Page 2 is emptied and Page 20 is new
+    write_db(document_path, {"Page 1": make_page("Page 1", 30, 11), "Page 2": None, "Page 20": make_page("Page 20", 12, 4)})
+    index = SegmentedBM25Index(index_path)
+    assert update_pages(index, document_path, ["Page 1", "Page 2", "Page 20"]) == (2, 1)
+
+    fresh = build_sharded_index(
+        str(tmp_path / "fresh"), document_path, workers=1, num_shards=3, max_table_chars=max_table_chars
+    )
+    assert index.num_docs == fresh.num_docs
+    for query in QUERIES:
+        assert ranking(index, query) == ranking(fresh, query)
+
+    index.compact()
+    for query in QUERIES:
+        assert ranking(SegmentedBM25Index(index_path), query) == ranking(fresh, query)